@@ -6,17 +6,29 @@ Created on Sat Oct 26 10:15:17 2019
 """
 try:
     from calendar import isleap
+    from concurrent.futures import ThreadPoolExecutor
     import csv
     from datetime import date, datetime, timedelta
     import inspect
+    from itertools import chain
     import json
     import pathlib
     import requests
     from requests.adapters import HTTPAdapter, Retry
+    from threading import Lock
     from time import time
     from typing import Union
     
     import littleLogging as logging
+    from aod_2db import AOD_2db
+    from aod_http_cache import ResponseCache
+    from aod_json_stream import first_char, iter_json_array
+    from aod_key_pool import ApiKeyPool
+    from aod_manifest import DownloadManifest
+    from aod_metadata_cache import MetadataCache
+    from aod_rate_limiter import TokenBucket
+    from aod_writers import CsvRecordWriter, DbRecordWriter, \
+        FILE_SUFFIXES, new_file_writer, ParquetRecordWriter, TeeRecordWriter
 except ImportError as e:
     print( getattr(e, 'message', repr(e)))
     raise SystemExit(0)
@@ -63,11 +75,21 @@ class AemetOpenData():
     #  {backoff_factor} * (2 **(total number of retries - 1)) seconds
     __MAXREQUEST = 5
     __BACKOFF_FACTOR = 5
+    # Client-side rate limit (TokenBucket). Aemet allows about 50 requests
+    #  per minute per api key; every request, first or second stage, takes
+    #  a token of a key of the ApiKeyPool. __BURST is the number of requests
+    #  that can be made at once after a pause
+    __REQUESTS_PER_MINUTE = 40
+    __BURST = 5
     # Number of seconds Requests will wait for your client to establish a 
     #  connection to a remote machine call on the socket. It’s a good practice
     #  to set connect timeouts to slightly larger than a multiple of 3, which
     #  is the default TCP packet retransmission window.
     __TIMEOUT = (4, 28)
+    # Size in bytes of the chunks read from the server in the streaming mode
+    __CHUNK_SIZE = 64 * 1024
+    # Where the downloaded rows are saved, see meteo_data_all_stations
+    __SINKS = ('csv', 'db', 'both')
     
     # Maximum length of time series requests imposed by Aemet 
     __MAX_NDAYS_STATION = 365*5
@@ -78,33 +100,82 @@ class AemetOpenData():
     #  is set to False, no messages will be displayed on the screen until the
     #  time indicated below has elapsed.  
     __MIN_SECS_NOT_VERBOSE = 60
+
+    # Upper limit of simultaneous requests in the concurrent download mode
+    #  (parameter max_workers)
+    __MAX_WORKERS = 16
     
     __NONE_AS_STR = ''
     
     
-    def __init__(self, file_name: str='apikey.txt'):
+    def __init__(self, file_name: str='apikey.txt',
+                 requests_per_minute: float=__REQUESTS_PER_MINUTE,
+                 lock_file: str=None, response_cache: ResponseCache=None):
         """
-        Reads a valid api key from file_name
+        Reads the api keys from file_name
 
         Parameters
         ----------
         file_name : optional, the default is 'apikey.txt'.
-            File where api key has been saved
+            File where api key has been saved. It can have several keys, one
+            per line; the requests are spread over the keys (see
+            ApiKeyPool)
+        requests_per_minute : optional. Maximum rate of requests to the
+            server of each api key. The limit is shared by all the
+            AemetOpenData objects of the process that use the same api key,
+            so they must have the same requests_per_minute and lock_file;
+            otherwise ValueError is raised (see TokenBucket.shared)
+        lock_file : optional. If not None, the rate limit is also shared by
+            all the processes that use this lock file
+        response_cache : optional. If not None, the responses of the server
+            are saved in this cache and repeated requests are served from it
         """
         with open(file_name) as f:
-            self.__myapikey = f.readline()
-        self.__querystring = {"api_key": self.__myapikey}
+            keys = f.read().splitlines()
+        self.__key_pool = ApiKeyPool(keys, requests_per_minute,
+                                     AemetOpenData.__BURST, lock_file)
         self.__headers = {'cache-control': "no-cache"}
         self.__s = requests.Session()
-        retries = Retry(total=AemetOpenData.__MAXREQUEST, 
-                        backoff_factor=AemetOpenData.__BACKOFF_FACTOR, 
-                        status_forcelist=[ AemetOpenData.__TOOMANYREQUESTS ])
-        self.s.mount('http://', HTTPAdapter(max_retries=retries))
+        self.__mount_adapters()
+        self.__response_cache = response_cache
+        self.__request_counts = {'first_stage': 0, 'second_stage': 0,
+                                 'saved': 0, 'cached': 0}
+        self.__counts_lock = Lock()
 
 
     @property
     def s(self):
         return self.__s
+
+
+    def __mount_adapters(self, pool_maxsize: int=10) -> None:
+        """
+        Mounts the adapters of the session with retries on connection
+            errors. The 429 responses are managed by __request_get, so the
+            adapters do not retry the responses with the header Retry-After
+            (otherwise they would wait in the thread without blocking the
+            rate limiter). pool_maxsize is the number of connections kept
+            alive
+        """
+        retries = Retry(total=AemetOpenData.__MAXREQUEST,
+                        backoff_factor=AemetOpenData.__BACKOFF_FACTOR,
+                        respect_retry_after_header=False)
+        for prefix in ('https://', 'http://'):
+            self.s.mount(prefix, HTTPAdapter(max_retries=retries,
+                                             pool_connections=pool_maxsize,
+                                             pool_maxsize=pool_maxsize))
+
+
+    @property
+    def request_counts(self) -> dict:
+        """
+        Number of requests made to the server in the last download:
+            'first_stage', 'second_stage', 'saved' (first-stage requests
+            that were not needed because data and metadata were fetched
+            from the same first-stage response) and 'cached' (requests
+            served by the response cache)
+        """
+        return self.__request_counts.copy()
     
 
     def get_public_methods(self):
@@ -342,12 +413,23 @@ class AemetOpenData():
         return years_range
 
 
-    def __request_get(self, url: str) -> ():
+    def __request_get(self, url: str, payloads: [str]=None) -> ():
         """
-        It makes a get request to Aemet urls
+        It makes a get request to Aemet urls. If there is a response cache
+            and it has the response of url, the server is not requested.
+            Each request takes a token from the rate limiter; if the server
+            answers 429 (too many requests) the rate limiter is blocked for
+            the seconds in the header Retry-After and the request is
+            repeated up to __MAXREQUEST times. Each request is made with a
+            key of the ApiKeyPool; if the key is unauthorized (401) the
+            request is repeated with another key
         Parameters
         ----------
         url : url.
+        payloads : optional. If url is a first-stage request, the keys of
+            the urls of its response that will be requested ('datos',
+            'metadatos'); the response cache only serves the response if
+            their responses are also in it. If None, both
             
         Raises
         ------
@@ -376,40 +458,268 @@ class AemetOpenData():
 
         """
 
-        try:
-            r = self.s.get\
-                (url, headers=self.__headers, params=self.__querystring,
-                 timeout=AemetOpenData.__TIMEOUT)
-            r.raise_for_status()
-            
-            decoded_content = r.content.decode('ISO-8859-15')
-            data = json.loads(decoded_content)
-            description = data['descripcion'] if 'descripcion' \
-                in data else ''            
-            return (r.status_code, r.reason, description, data)
-        except requests.exceptions.HTTPError as err:
-            msg = f'HTTPError, code {r.status_code}: {r.reason}'
-            logging.append(msg)
-            raise SystemExit(err)
-        except requests.exceptions.JSONDecodeError as err:
-            msg=f'JSON decode error {err}'  
-            logging.append(msg)
-            raise SystemExit(err)             
-        except Exception as err:
-            msg = f'Request error {err}'
+        if self.__response_cache is not None:
+            if payloads is None:
+                content = self.__response_cache.get(url)
+            else:
+                content = self.__response_cache.get(url, payloads=payloads)
+            if content is not None:
+                self.__count_requests(cached=1)
+                data = json.loads(content.decode('ISO-8859-15'))
+                description = data['descripcion'] if 'descripcion' \
+                    in data else ''
+                return (AemetOpenData.__RESPONSEOK, 'OK (cache)', description,
+                        data)
+
+        attempt = 0
+        while attempt <= AemetOpenData.__MAXREQUEST:
+            key = self.__acquire_key()
+            try:
+                r = self.s.get\
+                    (url, headers=self.__headers, params={'api_key': key},
+                     timeout=AemetOpenData.__TIMEOUT)
+                if r.status_code == AemetOpenData.__UNAUTHORIZED:
+                    self.__key_pool.unauthorized(key)
+                    continue
+                if r.status_code == AemetOpenData.__TOOMANYREQUESTS:
+                    self.__wait_retry_after(r, attempt, key)
+                    attempt += 1
+                    continue
+                r.raise_for_status()
+
+                decoded_content = r.content.decode('ISO-8859-15')
+                data = json.loads(decoded_content)
+                # Sometimes Aemet informs of the 429 or 401 in the json
+                #  content
+                status = AemetOpenData.__json_status(data)
+                if status == AemetOpenData.__UNAUTHORIZED:
+                    self.__key_pool.unauthorized(key)
+                    continue
+                if status == AemetOpenData.__TOOMANYREQUESTS:
+                    self.__wait_retry_after(r, attempt, key)
+                    attempt += 1
+                    continue
+                self.__key_pool.authorized(key)
+                description = data['descripcion'] if 'descripcion' \
+                    in data else ''            
+                if self.__response_cache is not None and \
+                    AemetOpenData.__is_cacheable(data):
+                    self.__response_cache.put(url, r.content)
+                return (r.status_code, r.reason, description, data)
+            except requests.exceptions.HTTPError as err:
+                msg = f'HTTPError, code {r.status_code}: {r.reason}'
+                logging.append(msg)
+                raise SystemExit(err)
+            except requests.exceptions.JSONDecodeError as err:
+                msg=f'JSON decode error {err}'  
+                logging.append(msg)
+                raise SystemExit(err)             
+            except Exception as err:
+                msg = f'Request error {err}'
+                logging.append(msg)
+                raise SystemExit(err)        
+
+        msg = f'Too many requests, {AemetOpenData.__MAXREQUEST} retries ' +\
+            'exhausted'
+        logging.append(msg)
+        raise SystemExit(msg)
+
+
+    @staticmethod
+    def __is_cacheable(data: Union[dict, list]) -> bool:
+        """
+        Only successful responses are saved in the response cache: the
+            first-stage responses have 'estado' 200 and the payloads do not
+            have 'estado' 
+        """
+        if isinstance(data, dict) and 'estado' in data:
+            return data['estado'] == AemetOpenData.__RESPONSEOK
+        return True
+
+
+    @staticmethod
+    def __json_status(data: Union[dict, list]) -> int:
+        """
+        Returns the 'estado' of a json response or None if it has not
+        """
+        if isinstance(data, dict):
+            return data.get('estado')
+        return None
+
+
+    def __acquire_key(self) -> str:
+        """
+        Returns a key of the ApiKeyPool with a token available
+
+        Raises
+        ------
+        SystemExit if all the keys are unauthorized
+        """
+        key = self.__key_pool.acquire()
+        if key is None:
+            msg = 'All the api keys are unauthorized'
             logging.append(msg)
-            raise SystemExit(err)        
+            raise SystemExit(msg)
+        return key
+
+
+    def __wait_retry_after(self, r: requests.Response, attempt: int,
+                           key: str) -> None:
+        """
+        Blocks the rate limiter of key after a 429 response for the seconds
+            in the header Retry-After or, if it is missing, for an
+            exponential backoff time
+        """
+        default = AemetOpenData.__BACKOFF_FACTOR * (2 ** attempt)
+        seconds = TokenBucket.retry_after_seconds\
+            (r.headers.get('Retry-After'), default)
+        logging.append(f'Too many requests with api key '
+                       f'{ApiKeyPool.masked(key)}, waiting {seconds:0.0f} s')
+        self.__key_pool.block(key, seconds)
+
+
+    def __request_get_stream(self, url: str, writer: CsvRecordWriter) -> ():
+        """
+        As __request_get, but the response is read in chunks of __CHUNK_SIZE
+            bytes and, if it is a json array, each of its elements is written
+            with writer as soon as it is parsed; the response is never held
+            in memory. If there is a response cache, the chunks are also
+            written to a file of the cache
+
+        Parameters
+        ----------
+        url : url
+        writer : Writer of the rows of the response
+
+        Raises
+        ------
+        SystemExit
+
+        Returns
+        -------
+        A tuple (status_code, reason, description, data) as in __request_get;
+            if the response is an array, data is the number of rows written
+        """
+        cache = self.__response_cache
+        if cache is not None:
+            file_path = cache.get_path(url)
+            if file_path is not None:
+                self.__count_requests(cached=1)
+                with open(file_path, 'rb') as f:
+                    chunks = iter(lambda: f.read(AemetOpenData.__CHUNK_SIZE),
+                                  b'')
+                    return AemetOpenData.__parse_stream\
+                        (chunks, writer, AemetOpenData.__RESPONSEOK,
+                         'OK (cache)')
+
+        attempt = 0
+        while attempt <= AemetOpenData.__MAXREQUEST:
+            key = self.__acquire_key()
+            tmp_path = None
+            try:
+                with self.s.get(url, headers=self.__headers,
+                                params={'api_key': key},
+                                timeout=AemetOpenData.__TIMEOUT,
+                                stream=True) as r:
+                    if r.status_code == AemetOpenData.__UNAUTHORIZED:
+                        self.__key_pool.unauthorized(key)
+                        continue
+                    if r.status_code == AemetOpenData.__TOOMANYREQUESTS:
+                        self.__wait_retry_after(r, attempt, key)
+                        attempt += 1
+                        continue
+                    r.raise_for_status()
+
+                    chunks = r.iter_content(AemetOpenData.__CHUNK_SIZE)
+                    if cache is not None:
+                        tmp_path = cache.temp_path()
+                        chunks = AemetOpenData.__tee(chunks, tmp_path)
+                    response = AemetOpenData.__parse_stream\
+                        (chunks, writer, r.status_code, r.reason)
+                    data = response[3]
+                    status = AemetOpenData.__json_status(data)
+                    if status == AemetOpenData.__UNAUTHORIZED:
+                        self.__key_pool.unauthorized(key)
+                        continue
+                    if status == AemetOpenData.__TOOMANYREQUESTS:
+                        self.__wait_retry_after(r, attempt, key)
+                        attempt += 1
+                        continue
+                    self.__key_pool.authorized(key)
+                    if cache is not None and \
+                        AemetOpenData.__is_cacheable(data):
+                        cache.put_file(url, tmp_path)
+                    return response
+            except requests.exceptions.HTTPError as err:
+                msg = f'HTTPError, code {r.status_code}: {r.reason}'
+                logging.append(msg)
+                raise SystemExit(err)
+            except ValueError as err:
+                msg=f'JSON decode error {err}'
+                logging.append(msg)
+                raise SystemExit(err)
+            except Exception as err:
+                msg = f'Request error {err}'
+                logging.append(msg)
+                raise SystemExit(err)
+            finally:
+                if tmp_path is not None:
+                    tmp_path.unlink(missing_ok=True)
+
+        msg = f'Too many requests, {AemetOpenData.__MAXREQUEST} retries ' +\
+            'exhausted'
+        logging.append(msg)
+        raise SystemExit(msg)
+
+
+    @staticmethod
+    def __tee(chunks, file_path: pathlib.Path):
+        """
+        Yields chunks and writes them to file_path
+        """
+        with open(file_path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+
+
+    @staticmethod
+    def __parse_stream(chunks, writer: CsvRecordWriter, status_code: int,
+                       reason: str) -> ():
+        """
+        Parses a json response that arrives in chunks. If it is an array, its
+            elements are written with writer; otherwise (an object, like
+            the error messages of Aemet) it is returned as a dict
+        """
+        chunks = iter(chunks)
+        first = b''
+        for first in chunks:
+            if first.strip():
+                break
+        if first_char(first) != '[':
+            content = first + b''.join(chunks)
+            data = json.loads(content.decode('ISO-8859-15'))
+            description = data['descripcion'] if 'descripcion' \
+                in data else ''
+            return (status_code, reason, description, data)
+
+        for element in iter_json_array(chain([first], chunks)):
+            writer.write(element)
+        # The rest of the response, if any, is read to complete the tee
+        for _ in chunks:
+            pass
+        return (status_code, reason, '', writer.nrows)
 
 
     def __data_download_status\
-        (self, file_names: {}, saved_files: [str], verbose: bool) -> \
-            {str: bool, str: bool}:
+        (self, file_names: {}, manifest: DownloadManifest, verbose: bool,
+         sink: str='csv') -> {str: bool, str: bool}:
         """
         Determines whether a data request will be made to the server. For this
-            purpose it compares the name of the files where the data to be
+            purpose it looks up the name of the files where the data to be
             downloaded from the server will be stored (2 names, one for the
-            data and one for the metadata) with a list of files with 
-            previously downloaded data; if the file already exists the data
+            data and one for the metadata) in the manifest of the download
+            directory; if the file has been completely downloaded the data
             will not be downloaded again.
 
         Parameters
@@ -418,9 +728,11 @@ class AemetOpenData():
             Each key contains the name of the file where the respective data
             to be downloaded will be saved and then stored with these
             file names
-        saved_files : Names of previously saved files
+        manifest : Manifest of the download directory; if None all the files
+            will be downloaded
         verbose: If True, all possible messages are displayed on the screen;
             if False, fewer messages are displayed.
+        sink : The files must have been saved in sink
         Returns
         -------
         Dictionary with 2 keys: data and metadata
@@ -428,10 +740,10 @@ class AemetOpenData():
             performed.
 
         """
-        request_data = {'data': True, 'metadata': True}
-        if saved_files:
+        request_data = {k: v is not None for k, v in file_names.items()}
+        if manifest is not None:
             for k, v in file_names.items():
-                if v in saved_files:
+                if v is not None and manifest.is_complete(v, sink):
                     msg = f'{v} has been previously downloaded'
                     logging.append(msg, verbose)
                     request_data[k] = False
@@ -515,7 +827,7 @@ class AemetOpenData():
         ValueError
         Returns
         -------
-        None
+        Number of rows saved
 
         """
         def dict_template_get(list_of_dicts):
@@ -533,7 +845,7 @@ class AemetOpenData():
             raise ValueError(msg)
         
         if not data:
-            return
+            return 0
             
         with open(csv_file_path, 'w', newline='', encoding='utf-8') as csvfile:
             csvwriter = csv.writer(csvfile)
@@ -546,6 +858,7 @@ class AemetOpenData():
                 header = dict_template.keys()
                 csvwriter.writerow(header)
                 csvwriter.writerows(new_data)
+                return len(new_data)
             else:
                 if 'campos' in data:
                     dict_template = dict_template_get(data['campos'])
@@ -555,70 +868,437 @@ class AemetOpenData():
                     header = dict_template.keys()
                     csvwriter.writerow(header)
                     csvwriter.writerows(new_data)
+                    return len(new_data)
                 else:
                     header = data.keys()
                     csvwriter.writerow(header)
                     for item in data:
                         csvwriter.writerow(item.values())
+                    return len(data)
 
 
     def __request_and_save_file\
-        (self, url: str, k: str, ofile_names: dict, dir_path, verbose: bool,
-         start_time: ScalarContainer) -> bool:
+        (self, url: str, keys: [str], ofile_names: dict, run: dict,
+         station: str=None, period: [str]=(None, None)) -> [str]:
         """
         It makes a first data request to the server. If the response is ok it
-            makes a second request using one of the two urls supplied in the
-            first response (one url for the data and one for the metadata).
-            The url used in the second request is determined by the value of
-            the k parameter. 
+            makes a second request for each of the urls supplied in the
+            first response that are selected in keys (one url for the data
+            and one for the metadata). A single first request serves the
+            download of the data and the metadata.
 
         Parameters
         ----------
         url : A valid url
-        k : A string with value 'data' or 'metadata'
+        keys : A list with values in ('data', 'metadata')
         ofile_names : Names for the output files. It's a dict with 2 keys:
             'data' and 'metadata'
-        dir_path : Directory path where file with downloaded data will be saved
-        verbose: If True, all possible messages are displayed on the screen;
-            if False, fewer messages are displayed.
-        start_time : It is a ScalarContainer object that stores a reference
-            time that is used to display the messages on the screen or not
-            according to the value of the verbose parameter
+        run : Settings of the download, see __new_download_run
+        station : Station of the request, it is saved in the manifest
+        period : First and last date or year of the request, it is saved in
+            the manifest
 
         Returns
         -------
-        True if the process is completed, otherwise False
+        List with the names of the saved files, relative to dir_path
 
         """
+        if not keys:
+            return []
+
+        dir_path = run['dir_path']
+        metadata_cache = run['metadata_cache']
+        manifest = run['manifest']
+
         status_code1, reason1, description1, data1 = \
-            self.__request_get(url)
+            self.__request_get(url, ['datos' if k == 'data' else 'metadatos' \
+                                     for k in keys])
+        self.__count_requests(first_stage=1, saved=len(keys) - 1)
         if status_code1 != AemetOpenData.__RESPONSEOK:
-            return False
-        
-        aemet_key = 'datos' if k == 'data' else 'metadatos'
-        
-        if aemet_key in data1:
+            return []
+
+        if run['stream'] or run['db'] is not None or \
+            run['file_format'] != 'csv':
+            # The metadata gives the columns and types of the data
+            keys = sorted(keys, key=lambda k: k != 'metadata')
+
+        saved_files = []
+        metadata = None
+        for k in keys:
+            aemet_key = 'datos' if k == 'data' else 'metadatos'
+            if aemet_key not in data1:
+                continue
+
+            if k == 'data' and run['stream']:
+                file_path = dir_path.joinpath(ofile_names[k])
+                manifest.start(ofile_names[k], run['endpoint'], k, url,
+                               station, period, run['sink'])
+                status_code2, reason2, description2, nrows = \
+                    self.__stream_data(data1[aemet_key], file_path, run,
+                                       metadata)
+                self.__count_requests(second_stage=1)
+                if status_code2 != AemetOpenData.__RESPONSEOK:
+                    continue
+                manifest.complete(ofile_names[k], nrows)
+                if file_path.exists():
+                    saved_files.append\
+                        (file_path.relative_to(dir_path).as_posix())
+                self.__log_saved_file(file_path, status_code2, reason2,
+                                      description2, run)
+                continue
+
             status_code2, reason2, description2, data2 = \
                 self.__request_get(data1[aemet_key])
+            self.__count_requests(second_stage=1)
             if status_code2 != AemetOpenData.__RESPONSEOK:
-                return False
-            
-            file_path = dir_path.joinpath(ofile_names[k])
-            self.__save_to_csv(file_path, data2)
-            
-            file_name = pathlib.Path(file_path).name
-            msg = f'{file_name}: {status_code2}, {reason2} {description2}'
-            if verbose:
-                logging.append(msg)
+                continue
+
+            if k == 'metadata':
+                metadata = AemetOpenData.__metadata_columns(data2)
+            if k == 'metadata' and metadata_cache is not None:
+                file_path = metadata_cache.put(run['endpoint'], data2)
+                if run['db'] is not None:
+                    AemetOpenData.__insert_records(run['db'], data2, k)
             else:
-                xtime = time() - start_time.x
-                if xtime > AemetOpenData.__MIN_SECS_NOT_VERBOSE:
-                    logging.append(msg)
-                    start_time.x = time()
-            
-            return True
+                file_path = dir_path.joinpath(ofile_names[k])
+                manifest.start(ofile_names[k], run['endpoint'], k, url,
+                               station, period, run['sink'])
+                nrows = self.__save_data(file_path, data2, k, run, metadata)
+                manifest.complete(ofile_names[k], nrows)
+            if file_path.exists():
+                saved_files.append(file_path.relative_to(dir_path).as_posix())
+            self.__log_saved_file(file_path, status_code2, reason2,
+                                  description2, run)
+
+        return saved_files
+
+
+    @staticmethod
+    def __log_saved_file(file_path: pathlib.Path, status_code: int,
+                         reason: str, description: str, run: dict) -> None:
+        """
+        Shows the message of a saved file according to run['verbose']
+        """
+        file_name = pathlib.Path(file_path).name
+        msg = f'{file_name}: {status_code}, {reason} {description}'
+        if run['verbose']:
+            logging.append(msg)
         else:
-            return False
+            start_time = run['start_time']
+            xtime = time() - start_time.x
+            if xtime > AemetOpenData.__MIN_SECS_NOT_VERBOSE:
+                logging.append(msg)
+                start_time.x = time()
+
+
+    @staticmethod
+    def __metadata_columns(data: dict) -> dict:
+        """
+        Returns the columns of a metadata response as a dictionary having
+            the column id as the key and a list [descripcion, tipo_datos,
+            requerido] as the value (see MetadataCache.columns)
+        """
+        if not isinstance(data, dict):
+            return None
+        return {c1['id']: [c1.get('descripcion'), c1.get('tipo_datos'),
+                           c1.get('requerido')] \
+                for c1 in data.get('campos', []) if 'id' in c1}
+
+
+    @staticmethod
+    def __new_file_writer(file_path: pathlib.Path, run: dict,
+                          metadata: dict=None):
+        """
+        Returns the writer of the data file file_path in the file format of
+            the download. The columns and their types are given by metadata,
+            the metadata of the same request, or by the metadata cache
+        """
+        if not metadata and run['metadata_cache'] is not None:
+            metadata = run['metadata_cache'].columns(run['endpoint'])
+        date_columns = ('fecha',) if 'day' in run['endpoint'] else ()
+        return new_file_writer(run['file_format'], file_path, metadata,
+                               date_columns)
+
+
+    @staticmethod
+    def __write_records(writer, records: list) -> int:
+        """
+        Writes records with writer and closes it
+
+        Returns
+        -------
+        Number of rows written
+        """
+        try:
+            for record in records:
+                writer.write(record)
+        except BaseException:
+            writer.abort()
+            raise
+        return writer.close()
+
+
+    def __save_data(self, file_path: pathlib.Path, data: Union[dict, list],
+                    key: str, run: dict, metadata: dict=None) -> int:
+        """
+        Saves the response data of the key 'data' or 'metadata' in the sinks
+            of the download: the file file_path and/or the database
+            run['db']. The metadata files are always csv files
+
+        Returns
+        -------
+        Number of rows saved
+        """
+        nrows = 0
+        if run['sink'] != 'db':
+            if run['file_format'] == 'csv' or key == 'metadata':
+                nrows = self.__save_to_csv(file_path, data)
+            elif isinstance(data, list):
+                writer = AemetOpenData.__new_file_writer(file_path, run,
+                                                         metadata)
+                nrows = AemetOpenData.__write_records(writer, data)
+        if run['db'] is not None:
+            nrows = AemetOpenData.__insert_records(run['db'], data, key)
+        return nrows
+
+
+    @staticmethod
+    def __insert_records(db: AOD_2db, data: Union[dict, list],
+                         key: str) -> int:
+        """
+        Inserts the rows of data in db in batched transactions; in the
+            metadata the rows are those of data['campos']
+
+        Returns
+        -------
+        Number of rows inserted
+        """
+        if key == 'metadata':
+            data = data.get('campos', []) if isinstance(data, dict) else []
+        if not isinstance(data, list):
+            return 0
+        return AemetOpenData.__write_records(DbRecordWriter(db, key), data)
+
+
+    def __stream_data(self, url: str, file_path: pathlib.Path,
+                      run: dict, metadata: dict=None) -> ():
+        """
+        Downloads the data of url in streaming mode and saves it in the sinks
+            of the download: the file file_path and/or the database
+            run['db']. The initial columns of the file are those of
+            metadata, the metadata of the same request, or those of the
+            metadata cache
+
+        Returns
+        -------
+        (status_code, reason, description, nrows)
+        """
+        writers = []
+        if run['sink'] != 'db':
+            writers.append(AemetOpenData.__new_file_writer(file_path, run,
+                                                           metadata))
+        if run['db'] is not None:
+            writers.append(DbRecordWriter(run['db']))
+        if len(writers) == 1:
+            writer = writers[0]
+        else:
+            writer = TeeRecordWriter(writers)
+        try:
+            status_code, reason, description, data = \
+                self.__request_get_stream(url, writer)
+        except BaseException:
+            writer.abort()
+            raise
+        if isinstance(data, int):
+            return (status_code, reason, description, writer.close())
+        # The response was not an array
+        writer.abort()
+        if status_code != AemetOpenData.__RESPONSEOK:
+            return (status_code, reason, description, 0)
+        nrows = self.__save_data(file_path, data, 'data', run, metadata)
+        return (status_code, reason, description, nrows)
+
+
+    def __count_requests(self, first_stage: int=0, second_stage: int=0,
+                         saved: int=0, cached: int=0) -> None:
+        """
+        Updates the counters of requests made to the server. saved is the
+            number of first-stage requests that were not repeated because
+            a single first-stage response served data and metadata; cached
+            is the number of requests served by the response cache
+        """
+        with self.__counts_lock:
+            self.__request_counts['first_stage'] += first_stage
+            self.__request_counts['second_stage'] += second_stage
+            self.__request_counts['saved'] += saved
+            self.__request_counts['cached'] += cached
+
+
+    def __download_job\
+        (self, url: str, ofile_names: dict, dd_status: dict, run: dict,
+         station: str=None, period: [str]=(None, None)) -> [str]:
+        """
+        Downloads the files of a single request to the server (a station and
+            a time period, or a time period of all the stations)
+
+        Parameters
+        ----------
+        url : A valid url
+        ofile_names : Names for the output files. It's a dict with 2 keys:
+            'data' and 'metadata'
+        dd_status : Dictionary returned by __data_download_status
+        run : Settings of the download, see __new_download_run. If it has a
+            metadata cache, the metadata is only requested when it is not
+            fresh in the cache, and only by one job
+        station : Station of the request
+        period : First and last date or year of the request
+
+        Returns
+        -------
+        List with the names of the downloaded files
+        """
+        metadata_cache = run['metadata_cache']
+        endpoint = run['endpoint']
+        keys = [k for k, v in dd_status.items() if v]
+        claimed = False
+        if 'metadata' in keys and metadata_cache is not None:
+            claimed = metadata_cache.claim(endpoint)
+            if not claimed:
+                keys.remove('metadata')
+        try:
+            saved_files = self.__request_and_save_file\
+                (url, keys, ofile_names, run, station, period)
+        finally:
+            if claimed:
+                metadata_cache.release(endpoint)
+        return saved_files
+
+
+    def __new_download_run\
+        (self, dir_path: pathlib.Path, endpoint: str, verbose: bool,
+         use_files: bool, metadata_cache: bool, stream: bool=False,
+         sink: str='csv', file_format: str='csv') -> dict:
+        """
+        Settings shared by all the jobs of a download
+
+        Parameters
+        ----------
+        dir_path : Directory path where files will be saved
+        endpoint : Endpoint type of the requests: 'stations_day',
+            'station1_day', 'station1_month' (see AOD_2db file types) or
+            'stations_inventory'
+        verbose: If True, all possible messages are displayed on the screen;
+            if False, fewer messages are displayed.
+        use_files : If True the files registered as complete in the manifest
+            are not downloaded again
+        metadata_cache : If True the metadata is saved in a MetadataCache
+        stream : If True the data responses are parsed and saved as they are
+            received
+        sink : 'csv', 'db' or 'both'. If the rows are inserted in the
+            database, endpoint must be a file type of AOD_2db
+        file_format : Format of the data files, a key of FILE_SUFFIXES
+
+        Returns
+        -------
+        dict with keys dir_path, endpoint, verbose, start_time (a
+            ScalarContainer), use_files, metadata_cache (MetadataCache or
+            None), manifest (DownloadManifest), stream, sink, db (AOD_2db
+            or None) and file_format
+        """
+        mcache = AemetOpenData.__get_metadata_cache\
+            (dir_path, endpoint, metadata_cache, use_files)
+        db = None
+        if sink != 'csv':
+            db = AOD_2db(dir_path, endpoint, verbose)
+            if mcache is not None:
+                # The metadata may not be requested again in this download
+                campos = [{'id': k, 'descripcion': v[0], 'tipo_datos': v[1],
+                           'requerido': v[2]} \
+                          for k, v in mcache.columns(endpoint).items()]
+                AemetOpenData.__insert_records(db, {'campos': campos},
+                                               'metadata')
+        return {'dir_path': dir_path, 'endpoint': endpoint,
+                'verbose': verbose, 'start_time': ScalarContainer(time()),
+                'use_files': use_files, 'metadata_cache': mcache,
+                'manifest': DownloadManifest(dir_path), 'stream': stream,
+                'sink': sink, 'db': db, 'file_format': file_format}
+
+
+    def __run_download_jobs\
+        (self, jobs: [(str, dict, dict, str, [str])], run: dict,
+         max_workers: int=1) -> [str]:
+        """
+        Runs the download jobs sequentially or, if max_workers > 1, in a pool
+            of threads. Each job is a tuple (url, ofile_names, dd_status,
+            station, period). Most of the time of a download is spent
+            waiting for the server, so the threads make many requests at
+            once.
+
+        Parameters
+        ----------
+        jobs : List of tuples (url, ofile_names, dd_status, station, period)
+        run : Settings of the download, see __new_download_run
+        max_workers : Maximum number of simultaneous jobs. It is limited
+            to __MAX_WORKERS
+
+        Returns
+        -------
+        List with the names of the downloaded files, in the same order as
+            they would be downloaded sequentially
+        """
+        downloaded_files = []
+        for k in self.__request_counts:
+            self.__request_counts[k] = 0
+
+        jobs = [job1 for job1 in jobs if any(job1[2].values())]
+        n_workers = min(max_workers, AemetOpenData.__MAX_WORKERS, len(jobs))
+        if n_workers <= 1:
+            try:
+                for url, ofile_names, dd_status, station, period in jobs:
+                    downloaded_files += self.__download_job\
+                        (url, ofile_names, dd_status, run, station, period)
+            finally:
+                AemetOpenData.__close_run(run)
+            self.__log_request_counts()
+            return downloaded_files
+
+        # A connection per thread is kept alive in the pool
+        self.__mount_adapters(max(n_workers, 10))
+        executor = ThreadPoolExecutor(max_workers=n_workers)
+        try:
+            futures = [executor.submit(self.__download_job, url, ofile_names,
+                                       dd_status, run, station, period) \
+                       for url, ofile_names, dd_status, station, period \
+                           in jobs]
+            for future in futures:
+                downloaded_files += future.result()
+        except BaseException:
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+        finally:
+            executor.shutdown(wait=True)
+            AemetOpenData.__close_run(run)
+        self.__log_request_counts()
+        return downloaded_files
+
+
+    @staticmethod
+    def __close_run(run: dict) -> None:
+        """
+        Closes the manifest and the database of a download run
+        """
+        run['manifest'].close()
+        if run['db'] is not None:
+            run['db'].close()
+
+
+    def __log_request_counts(self) -> None:
+        counts = self.__request_counts
+        msg = f"Requests: {counts['first_stage']} first stage, " +\
+            f"{counts['second_stage']} second stage; " +\
+            f"{counts['saved']} first-stage requests saved; " +\
+            f"{counts['cached']} served from cache"
+        logging.append(msg)
 
 
     @staticmethod
@@ -645,9 +1325,51 @@ class AemetOpenData():
             return True
 
 
+    @staticmethod
+    def __check_sink_value(sink: str) -> bool:
+        """
+        Checks if sink has a valid value
+        """
+        if sink not in AemetOpenData.__SINKS:
+            msg = ', '.join(AemetOpenData.__SINKS)
+            logging.append(f'sink not in {msg}')
+            return False
+        return True
+
+
+    @staticmethod
+    def __check_file_format_value(file_format: str) -> bool:
+        """
+        Checks if file_format has a valid value and its writer can be used
+        """
+        if file_format not in FILE_SUFFIXES:
+            msg = ', '.join(FILE_SUFFIXES)
+            logging.append(f'file_format not in {msg}')
+            return False
+        if file_format == 'parquet' and not ParquetRecordWriter.available():
+            logging.append('pyarrow is required to save parquet files')
+            return False
+        return True
+
+
+    @staticmethod
+    def __set_file_format(file_names: dict, file_format: str) -> dict:
+        """
+        Changes the suffix of the data file name to that of file_format;
+            the metadata files are always csv files
+        """
+        if file_names['data'] is not None:
+            file_names['data'] = pathlib.Path(file_names['data'])\
+                .with_suffix(FILE_SUFFIXES[file_format]).name
+        return file_names
+
+
     def __request_meteo_data_all_stations\
         (self, dr: [(str, str)], dir_path: str, fetch: str='both',
-         use_files: bool=True, verbose: bool=False) -> [str]: 
+         use_files: bool=True, verbose: bool=False,
+         max_workers: int=1, metadata_cache: bool=False,
+         stream: bool=False, sink: str='csv',
+         file_format: str='csv') -> [str]: 
         """
         Makes one or many request to the server and downloads the data 
             in one or many files depending on the range of time series 
@@ -660,11 +1382,17 @@ class AemetOpenData():
         dr : date or year ranges to do valid requests
         fetch: str in ('data', 'metadata', 'both')
         dir_path. Directory where csv files will be saved
-        use_files : If True checks that the file name already exists in 
-            dir_path and does not make the request to the server; otherwise 
-            the request is made and the pre-existing file is overwritten.
+        use_files : If True checks that the file has been completely
+            downloaded, according to the manifest of dir_path, and does not
+            make the request to the server; otherwise the request is made
+            and the pre-existing file is overwritten.
         verbose: If True, all possible messages are displayed on the screen;
             if False, fewer messages are displayed.
+        max_workers : Maximum number of simultaneous requests
+        metadata_cache : If True the metadata is saved in a MetadataCache
+        stream : If True the data responses are saved as they are received
+        sink : 'csv', 'db' or 'both'
+        file_format : 'csv' or 'parquet'
         Raises
         ------
         ValueError
@@ -678,12 +1406,11 @@ class AemetOpenData():
             patterns in concatenate_files method
         """
 
-        if use_files:
-            saved_files = AemetOpenData.file_names_in_dir(dir_path, '*.csv')
-        else:
-            saved_files = []
-
-        dir_path = pathlib.Path(dir_path)            
+        dir_path = pathlib.Path(dir_path)
+        run = self.__new_download_run\
+            (dir_path, 'stations_day', verbose, use_files, metadata_cache,
+             stream, sink, file_format)
+        manifest = run['manifest'] if use_files else None
 
         url_template =  'https://opendata.aemet.es/opendata/api/valores/'+\
             'climatologicos/diarios/datos/fechaini/{}/fechafin/{}/'+\
@@ -691,33 +1418,44 @@ class AemetOpenData():
         
         file_name_template = 'stations_{}_{}_{}.csv'
         
-        start_time = ScalarContainer(time())
-        downloaded_files = [] 
+        jobs = []
         for dr1 in dr:
-            
+
             url = url_template.format(dr1[0], dr1[1])
 
             ofile_names = AemetOpenData.__set_output_file_names_with_template\
                 (fetch, file_name_template, dr1, True)
+            AemetOpenData.__set_file_format(ofile_names, file_format)
 
             dd_status = self.__data_download_status\
-                (ofile_names, saved_files, verbose)
-            for k, v in dd_status.items():
-                if v == False:
-                    continue
-    
-                if not self.__request_and_save_file\
-                    (url, k, ofile_names, dir_path, verbose, start_time):
-                    continue
-            
-                downloaded_files.append(ofile_names[k])
-                
+                (ofile_names, manifest, verbose, sink)
+            jobs.append((url, ofile_names, dd_status, None, dr1))
+
+        downloaded_files = self.__run_download_jobs(jobs, run, max_workers)
         return downloaded_files
+
+
+    @staticmethod
+    def __get_metadata_cache(dir_path: pathlib.Path, endpoint: str,
+                             metadata_cache: bool, use_files: bool) \
+        -> MetadataCache:
+        """
+        Returns the MetadataCache of dir_path or None if metadata_cache is
+            False. If use_files is False the metadata of endpoint will be
+            downloaded again
+        """
+        if not metadata_cache:
+            return None
+        mcache = MetadataCache(dir_path)
+        if not use_files:
+            mcache.expire(endpoint)
+        return mcache
         
 
     @staticmethod 
     def __meteo_data_all_stations_check_type_parameters\
-        (d1, d2, dir_path, fetch, verbose, use_files):
+        (d1, d2, dir_path, fetch, verbose, use_files, max_workers,
+         metadata_cache, stream, sink, file_format):
         """
         Check the parameter types of method meteo_data_all_stations
         
@@ -726,7 +1464,8 @@ class AemetOpenData():
         bool: True if parameters have the right types
         """
             
-        params = {'dir_path': dir_path, 'fetch': fetch}
+        params = {'dir_path': dir_path, 'fetch': fetch, 'sink': sink,
+                  'file_format': file_format}
         if not AemetOpenData.__check_params_type(params, str):
             return False
  
@@ -737,16 +1476,25 @@ class AemetOpenData():
             logging.append('Incorrect type for d1 and d2')
             return False
         
-        params = {'verbose': verbose, 'use_files': use_files}
+        params = {'verbose': verbose, 'use_files': use_files,
+                  'metadata_cache': metadata_cache, 'stream': stream}
         if not AemetOpenData.__check_params_type(params, bool):
             return False
 
+        if isinstance(max_workers, bool) or not isinstance(max_workers, int) \
+            or max_workers < 1:
+            logging.append('max_workers must be an int >= 1')
+            return False
+
         return True
 
 
     def meteo_data_all_stations\
         (self, d1: date, d2: date, dir_path: str, fetch: str='both',
-         verbose: bool=True, use_files: bool=True) -> [str]:
+         verbose: bool=True, use_files: bool=True,
+         max_workers: int=1, metadata_cache: bool=False,
+         stream: bool=False, sink: str='csv',
+         file_format: str='csv') -> [str]:
         """
         Retrieves daily meteorological data from all the station in Aemet
             OpenData server.
@@ -760,9 +1508,34 @@ class AemetOpenData():
         fetch: str in ('data', 'metadata', 'both')       
         verbose: If True, all possible messages are displayed on the screen;
             if False, fewer messages are displayed.
-        use_files : If True checks that the file name already exists in dir_path
-            and does not make the request to the server; otherwise the request
-            is made and the pre-existing file is overwritten.
+        use_files : If True checks that the file has been completely
+            downloaded, according to the manifest of dir_path
+            (DownloadManifest), and does not make the request to the server;
+            otherwise the request is made and the pre-existing file is
+            overwritten.
+        max_workers : If greater than 1, up to max_workers requests are made
+            to the server at the same time (concurrent mode). The default is
+            1, one request after another
+        metadata_cache : If True the metadata, which is the same for all
+            the requests, is downloaded once and saved in the directory
+            dir_path/metadata_cache (see MetadataCache) instead of a metadata
+            file per request; the returned list has the file of the cache
+            instead of the metadata files. The default is False, a metadata
+            file per request
+        stream : If True the data responses are read in chunks and their
+            rows are written to the csv files as they are parsed, so a
+            response is never held in memory; recommended for long periods.
+            The default is False
+        sink : Where the downloaded rows are saved: 'csv' (default), a csv
+            file per request in dir_path; 'db', the rows are inserted
+            directly in the database of AOD_2db in dir_path, in batched
+            transactions and without csv files; 'both', the database and the
+            csv files as an archive
+        file_format : Format of the data files: 'csv' (default) or
+            'parquet'. The parquet files (pyarrow is required) have typed
+            columns: floats with a period as decimal separator, dates and
+            indicativo, nombre and provincia dictionary encoded; they are
+            not inserted in the database by AOD_2db
         Returns
         -------
         [] with the the names of saved csv files. Each file has a subset of
@@ -770,12 +1543,17 @@ class AemetOpenData():
         """
 
         if not AemetOpenData.__meteo_data_all_stations_check_type_parameters\
-            (d1, d2, dir_path, fetch, verbose, use_files):
+            (d1, d2, dir_path, fetch, verbose, use_files, max_workers,
+             metadata_cache, stream, sink, file_format):
             return []
 
         if not AemetOpenData.__check_fecth_value(fetch):
             return []
 
+        if not AemetOpenData.__check_sink_value(sink) or \
+            not AemetOpenData.__check_file_format_value(file_format):
+            return []
+
         d1, d2 = AemetOpenData.__shrink_ts_limits(d1, d2)
             
         dir_path = pathlib.Path(dir_path)
@@ -787,7 +1565,8 @@ class AemetOpenData():
         dr = AemetOpenData.daily_ranges_get(d1, d2, selected_stations=False)
         
         downloaded_files = self.__request_meteo_data_all_stations\
-            (dr, dir_path, fetch, use_files, verbose)
+            (dr, dir_path, fetch, use_files, verbose, max_workers,
+             metadata_cache, stream, sink, file_format)
 
         return downloaded_files
 
@@ -856,9 +1635,11 @@ class AemetOpenData():
         ----------
         fetch: str in ('data', 'metadata', 'both')
         dir_path. Directory path where csv files will be saved
-        use_files : If True checks that the file name already exists in 
-            dir_path and does not make the request to the server; otherwise 
-            the request is made and the pre-existing file is overwritten.
+        use_files : If True checks that the file has been completely
+            downloaded, according to the manifest of dir_path
+            (DownloadManifest), and does not make the request to the server;
+            otherwise the request is made and the pre-existing file is
+            overwritten.
         verbose: If True, all possible messages are displayed on the screen;
             if False, fewer messages are displayed.
 
@@ -879,27 +1660,19 @@ class AemetOpenData():
         if not AemetOpenData.__check_fecth_value(fetch):
             return
 
-        if use_files:
-            saved_files = AemetOpenData.file_names_in_dir(dir_path, '*.csv')
-        else:
-            saved_files = []
-        
+        run = self.__new_download_run\
+            (dir_path, 'stations_inventory', verbose, use_files, False)
+        manifest = run['manifest'] if use_files else None
+
         file_name_template = 'estaciones_open_data_{}.csv'
-        
-        start_time = ScalarContainer(time())
 
         ofile_names = AemetOpenData.__set_output_file_names_with_template\
             (fetch, file_name_template, [], True)
 
         dd_status = self.__data_download_status\
-            (ofile_names, saved_files, verbose)
-        for k, v in dd_status.items():
-            if v == False:
-                continue
-
-            if not self.__request_and_save_file\
-                (url, k, ofile_names, dir_path, verbose, start_time):
-                continue
+            (ofile_names, manifest, verbose)
+        self.__run_download_jobs\
+            ([(url, ofile_names, dd_status, None, (None, None))], run)
 
 
     @staticmethod
@@ -968,8 +1741,8 @@ class AemetOpenData():
 
     @staticmethod 
     def __meteo_data_by_station_check_type_parameters\
-        (time_step, d1, d2, stations, dir_path, fetch, verbose, use_files) \
-            -> bool:
+        (time_step, d1, d2, stations, dir_path, fetch, verbose, use_files,
+         max_workers, metadata_cache, stream, sink, file_format) -> bool:
         """
         Check the parameter types of method meteo_data_by_station
         
@@ -978,7 +1751,8 @@ class AemetOpenData():
         True if all parameters have the expected types, False otherwise
         """
         params = {'time_step': time_step, 'stations': stations, 
-                  'dir_path': dir_path, 'fetch': fetch}
+                  'dir_path': dir_path, 'fetch': fetch, 'sink': sink,
+                  'file_format': file_format}
         if not AemetOpenData.__check_params_type(params, str):
             return False
  
@@ -990,10 +1764,16 @@ class AemetOpenData():
             logging.append('Incorrect type for d1 and d2')
             return False
         
-        params = {'verbose': verbose, 'use_files': use_files}
+        params = {'verbose': verbose, 'use_files': use_files,
+                  'metadata_cache': metadata_cache, 'stream': stream}
         if not AemetOpenData.__check_params_type(params, bool):
             return False
 
+        if isinstance(max_workers, bool) or not isinstance(max_workers, int) \
+            or max_workers < 1:
+            logging.append('max_workers must be an int >= 1')
+            return False
+
         return True
 
 
@@ -1001,7 +1781,10 @@ class AemetOpenData():
         (self, time_step: str, d1: date, d2: date, 
          stations: Union[__TupStr, __LisStr, str],
          dir_path: str, fetch: str='both',
-         verbose: bool=True, use_files: bool=True) -> [str]:
+         verbose: bool=True, use_files: bool=True,
+         max_workers: int=1, metadata_cache: bool=False,
+         stream: bool=False, sink: str='csv',
+         file_format: str='csv') -> [str]:
         """
         Retrieves daily or monthly meteorological data from Aemet OpenData
             server station by station.
@@ -1012,14 +1795,41 @@ class AemetOpenData():
             'day' or 'month'
         d1 : Initial date (daily data) or year (monthly data)
         d2 : Final date or year. Equal d1
-        stations : List of stations or only one station as str
+        stations : List of stations or only one station as str; for
+            example, the stations near a point found in the inventory of
+            stations (see aod_stations.StationCatalog)
         dir_path : Directory path where files will be saved
         fetch: str in ('data', 'metadata', 'both')
         verbose: If True, all possible messages are displayed on the screen;
             if False, fewer messages are displayed.
-        use_files : If True checks that the file name already exists in dir_out
-            and does not make the request to the server; otherwise the request
-            is made and the pre-existing file is overwritten.
+        use_files : If True checks that the file has been completely
+            downloaded, according to the manifest of dir_path
+            (DownloadManifest), and does not make the request to the server;
+            otherwise the request is made and the pre-existing file is
+            overwritten.
+        max_workers : If greater than 1, up to max_workers station/period
+            requests are made to the server at the same time (concurrent
+            mode). The default is 1, one request after another
+        metadata_cache : If True the metadata, which is the same for all
+            the stations and periods, is downloaded once and saved in the
+            directory dir_path/metadata_cache (see MetadataCache) instead of
+            a metadata file per station and period; the returned list has
+            the file of the cache instead of the metadata files. The default
+            is False, a metadata file per station and period
+        stream : If True the data responses are read in chunks and their
+            rows are written to the csv files as they are parsed, so a
+            response is never held in memory; recommended for long periods.
+            The default is False
+        sink : Where the downloaded rows are saved: 'csv' (default), a csv
+            file per request in dir_path; 'db', the rows are inserted
+            directly in the database of AOD_2db in dir_path, in batched
+            transactions and without csv files; 'both', the database and the
+            csv files as an archive
+        file_format : Format of the data files: 'csv' (default) or
+            'parquet'. The parquet files (pyarrow is required) have typed
+            columns: floats with a period as decimal separator, dates and
+            indicativo, nombre and provincia dictionary encoded; they are
+            not inserted in the database by AOD_2db
         Returns
         -------
         [] with the the names of saved csv files. Each file has a subset of
@@ -1027,7 +1837,12 @@ class AemetOpenData():
         """
 
         if not AemetOpenData.__meteo_data_by_station_check_type_parameters\
-            (time_step, d1, d2, stations, dir_path, fetch, verbose, use_files):
+            (time_step, d1, d2, stations, dir_path, fetch, verbose, use_files,
+             max_workers, metadata_cache, stream, sink, file_format):
+            return []
+
+        if not AemetOpenData.__check_sink_value(sink) or \
+            not AemetOpenData.__check_file_format_value(file_format):
             return []
 
         AemetOpenData.__check_time_step_value(time_step)
@@ -1067,36 +1882,29 @@ class AemetOpenData():
                 'climatologicos/mensualesanuales/datos/anioini/'+\
                     '{}/aniofin/{}/estacion/{}'
 
-        if use_files:
-            saved_files = AemetOpenData.file_names_in_dir(dir_path, '*.csv')
-        else:
-            saved_files = []
-        
+        run = self.__new_download_run\
+            (dir_path, f'station1_{time_step}', verbose, use_files,
+             metadata_cache, stream, sink, file_format)
+        manifest = run['manifest'] if use_files else None
+
         file_name_template = '{}_{}_{}_{}.csv'
 
-        downloaded_files = []
-        start_time = ScalarContainer(time())
+        jobs = []
         for station1 in stations:
-        
+
             for tp1 in time_periods:
-                
+
                 url = url_template.format(tp1[0], tp1[1], station1)
-    
+
                 params = [station1] + tp1
                 ofile_names = \
                     AemetOpenData.__set_output_file_names_with_template\
                     (fetch, file_name_template, params, True)
-    
+                AemetOpenData.__set_file_format(ofile_names, file_format)
+
                 dd_status = self.__data_download_status\
-                    (ofile_names, saved_files, verbose)
-                for k, v in dd_status.items():
-                    if v == False:
-                        continue
-        
-                    if not self.__request_and_save_file\
-                        (url, k, ofile_names, dir_path, verbose, start_time):
-                        continue
-                
-                    downloaded_files.append(ofile_names[k])
-        
+                    (ofile_names, manifest, verbose, sink)
+                jobs.append((url, ofile_names, dd_status, station1, tp1))
+
+        downloaded_files = self.__run_download_jobs(jobs, run, max_workers)
         return downloaded_files
@@ -23,6 +23,10 @@ verbose = True  # messages in screen
 # Common parameters of all methods that download meteorological data
 d1 = date(2023, 1, 1)  # start date
 d2 = date(2023, 6, 1)  # end date
+max_workers = 1  # > 1, simultaneous requests to the server (concurrent mode)
+# True, the metadata is downloaded once and saved in dir_path/metadata_cache
+#  instead of a metadata file per request
+metadata_cache = False
 
 
 # To download daily data from all meteorological stations we use the method
@@ -48,6 +52,10 @@ stations = ['7178I', '7031', '7031X']  # list with station identifiers
 #    'station1_month'. Monthly meteorological data from selected stations
 
 ftype = 'stations_day'
+incremental = True  # inserts only the csv files that are new or have changed
+parse_workers = 1  # processes that read the csv files; 1, no processes
+partition = None  # None, 'year' or 'decade': a database file per period
+overwrite_csv = True  # the csv exported from the database is overwritten
 
 
 
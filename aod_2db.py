@@ -6,15 +6,32 @@ Created on Wed Aug 16 11:19:26 2023
 
 version 0.6
 """
+from array import array
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 import csv
+from datetime import date, datetime
+import gzip
+import hashlib
+from itertools import groupby, islice
 import pathlib
 import os
 import re
 import sqlite3
+from threading import RLock
 import traceback
 from typing import Union
+import uuid
 
 import littleLogging as logging
+from aod_manifest import DownloadManifest
+from aod_metadata_cache import MetadataCache
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 class AOD_2db():
@@ -26,9 +43,12 @@ class AOD_2db():
     The name of the database is determined by the type of data to be inserted
         and for each type the name is always the same.
     Table structure:
-        1) Table does not have a primary key.
+        1) Table does not have a primary key; it has a unique index on the
+        natural key: (indicativo, fecha) in data tables, id in metadata
+        tables.
         2) Columns names. They are the headers of the downloaded csv files
-        3) Columns types. Are always TEXT (str). 
+        3) Columns types. In data tables, REAL or INTEGER as the tipo_datos
+        of the column in the metadata (see __AFFINITIES); otherwise TEXT.
     Table contents:
         1) Format
         * In monthly data requests, Aemet treats all the data as strings, and
@@ -36,12 +56,21 @@ class AOD_2db():
         separator.
         * In daily data requests, Aemet distinguishes between data of type 
         string and other data of type float. In this case, Aemet uses the comma
-        as the decimal separator: in the database, this decimal separator is
-        changed to a period.
+        as the decimal separator: in the database, the numbers are saved
+        with a period. The empty values are null, 'Ip' is 0 (see
+        CODE_VALUES) and the other codes, such as 'Acum', are kept as text.
         2) If multiple download sessions of the same data type are performed
         with overlapping date ranges and ther are saved in the same directory,
-        the csv data files contain repeated data. The app inserts only unique
-        rows.
+        the csv data files contain repeated data. The app inserts only one
+        row per key: to_db inserts all the rows and then deletes the
+        repeated keys, keeping the first row read; the incremental mode of
+        to_db and insert_records replace the row with the new one (insert
+        or replace).
+    The tables ingested_files, file_columns and inserted_records register the
+        inserted files, their headers and the rows inserted without files
+        (see to_db). The aggregates, the coverage index and the data version
+        are explained in aggregate, coverage_index and data_version; the
+        partitioned layout in the parameter partition of the constructor.
     """
 
     # warning, if you change these constants you must review the code
@@ -65,117 +94,1954 @@ class AOD_2db():
          'station1_day': 'metd_metadata',
          'station1_month': 'metm_metadata',
          }        
+    # Columns that identify a row. A row of a file replaces the rows of the
+    #  table with the same key
+    __NATURAL_KEY = {'data': ('indicativo', 'fecha'), 'metadata': ('id',)}
+    # Column type in the database by tipo_datos in the metadata; the columns
+    #  of other types are text
+    __AFFINITIES = {'float': 'real', 'int': 'integer', 'integer': 'integer'}
+    # Number saved for the codes of the REAL columns: 'Ip', inappreciable
+    #  precipitation, is 0
+    CODE_VALUES = {'Ip': 0.}
+    __INGESTED_TABLE = 'ingested_files'
+    # Insertions of data rows with insert_records, which are not in files
+    __RECORDS_TABLE = 'inserted_records'
+    __SCHEMA_TABLE = 'file_columns'
+    __HASH_BLOCK_SIZE = 1024 * 1024
+    # The csv files are inserted in batches of __BATCH_SIZE rows and the
+    #  transaction is committed every __BATCHES_PER_COMMIT batches
+    __BATCH_SIZE = 10000
+    __BATCHES_PER_COMMIT = 10
+    # Pragmas of the connection while to_db inserts the files. synchronous
+    #  is off when the tables are created again (if the process stops, to_db
+    #  must be run again) and normal in the incremental mode
+    __BULK_PROFILE = {'journal_mode': 'wal', 'cache_size': -256 * 1024,
+                      'temp_store': 'memory'}
+    __BULK_SYNCHRONOUS = {False: 'off', True: 'normal'}
+    # Suffix of the indexes of a variable created by series in previous
+    #  versions; to_db drops them
+    __SERIES_INDEX = '_series'
+    # Year * 100 + month of a monthly date 'YYYY-M'
+    __MONTH_NUMBER = "cast(substr(fecha, 1, 4) as integer) * 100 + " +\
+        "cast(substr(fecha, 6) as integer)"
+    # Suffix of the files exported by to_csv by compression
+    __CSV_SUFFIXES = {None: '.csv', 'gzip': '.csv.gz', 'zstd': '.csv.zst'}
+    # Partitioned layout: prefix of the partition names by partition and
+    #  maximum number of partitions attached to the connection
+    __PARTITIONS = {'year': 'y', 'decade': 'd'}
+    __MAX_ATTACHED = 8
+    # Aggregates of the daily data (see aggregate): table name by period,
+    #  aggregate function of the variables by column suffix and columns
+    #  that are not aggregated
+    __AGGREGATE_TABLES = {'month': '{}_monthly', 'year': '{}_annual'}
+    __AGGREGATE_FUNCTIONS = {'n': 'count', 'sum': 'sum', 'avg': 'avg',
+                             'min': 'min', 'max': 'max'}
+    __NOT_AGGREGATED = ('altitud',)
+    # Tables of the station-months inserted since the aggregates and the
+    #  coverage index were refreshed
+    __PENDING_MONTHS_TABLES = {'aggregates': 'aggregates_pending',
+                               'coverage': 'coverage_pending'}
+    # Coverage index (see coverage_index): table name and julian day of
+    #  1970-01-01, the day 0 of the intervals
+    __COVERAGE_TABLE = '{}_coverage'
+    __JULIAN_DAY_1970 = 2440587.5
+    # Table with the version of the data (see data_version)
+    __VERSION_TABLE = 'data_version'
     __MAX_ERRORS_2STOP_INSERTING = 3
 
-    
-    def __init__(self, d_path: str, file_type: str, verbose: bool=True):
+    
+    def __init__(self, d_path: str, file_type: str, verbose: bool=True,
+                 batch_size: int=__BATCH_SIZE,
+                 batches_per_commit: int=__BATCHES_PER_COMMIT,
+                 max_workers: int=1, partition: str=None):
+        """
+        Parameters
+        ----------
+        d_path (str). Directory path where files has been saved and database 
+            will be created
+        file_type (str). Type of files to insert in the database, codified as
+            the keys of the dictionary __FILE_PATTERNS
+        batch_size (int). Number of rows of the csv files read and inserted
+            at once; the memory used to insert a file does not depend on its
+            size
+        batches_per_commit (int). Number of batches inserted in a
+            transaction
+        max_workers (int). Number of processes that convert the rows of the
+            csv files in to_db, in batches of batch_size rows. If 1, the
+            rows are converted in this process
+        partition (str). None (default), the data is saved in the database;
+            'year' or 'decade', the data rows are saved in a database per
+            year or per decade, named as the database with the suffix _yYYYY
+            or _dYYYY; the data table of the database gives their columns.
+            The partitions are attached as they are used. If it is None and
+            the database has partitions, their layout is used; to change the
+            layout, remove the database and its partitions
+
+        Returns
+        -------
+        self
+        """
+        
+        dir_path = AOD_2db.exists_dir_path(d_path)
+        dir_path = AOD_2db.__get_absolute_path(dir_path)
+        
+        par = {'file_type': file_type}
+        AOD_2db.__valid_value(par, AOD_2db.__FILE_PATTERNS.keys())
+        if partition is not None:
+            par = {'partition': partition}
+            AOD_2db.__valid_value(par, AOD_2db.__PARTITIONS.keys())
+        
+        self.dir_path: pathlib.Path = dir_path
+        self.file_type: str = file_type
+        self.verbose: bool = verbose
+        self.batch_size: int = max(1, batch_size)
+        self.batches_per_commit: int = max(1, batches_per_commit)
+        self.max_workers: int = max(1, max_workers)
+        self.partition: str = partition
+        if partition is None:
+            self.partition = self.__existing_partition()
+        self.__lock = RLock()
+        self.__conn: sqlite3.Connection = None
+        # attached partitions: name -> columns of its data table
+        self.__attached = OrderedDict()
+        # partitions where rows have been inserted, see __insert_unique
+        self.__touched_partitions = set()
+        self.__uncommitted_batches = 0
+        # column types of the data table, see __get_column_types
+        self.__column_types: dict = None
+        
+    #     self.__dbpath: pathlib.Path = None
+
+
+    # @property
+    # def dbpath(self):
+    #     return self.__dbpath
+
+
+    # @dbpath.setter
+    # def dbpath(self, dbpath: str):
+    #     dbpath = AOD_2db.__get_absolute_path(dbpath)
+    #     if not dbpath.exists() or not dbpath.is_file():
+    #         msg = f"No {dbpath} exists"
+    #         logging.append(msg)
+    #         raise ValueError(msg)
+    #     self.__dbpath = dbpath
+
+
+    def get_default_dbpath(self) -> pathlib.Path:
+        dbname = self.__DBNAME[self.file_type]
+        dbpath = self.dir_path.joinpath(dbname)
+        return dbpath 
+
+
+    def __connection(self) -> sqlite3.Connection:
+        """
+        Returns the connection to the database; it is opened in the first
+            call. It can be used from several threads; the writes are made
+            holding self.__lock
+        """
+        if self.__conn is None:
+            self.__conn = sqlite3.connect(self.get_default_dbpath(),
+                                          check_same_thread=False)
+        return self.__conn
+
+
+    def close(self) -> None:
+        """
+        Closes the connection to the database
+        """
+        if self.__conn is not None:
+            self.__conn.close()
+            self.__conn = None
+        self.__attached.clear()
+
+
+    @contextmanager
+    def __bulk_load(self, incremental: bool):
+        """
+        Sets the pragmas in __BULK_PROFILE in the connection and restores the
+            previous values at the end
+        """
+        conn = self.__connection()
+        conn.commit()
+        profile = dict(AOD_2db.__BULK_PROFILE,
+                       synchronous=AOD_2db.__BULK_SYNCHRONOUS[incremental])
+        previous = {k: conn.execute(f"PRAGMA {k}").fetchone()[0] \
+                    for k in profile}
+        AOD_2db.__set_pragmas(conn, profile)
+        try:
+            yield conn
+        finally:
+            conn.commit()
+            AOD_2db.__set_pragmas(conn, previous)
+
+
+    @staticmethod
+    def __set_pragmas(conn: sqlite3.Connection, pragmas: dict) -> None:
+        for k, v in pragmas.items():
+            try:
+                conn.execute(f"PRAGMA {k} = {v}")
+            except sqlite3.Error as err:
+                logging.append(f'PRAGMA {k} = {v} not set: {err}', False)
+
+
+    def __partition_name(self, fecha: str) -> str:
+        """
+        Name of the partition of the date fecha ('YYYY-MM-DD' or 'YYYY-M');
+            None if fecha is not valid
+        """
+        try:
+            year = int(fecha[:4])
+        except (TypeError, ValueError):
+            return None
+        if self.partition == 'decade':
+            year -= year % 10
+        return f'{AOD_2db.__PARTITIONS[self.partition]}{year:04d}'
+
+
+    def __existing_partition(self) -> str:
+        """
+        Partition of the existing partitions of the database or None if it
+            has no partitions
+        """
+        for partition in AOD_2db.__PARTITIONS:
+            self.partition = partition
+            if self.__partition_names():
+                return partition
+        return None
+
+
+    def __partition_path(self, name: str) -> pathlib.Path:
+        dbpath = self.get_default_dbpath()
+        return dbpath.with_name(f'{dbpath.stem}_{name}{dbpath.suffix}')
+
+
+    def __partition_names(self, d1: date=None, d2: date=None) -> [str]:
+        """
+        Names of the existing partitions with dates between d1 and d2,
+            ordered by date
+        """
+        prefix = AOD_2db.__PARTITIONS[self.partition]
+        dbpath = self.get_default_dbpath()
+        pattern = re.compile(rf'^{re.escape(dbpath.stem)}_({prefix}\d{{4}})'
+                             rf'{re.escape(dbpath.suffix)}$')
+        years = 10 if self.partition == 'decade' else 1
+        names = []
+        for fp1 in self.dir_path.glob(f'{dbpath.stem}_{prefix}*'):
+            match = pattern.match(fp1.name)
+            if not match:
+                continue
+            first_year = int(match.group(1)[1:])
+            if d1 is not None and first_year + years - 1 < d1.year:
+                continue
+            if d2 is not None and first_year > d2.year:
+                continue
+            names.append(match.group(1))
+        return sorted(names)
+
+
+    def __partition_schema(self, conn: sqlite3.Connection, name: str,
+                           headers: [str]=None,
+                           key_index: bool=True) -> str:
+        """
+        Attaches the partition name to conn, if it is not attached, and
+            returns its schema name. If there are __MAX_ATTACHED partitions
+            attached, the partition used least recently is detached; the
+            transaction is committed before a partition is attached or
+            detached. The data table of the partition is created, or its
+            columns are added, with the columns of the data table of the
+            database if headers are not columns of the partition. If
+            key_index is True the unique index of the natural key is created
+
+        Parameters
+        ----------
+        conn : connection
+        name : partition name; if None the schema is main
+        headers : optional. Columns that will be used; if None the columns
+            are always checked
+        key_index : optional. See above
+        """
+        if name is None:
+            return 'main'
+        schema = f'p_{name}'
+        table_name = AOD_2db.__DBTABLE[self.file_type]
+        with self.__lock:
+            columns = self.__attached.get(name)
+            if columns is None:
+                conn.commit()
+                self.__uncommitted_batches = 0
+                if len(self.__attached) >= AOD_2db.__MAX_ATTACHED:
+                    old_name, _ = self.__attached.popitem(last=False)
+                    conn.execute(f"detach database p_{old_name}")
+                conn.execute(f"attach database ? as {schema}",
+                             (str(self.__partition_path(name)),))
+                columns = set()
+                self.__attached[name] = columns
+            else:
+                self.__attached.move_to_end(name)
+            if headers is None or not columns.issuperset(headers):
+                cur = conn.cursor()
+                column_types = \
+                    {row[1]: row[2].lower() for row in \
+                     cur.execute(f"PRAGMA main.table_info({table_name})")}
+                AOD_2db.__add_columns(cur, table_name, list(column_types),
+                                      column_types, schema)
+                if key_index:
+                    AOD_2db.__create_key_index(cur, table_name, 'data',
+                                               schema)
+                columns.update(column_types)
+        return schema
+
+
+    def __schemas(self, conn: sqlite3.Connection, d1: date=None,
+                  d2: date=None):
+        """
+        Yields the schemas with the data rows between d1 and d2: main and,
+            in a partitioned layout, the partitions of the dates (they are
+            attached as they are yielded)
+        """
+        yield 'main'
+        if self.partition is None:
+            return
+        for name in self.__partition_names(d1, d2):
+            yield self.__partition_schema(conn, name)
+
+
+    def __remove_partitions(self, conn: sqlite3.Connection) -> None:
+        """
+        Detaches and deletes all the partitions
+        """
+        with self.__lock:
+            conn.commit()
+            for name in self.__attached:
+                conn.execute(f"detach database p_{name}")
+            self.__attached.clear()
+            for name in self.__partition_names():
+                self.__partition_path(name).unlink()
+
+
+    def is_daily_file_type(self):
+        if 'day' in self.file_type:
+            return True
+        elif 'month' in self.file_type:
+            return False
+        else:
+            msg = f'File_type ({self.file_type})does not follow the '+\
+                'required name pattern' 
+            raise ValueError(msg)
+
+            
+    def to_db(self, incremental: bool=False, force: bool=False) :
+        """
+        Inserts the data in a database of type sqlite3
+
+        Parameters
+        ----------
+        incremental : optional. If False (default) the tables are created
+            again with all the files of the directory. If True only the
+            files that are not in the table ingested_files, or that have
+            changed since they were inserted, are inserted: the rows of a
+            file replace the rows with the same key (__NATURAL_KEY) and the
+            new columns are added to the tables. The rows that have been
+            removed from a changed file are not deleted from the tables
+        force : optional. If incremental is False and the database has data
+            rows that are not in files (rows inserted with insert_records or
+            downloads with sink 'db', see the manifest of the directory),
+            the tables are not created again, because those rows would be
+            lost, unless force is True; then the downloads saved only in the
+            database are removed from the manifest, so they can be
+            downloaded again
+
+        Returns
+        -------
+        True if the task ends OK
+        """
+        if not incremental and not force and self.__has_db_only_rows():
+            return False
+        with self.__lock, self.__bulk_load(incremental):
+            if incremental:
+                ok = self.__to_db_incremental()
+            else:
+                ok = self.__to_db_full()
+            if ok and self.__has_aggregates():
+                ok = self.aggregate()
+            if ok and self.__has_coverage_index():
+                ok = self.coverage_index()
+            return ok
+
+
+    def __to_db_full(self) -> bool:
+        """
+        Inserts all the files in the tables, whose previous rows are
+            deleted. The indexes of the data table are built after the rows
+            have been inserted
+        """
+        # the metadata is inserted first because it gives the column types
+        files_of_type = {'metadata': True, 'data': True}
+        insert_data = {'metadata': True, 'data': True}
+        
+        for key in files_of_type:
+        
+            f_paths = self.__get_file_paths(key)
+            if not f_paths:
+                msg = f'No {key} files in '+\
+                    f'{self.dir_path} of type {self.file_type}'
+                logging.append(msg)
+                files_of_type[key] = False
+                continue
+    
+            headers = self.__get_headers(f_paths, key)
+            table_name = AOD_2db.__table_name(self.file_type, key)
+            
+            if not self.__create_table(headers, key):
+                insert_data[key] = False
+                continue
+        
+            if not self.__insert_unique(f_paths, key):
+                return False
+            self.__register_files(f_paths, key, clear=True)
+            if key == 'metadata':
+                self.__column_types = None
+        
+        return True
+
+
+    def __to_db_incremental(self) -> bool:
+        """
+        Inserts the new and changed files; the metadata is inserted first
+            because it gives the column types
+        """
+        for key in ('metadata', 'data'):
+            f_paths = self.__get_file_paths(key)
+            if not f_paths:
+                msg = f'No {key} files in '+\
+                    f'{self.dir_path} of type {self.file_type}'
+                logging.append(msg)
+                continue
+
+            pending = self.__pending_files(f_paths, key)
+            if not pending:
+                logging.append(f'No new {key} files to insert')
+                continue
+            if not self.__ingest_files(pending, key):
+                return False
+            table_name = AOD_2db.__table_name(self.file_type, key)
+            logging.append(f'\n{len(pending)} {key} files have been '
+                           f'inserted into {table_name}')
+        return True
+
+
+    def __has_db_only_rows(self) -> bool:
+        """
+        True if the database has data rows that are not in files: rows
+            inserted with insert_records or downloads saved only in the
+            database according to the manifest. The reason is logged
+        """
+        n_rows = 0
+        if self.get_default_dbpath().exists():
+            with self.__lock:
+                try:
+                    cur = self.__connection().cursor()
+                    if AOD_2db.__table_exists(cur, AOD_2db.__RECORDS_TABLE):
+                        n_rows = cur.execute\
+                            ("select coalesce(sum(nrows), 0) from "
+                             f"{AOD_2db.__RECORDS_TABLE}").fetchone()[0]
+                except sqlite3.Error as err:
+                    logging.append(f'Sqlite error {err}')
+        file_names = []
+        if DownloadManifest.exists(self.dir_path):
+            manifest = DownloadManifest(self.dir_path)
+            file_names = manifest.db_only_file_names(self.file_type)
+            manifest.close()
+        if not n_rows and not file_names:
+            return False
+        logging.append(f'The database has {n_rows} rows inserted with '
+                       f'insert_records and {len(file_names)} downloads saved '
+                       "only in it (sink 'db') that are not in csv files; "
+                       'to_db(incremental=False) would delete them. Use '
+                       'to_db(incremental=True) or, to delete them, '
+                       'to_db(force=True)')
+        return True
+
+
+    @staticmethod
+    def __table_name(file_type: str, key: str) -> str:
+        if key == 'data':
+            return AOD_2db.__DBTABLE[file_type]
+        return AOD_2db.__DBTABLE_METADATA[file_type]
+
+
+    def __create_ingested_table(self, cur: sqlite3.Cursor) -> None:
+        cur.execute(f"create table if not exists "
+                    f"{AOD_2db.__INGESTED_TABLE} ("
+                    "file_name text primary key, key text, size integer, "
+                    "mtime real, sha256 text, nrows integer, "
+                    "ingested_at text)")
+
+
+    def __file_name(self, f_path: pathlib.Path) -> str:
+        """
+        Name of f_path in the table ingested_files, relative to dir_path
+        """
+        try:
+            return f_path.relative_to(self.dir_path).as_posix()
+        except ValueError:
+            return f_path.as_posix()
+
+
+    @staticmethod
+    def __checksum(f_path: pathlib.Path) -> str:
+        h = hashlib.sha256()
+        with open(f_path, 'rb') as f:
+            for block in iter(lambda: f.read(AOD_2db.__HASH_BLOCK_SIZE), b''):
+                h.update(block)
+        return h.hexdigest()
+
+
+    def __pending_files(self, f_paths: [pathlib.Path], key: str) \
+        -> [(pathlib.Path, str)]:
+        """
+        Returns the files of f_paths that have not been inserted or have
+            changed, with their checksums. A file whose size and
+            modification time are those in ingested_files has not changed;
+            otherwise its checksum is compared with the registered one. If
+            the registered checksum is null (see __register_files) the file
+            is considered changed
+        """
+        with self.__lock:
+            conn = self.__connection()
+            cur = conn.cursor()
+            self.__create_ingested_table(cur)
+            ingested = {row[0]: row[1:] for row in \
+                        cur.execute("select file_name, size, mtime, sha256 "
+                                    f"from {AOD_2db.__INGESTED_TABLE} "
+                                    "where key = ?", (key,))}
+            pending = []
+            touched = []
+            for fp1 in f_paths:
+                name = self.__file_name(fp1)
+                stat = fp1.stat()
+                previous = ingested.get(name)
+                if previous is not None and previous[0] == stat.st_size \
+                    and previous[1] == stat.st_mtime:
+                    continue
+                checksum = AOD_2db.__checksum(fp1)
+                if previous is not None and previous[2] is not None \
+                    and previous[2] == checksum:
+                    touched.append((stat.st_size, stat.st_mtime, name))
+                    continue
+                pending.append((fp1, checksum))
+            if touched:
+                cur.executemany(f"update {AOD_2db.__INGESTED_TABLE} set "
+                                "size = ?, mtime = ? where file_name = ?",
+                                touched)
+            conn.commit()
+        return pending
+
+
+    def __ingest_files(self, files: [(pathlib.Path, str)],
+                       key: str) -> bool:
+        """
+        Inserts the rows of the csv files, given as tuples (path, checksum),
+            in batches (see __insert_rows) and registers each file in
+            ingested_files. A row replaces the row of the table with the
+            same natural key, so a changed file replaces its previous rows
+            and the rows repeated in several files are inserted once; if the
+            process stops, the files that have not been registered will be
+            inserted again
+        """
+        table_name = AOD_2db.__table_name(self.file_type, key)
+        with self.__lock:
+            conn = self.__connection()
+            self.__uncommitted_batches = 0
+            file_name = ''
+            try:
+                cur = conn.cursor()
+                self.__create_ingested_table(cur)
+                column_types = self.__table_column_types(cur, key)
+                AOD_2db.__retype_table(cur, table_name, column_types)
+                checksums = dict(files)
+                parsed_files = \
+                    self.__parsed_files([fp1 for fp1, _ in files], key,
+                                        column_types)
+                for i, (fp1, headers, rows) in enumerate(parsed_files):
+                    file_name = fp1.name
+                    if self.verbose:
+                        print(i, file_name)
+                    nrows = 0
+                    if headers:
+                        AOD_2db.__add_columns(cur, table_name, headers,
+                                              column_types)
+                        AOD_2db.__create_key_index(cur, table_name, key)
+                        nrows = self.__insert_rows(conn, 'insert or replace',
+                                                   table_name, key, headers,
+                                                   rows)
+                    checksum = checksums[fp1]
+                    stat = fp1.stat()
+                    cur.execute(f"insert or replace into "
+                                f"{AOD_2db.__INGESTED_TABLE} "
+                                "values (?, ?, ?, ?, ?, ?, ?)",
+                                (self.__file_name(fp1), key, stat.st_size,
+                                 stat.st_mtime, checksum, nrows,
+                                 datetime.now().isoformat(timespec='seconds')))
+                conn.commit()
+                if key == 'metadata':
+                    self.__column_types = None
+            except (sqlite3.Error, OSError, ValueError) as err:
+                conn.rollback()
+                msg = f'Error inserting {file_name} in {table_name}\n{err}'
+                logging.append(msg)
+                return False
+        return True
+
+
+    def __parsed_files(self, f_paths: [pathlib.Path], key: str,
+                       column_types: dict):
+        """
+        Yields the csv files of f_paths as tuples (path, headers, rows), in
+            the order of f_paths; rows is an iterator of the rows of the
+            file with the values converted to column_types, that has to be
+            consumed before the next file is requested. If max_workers is 1
+            the files are read and converted in this process. Otherwise the
+            rows are read in this process in batches of batch_size rows,
+            which are converted and aligned to the union of the headers of
+            f_paths in a pool of max_workers processes; at most
+            2 * max_workers batches are submitted in advance, so the memory
+            used does not depend on the size of the files. The headers of
+            the files are saved in file_columns
+        """
+        if self.max_workers <= 1 or len(f_paths) < 2:
+            for fp1 in f_paths:
+                with open(fp1, 'r', newline='', encoding='utf-8') \
+                    as csv_file:
+                    reader = csv.reader(csv_file)
+                    headers = next(reader, [])
+                    self.__register_headers([(fp1, headers)], key)
+                    converters = AOD_2db.__converters(headers, column_types)
+                    yield fp1, headers, \
+                        (AOD_2db.__row_values(row, converters) \
+                         for row in reader)
+            return
+
+        headers = self.__get_headers(f_paths, key)
+        executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        try:
+            batches = self.__converted_batches(executor, f_paths, headers,
+                                               column_types)
+            for fp1, group in groupby(batches, key=lambda b: b[0]):
+                yield fp1, headers, (row for _, rows in group \
+                                     for row in rows)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+    def __converted_batches(self, executor: ProcessPoolExecutor,
+                            f_paths: [pathlib.Path], columns: [str],
+                            column_types: dict):
+        """
+        Yields the batches of rows of the csv files f_paths (see
+            __csv_batches), converted in executor by _parse_csv_rows, as
+            tuples (path, rows) in the order they are read; at most
+            2 * max_workers batches are submitted and not yielded
+        """
+        pending = deque()
+        for fp1, headers, batch in AOD_2db.__csv_batches(f_paths,
+                                                         self.batch_size):
+            pending.append((fp1, executor.submit\
+                            (AOD_2db._parse_csv_rows, batch, headers,
+                             columns, column_types)))
+            if len(pending) >= 2 * self.max_workers:
+                fp1, future = pending.popleft()
+                yield fp1, future.result()
+        while pending:
+            fp1, future = pending.popleft()
+            yield fp1, future.result()
+
+
+    @staticmethod
+    def __csv_batches(f_paths: [pathlib.Path], batch_size: int):
+        """
+        Yields the rows of the csv files f_paths as they are read, as tuples
+            (path, headers of the file, list of at most batch_size rows); a
+            file without rows yields an empty list
+        """
+        for fp1 in f_paths:
+            with open(fp1, 'r', newline='', encoding='utf-8') as csv_file:
+                reader = csv.reader(csv_file)
+                headers = next(reader, [])
+                empty = True
+                for batch in AOD_2db.__batches(reader, batch_size):
+                    empty = False
+                    yield fp1, headers, batch
+                if empty:
+                    yield fp1, headers, []
+
+
+    @staticmethod
+    def _parse_csv_rows(rows: [list], headers: [str], columns: [str],
+                        column_types: dict) -> [list]:
+        """
+        Returns the rows of a csv file whose columns are headers with the
+            values converted to column_types and aligned to columns; the
+            columns that are not in the file are None. It is run in the
+            processes of __parsed_files, so its name is not private (the
+            private methods can not be pickled)
+        """
+        converters = AOD_2db.__converters(headers, column_types)
+        if headers == columns:
+            return [AOD_2db.__row_values(row, converters) for row in rows]
+        positions = [columns.index(h1) for h1 in headers]
+        n_columns = len(columns)
+        aligned = []
+        for row in rows:
+            values = [None] * n_columns
+            for j, v in zip(positions, AOD_2db.__row_values(row, converters)):
+                values[j] = v
+            aligned.append(values)
+        return aligned
+
+
+    @staticmethod
+    def __batches(rows, batch_size: int):
+        """
+        Yields lists with batch_size elements of the iterable rows; the last
+            one can be shorter
+        """
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                return
+            yield batch
+
+
+    def __insert_batches(self, conn: sqlite3.Connection, insert: str,
+                         rows) -> int:
+        """
+        Executes insert with the rows of the iterable rows in batches of
+            batch_size rows, so only a batch is held in memory; the
+            transaction of conn is committed every batches_per_commit
+            batches. The caller commits the last batches
+
+        Returns
+        -------
+        Number of rows
+        """
+        nrows = 0
+        cur = conn.cursor()
+        for batch in AOD_2db.__batches(rows, self.batch_size):
+            cur.executemany(insert, batch)
+            nrows += len(batch)
+            self.__batch_inserted(conn)
+        return nrows
+
+
+    def __batch_inserted(self, conn: sqlite3.Connection) -> None:
+        self.__uncommitted_batches += 1
+        if self.__uncommitted_batches >= self.batches_per_commit:
+            conn.commit()
+            self.__uncommitted_batches = 0
+
+
+    def __insert_rows(self, conn: sqlite3.Connection, verb: str,
+                      table_name: str, key: str, headers: [str], rows,
+                      key_index: bool=True) -> int:
+        """
+        Inserts rows, whose columns are headers, in table_name with the
+            statement verb ('insert', 'insert or replace' or 'insert or
+            ignore') in batches (see __insert_batches). In a partitioned
+            layout the data rows of each batch are inserted in the partition
+            of their date (see __partition_schema, which receives key_index)
+
+        If the aggregates or the coverage index are being refreshed (see
+            aggregate and coverage_index) the station-months of the data
+            rows are saved in their tables of __PENDING_MONTHS_TABLES
+
+        Returns
+        -------
+        Number of rows
+        """
+        months = None
+        pending_tables = []
+        if key == 'data':
+            pending_tables = self.__pending_tables(conn, headers)
+        if pending_tables:
+            months = set()
+            rows = AOD_2db.__track_months(headers, rows, months)
+        nrows = self.__insert_partitioned(conn, verb, table_name, key,
+                                          headers, rows, key_index)
+        if months:
+            for pending in pending_tables:
+                conn.executemany(f"insert or ignore into main.{pending} "
+                                 "values (?, ?)", months)
+        if key == 'data':
+            AOD_2db.__increment_data_version(conn.cursor())
+        return nrows
+
+
+    def __insert_partitioned(self, conn: sqlite3.Connection, verb: str,
+                             table_name: str, key: str, headers: [str],
+                             rows, key_index: bool) -> int:
+        """
+        Inserts rows as explained in __insert_rows
+        """
+        insert = f"{verb} into {{}}.{table_name} ({', '.join(headers)}) " +\
+            f"values ({', '.join(['?'] * len(headers))})"
+        if self.partition is None or key != 'data' or 'fecha' not in headers:
+            return self.__insert_batches(conn, insert.format('main'), rows)
+
+        i_fecha = headers.index('fecha')
+        nrows = 0
+        for batch in AOD_2db.__batches(rows, self.batch_size):
+            groups = {}
+            for row in batch:
+                name = self.__partition_name(row[i_fecha])
+                groups.setdefault(name, []).append(row)
+            for name, group in groups.items():
+                schema = self.__partition_schema(conn, name, headers,
+                                                 key_index)
+                conn.executemany(insert.format(schema), group)
+                if name is not None:
+                    self.__touched_partitions.add(name)
+            nrows += len(batch)
+            self.__batch_inserted(conn)
+        return nrows
+
+
+    @staticmethod
+    def __increment_data_version(cur: sqlite3.Cursor) -> None:
+        """
+        Increments the version of the data table; the table data_version
+            is created if it does not exist
+        """
+        table_name = AOD_2db.__VERSION_TABLE
+        cur.execute(f"create table if not exists {table_name} "
+                    "(token text, version integer)")
+        cur.execute(f"update {table_name} set version = version + 1")
+        if cur.rowcount < 1:
+            cur.execute(f"insert into {table_name} values (?, ?)",
+                        (uuid.uuid4().hex, 1))
+
+
+    def data_version(self) -> str:
+        """
+        Version of the data table as 'token:number': the token is created
+            with the table data_version and the number is incremented in
+            each insertion of data rows, so the caches derived from the data
+            table (see SeriesStore.from_db_cached) are valid while it does
+            not change. None if the database does not exist or there is an
+            error. In the databases created before data_version existed, the
+            table is created in the first call
+        """
+        dbpath = self.get_default_dbpath()
+        if not dbpath.exists():
+            logging.append(f'{dbpath} does not exists')
+            return None
+        table_name = AOD_2db.__VERSION_TABLE
+        with self.__lock:
+            conn = self.__connection()
+            try:
+                cur = conn.cursor()
+                if not AOD_2db.__table_exists(cur, table_name):
+                    AOD_2db.__increment_data_version(cur)
+                    conn.commit()
+                row = cur.execute(f"select token, version from "
+                                  f"{table_name}").fetchone()
+            except sqlite3.Error as err:
+                conn.rollback()
+                logging.append(f'Error reading {table_name}\n{err}')
+                return None
+        return f'{row[0]}:{row[1]}'
+
+
+    def __pending_tables(self, conn: sqlite3.Connection,
+                         headers: [str]) -> [str]:
+        """
+        Tables of __PENDING_MONTHS_TABLES where the station-months of the
+            daily rows with headers must be saved
+        """
+        if 'indicativo' not in headers or 'fecha' not in headers or \
+            not self.is_daily_file_type():
+            return []
+        cur = conn.cursor()
+        return [t1 for t1 in AOD_2db.__PENDING_MONTHS_TABLES.values() \
+                if AOD_2db.__table_exists(cur, t1)]
+
+
+    @staticmethod
+    def __track_months(headers: [str], rows, months: set):
+        """
+        Yields rows and adds to months their tuples (indicativo, 'YYYY-MM')
+        """
+        i_station = headers.index('indicativo')
+        i_fecha = headers.index('fecha')
+        for row in rows:
+            fecha = row[i_fecha]
+            if isinstance(fecha, str) and len(fecha) == 10:
+                months.add((row[i_station], fecha[:7]))
+            yield row
+
+
+    @staticmethod
+    def __table_exists(cur: sqlite3.Cursor, table_name: str,
+                       schema: str='main') -> bool:
+        return cur.execute(f"select 1 from {schema}.sqlite_master where "
+                           "type = 'table' and name = ?",
+                           (table_name,)).fetchone() is not None
+
+
+    @staticmethod
+    def __to_real(value) -> float:
+        """
+        Converts value to float; the decimal comma is changed to a period
+            and the codes of CODE_VALUES are their number. The empty values
+            are None; the other values that are not numbers are returned
+            as they are
+        """
+        if isinstance(value, (int, float)):
+            return float(value)
+        if not isinstance(value, str) or not value.strip():
+            return None
+        value = value.strip()
+        if value in AOD_2db.CODE_VALUES:
+            return AOD_2db.CODE_VALUES[value]
+        try:
+            return float(value.replace(',', '.'))
+        except ValueError:
+            return value
+
+
+    @staticmethod
+    def __to_integer(value) -> int:
+        """
+        Converts value to int. The empty values are None; the other values
+            that are not integers are returned as they are
+        """
+        if isinstance(value, int):
+            return value
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            pass
+        if not isinstance(value, str) or not value.strip():
+            return None
+        return value.strip()
+
+
+    @staticmethod
+    def __converters(columns: [str], column_types: dict) -> [(int, object)]:
+        """
+        Returns the conversion function of the REAL and INTEGER columns of
+            columns as tuples (column index, function)
+        """
+        functions = {'real': AOD_2db.__to_real,
+                     'integer': AOD_2db.__to_integer}
+        return [(i, functions[column_types[c1]]) \
+                for i, c1 in enumerate(columns) \
+                if column_types.get(c1) in functions]
+
+
+    @staticmethod
+    def __row_values(row: [str], converters: [(int, object)]) -> list:
+        """
+        Converts the values of row with converters (see __converters)
+        """
+        for i, f in converters:
+            row[i] = f(row[i])
+        return row
+
+
+    def __register_files(self, f_paths: [pathlib.Path], key: str,
+                         clear: bool=False) -> None:
+        """
+        Registers f_paths as ingested files of key. If clear is True the
+            files of key previously registered are removed. The checksums
+            are not computed, they are null: reading every file again would
+            slow down the full inserts; __pending_files computes the
+            checksum of a file only if its size or modification time change
+        """
+        rows = []
+        now = datetime.now().isoformat(timespec='seconds')
+        for fp1 in f_paths:
+            stat = fp1.stat()
+            rows.append((self.__file_name(fp1), key, stat.st_size,
+                         stat.st_mtime, None, None, now))
+        with self.__lock:
+            conn = self.__connection()
+            try:
+                cur = conn.cursor()
+                self.__create_ingested_table(cur)
+                if clear:
+                    cur.execute(f"delete from {AOD_2db.__INGESTED_TABLE} "
+                                "where key = ?", (key,))
+                cur.executemany(f"insert or replace into "
+                                f"{AOD_2db.__INGESTED_TABLE} "
+                                "values (?, ?, ?, ?, ?, ?, ?)", rows)
+                conn.commit()
+            except sqlite3.Error as err:
+                conn.rollback()
+                logging.append(f'Error registering the ingested files\n{err}')
+
+
+    def insert_records(self, records: [dict], key: str='data') -> bool:
+        """
+        Inserts in a transaction the rows downloaded from Aemet, as
+            they are in the json response (a dictionary per row), in the
+            table of key. The table is created if it does not exist and the
+            keys of the records that are not columns of the table are added
+            as new columns. As in to_db, the values are converted to the
+            types of the columns (see the class description). A data row
+            replaces the row of the table with the same key; the metadata
+            rows whose id is already in the table are not inserted.
+        It can be called from several threads.
+
+        Parameters
+        ----------
+        records : rows as dictionaries
+        key : 'data' or 'metadata'
+
+        Returns
+        -------
+        bool. True if the rows have been inserted
+        """
+        if key not in ('data', 'metadata'):
+            logging.append(f'key has not a valid value: {key}')
+            return False
+        if not records:
+            return True
+
+        table_name = AOD_2db.__table_name(self.file_type, key)
+        conflict = 'replace' if key == 'data' else 'ignore'
+
+        with self.__lock:
+            conn = self.__connection()
+            try:
+                cur = conn.cursor()
+                columns = sorted({k for r in records for k in r})
+                column_types = self.__table_column_types(cur, key)
+                AOD_2db.__add_columns(cur, table_name, columns, column_types)
+                AOD_2db.__create_key_index(cur, table_name, key)
+                converters = AOD_2db.__converters(columns, column_types)
+                self.__uncommitted_batches = 0
+                nrows = self.__insert_rows(conn, f'insert or {conflict}',
+                                           table_name, key, columns,
+                                           (AOD_2db.__record_values\
+                                            (r, columns, converters) \
+                                            for r in records))
+                if key == 'data':
+                    cur.execute("create table if not exists "
+                                f"{AOD_2db.__RECORDS_TABLE} "
+                                "(inserted_at text, nrows integer)")
+                    cur.execute(f"insert into {AOD_2db.__RECORDS_TABLE} "
+                                "values (?, ?)",
+                                (datetime.now().isoformat(timespec='seconds'),
+                                 nrows))
+                conn.commit()
+                if key == 'metadata':
+                    self.__column_types = None
+            except sqlite3.Error as err:
+                conn.rollback()
+                msg = f'Error inserting rows in {table_name}\n{err}'
+                logging.append(msg)
+                return False
+        return True
+
+
+    @staticmethod
+    def __add_columns(cur: sqlite3.Cursor, table_name: str,
+                      columns: [str], column_types: dict,
+                      schema: str='main') -> None:
+        """
+        Creates table_name with columns if it does not exist; otherwise the
+            columns that are not in table_name are added. The type of a
+            column is in column_types, the default is text
+        """
+        table_info = \
+            cur.execute(f"PRAGMA {schema}.table_info({table_name})")\
+            .fetchall()
+        if not table_info:
+            column_defs = \
+                ', '.join([f'{c1} {column_types.get(c1, "text")}' \
+                           for c1 in columns])
+            cur.execute(f"create table if not exists {schema}.'{table_name}' "
+                        f"( {column_defs} );")
+            return
+        table_columns = {c1[1] for c1 in table_info}
+        for c1 in columns:
+            if c1 not in table_columns:
+                cur.execute(f"alter table {schema}.{table_name} add column "
+                            f"{c1} {column_types.get(c1, 'text')}")
+
+
+    @staticmethod
+    def __retype_table(cur: sqlite3.Cursor, table_name: str,
+                       column_types: dict) -> None:
+        """
+        Rebuilds table_name if the type of some of its columns is not the
+            REAL or INTEGER type of column_types (the tables created by
+            previous versions have only text columns): a table with the
+            types is created, the rows are copied converting the values as
+            the rows of the files (see __to_real and __to_integer), the
+            table is replaced by it and its indexes are created again
+        """
+        table_info = cur.execute(f"PRAGMA main.table_info({table_name})")\
+            .fetchall()
+        declared = {row[1]: row[2].lower() for row in table_info}
+        functions = {'real': 'aod_to_real', 'integer': 'aod_to_integer'}
+        changed = [c1 for c1, t1 in declared.items() \
+                   if column_types.get(c1) in functions and \
+                   column_types[c1] != t1]
+        if not changed:
+            return
+        conn = cur.connection
+        conn.create_function(functions['real'], 1, AOD_2db.__to_real,
+                             deterministic=True)
+        conn.create_function(functions['integer'], 1, AOD_2db.__to_integer,
+                             deterministic=True)
+        indexes = [row[0] for row in \
+                   cur.execute("select sql from sqlite_master where type = "
+                               "'index' and tbl_name = ? and sql is not null",
+                               (table_name,))]
+        column_defs = ', '.join([f'{c1} {column_types.get(c1, t1) or "text"}' \
+                                 for c1, t1 in declared.items()])
+        values = ', '.join([f'{functions[column_types[c1]]}({c1})' \
+                            if c1 in changed else c1 for c1 in declared])
+        new_table = f'{table_name}_retyped'
+        cur.execute(f"drop table if exists {new_table}")
+        cur.execute(f"create table {new_table} ( {column_defs} )")
+        cur.execute(f"insert into {new_table} select {values} "
+                    f"from {table_name}")
+        cur.execute(f"drop table {table_name}")
+        cur.execute(f"alter table {new_table} rename to {table_name}")
+        for sql in indexes:
+            cur.execute(sql)
+        logging.append(f'The columns {", ".join(changed)} of {table_name} '
+                       'have been converted to their types')
+
+
+    @staticmethod
+    def __create_key_index(cur: sqlite3.Cursor, table_name: str,
+                           key: str, schema: str='main') -> bool:
+        """
+        Creates the unique index on the natural key of table_name. If the
+            table has repeated keys (it was created before the index
+            existed) only the first row of each key is kept; the number of
+            rows deleted is logged
+
+        Returns
+        -------
+        False if table_name has not the columns of the natural key
+        """
+        natural_key = AOD_2db.__NATURAL_KEY[key]
+        columns = {c1[1] for c1 in \
+                   cur.execute(f"PRAGMA {schema}.table_info({table_name})")}
+        if not all(k in columns for k in natural_key):
+            return False
+        key_columns = ', '.join(natural_key)
+        create_index = f"create unique index if not exists " +\
+            f"{schema}.{table_name}_key on {table_name} ({key_columns})"
+        try:
+            cur.execute(create_index)
+        except sqlite3.IntegrityError:
+            cur.execute(f"delete from {schema}.{table_name} where rowid "
+                        f"not in (select min(rowid) from "
+                        f"{schema}.{table_name} group by {key_columns})")
+            logging.append(f'{cur.rowcount} rows with a repeated key '
+                           f'({key_columns}) have been deleted from '
+                           f'{schema}.{table_name}')
+            cur.execute(create_index)
+        return True
+
+
+    def __get_column_types(self, cur: sqlite3.Cursor) -> dict:
+        """
+        Types of the columns of the data table that are not text, as a
+            dictionary having the column name as the key and 'real' or
+            'integer' as the value (see __AFFINITIES). They are read from
+            the metadata table or, if it is empty, with read_metadata_files
+        """
+        if self.__column_types is not None:
+            return self.__column_types
+        table_name = AOD_2db.__DBTABLE_METADATA[self.file_type]
+        tipos = {}
+        try:
+            rows = cur.execute(f"select id, tipo_datos from {table_name}")\
+                .fetchall()
+            tipos = {row[0]: row[1] for row in rows}
+        except sqlite3.OperationalError:
+            # the metadata table does not exist
+            pass
+        if not tipos:
+            tipos = {k: v[1] for k, v in self.read_metadata_files().items()}
+        self.__column_types = \
+            {k: AOD_2db.__AFFINITIES[v] for k, v in tipos.items() \
+             if v in AOD_2db.__AFFINITIES}
+        return self.__column_types
+
+
+    def __table_column_types(self, cur: sqlite3.Cursor, key: str) -> dict:
+        """
+        Column types of the table of key; the columns of the metadata table
+            are text
+        """
+        if key == 'metadata':
+            return {}
+        return self.__get_column_types(cur)
+
+
+    @staticmethod
+    def __record_values(record: dict, columns: [str],
+                        converters: [(int, object)]) -> list:
+        values = []
+        for c1 in columns:
+            v = record.get(c1)
+            if v is None:
+                v = ''
+            elif not isinstance(v, str):
+                v = str(v)
+            values.append(v)
+        return AOD_2db.__row_values(values, converters)
+
+
+    def series(self, stations: Union[str, list]=None,
+               variables: Union[str, list]=None,
+               d1: Union[str, date]=None, d2: Union[str, date]=None,
+               as_arrays: bool=True):
+        """
+        Reads the time series of stations and variables between d1 and d2
+            from the data table; the rows of each station are found with
+            the unique index on (indicativo, fecha) created by to_db. In
+            monthly data the annual rows (month 13) are ordered after
+            December.
+
+        Parameters
+        ----------
+        stations : optional. Station or list of stations (indicativo); if
+            None, all the stations
+        variables : optional. Column or list of columns of the data table;
+            if None, all the columns except indicativo and fecha
+        d1, d2 : optional. First and last date as date or 'YYYY-MM-DD'; if
+            None, the series are not limited. In monthly data only the year
+            and the month are used
+        as_arrays : optional. If True the series are returned as arrays;
+            otherwise as an iterator of rows
+
+        Returns
+        -------
+        If as_arrays is True, a dictionary having the station as the key and
+            as the value a dictionary with the dates ('fecha', a list) and
+            the variables: the REAL and INTEGER variables are arrays of type
+            'd' with nan as missing value, the TEXT variables are lists.
+        If as_arrays is False, an iterator of tuples (indicativo, fecha,
+            variable values) ordered by station and date.
+        If there is an error, an empty dictionary or iterator
+        """
+        rows = self.__series_rows(stations, variables, d1, d2)
+        if rows is None:
+            return {} if as_arrays else iter(())
+        columns = next(rows)
+        if not as_arrays:
+            return rows
+        return AOD_2db.__series_arrays(columns, rows)
+
+
+    def __series_rows(self, stations, variables, d1, d2):
+        """
+        Returns a generator whose first element are the names and types of
+            the variables and the next ones are the rows of series, or None
+            if there is an error
+        """
+        dbpath = self.get_default_dbpath()
+        if not dbpath.exists():
+            logging.append(f'{dbpath} does not exists')
+            return None
+        table_name = AOD_2db.__DBTABLE[self.file_type]
+        natural_key = AOD_2db.__NATURAL_KEY['data']
+        if isinstance(stations, str):
+            stations = [stations]
+        if isinstance(variables, str):
+            variables = [variables]
+        try:
+            d1, d2 = [AOD_2db.__as_date(d) for d in (d1, d2)]
+        except ValueError as err:
+            logging.append(f'Not valid date: {err}')
+            return None
+
+        conn = self.__connection()
+        try:
+            cur = conn.cursor()
+            column_types = {row[1]: row[2].lower() for row in \
+                            cur.execute(f"PRAGMA table_info({table_name})")}
+            if not column_types:
+                logging.append(f'Table {table_name} does not exists')
+                return None
+            if variables is None:
+                variables = [c1 for c1 in column_types \
+                             if c1 not in natural_key]
+            unknown = [v1 for v1 in variables if v1 not in column_types]
+            if unknown:
+                logging.append(f'Not columns of {table_name}: '
+                               f'{", ".join(unknown)}')
+                return None
+        except sqlite3.Error as err:
+            logging.append(f'Error reading {table_name}\n{err}')
+            return None
+
+        where, params, order = self.__where(stations, d1, d2)
+        select = f"select indicativo, fecha, {', '.join(variables)} " +\
+            f"from {{}}.{table_name}{where} order by {order}"
+        columns = [(v1, column_types[v1]) for v1 in variables]
+        return self.__iter_series(conn, select, params, columns, d1, d2)
+
+
+    def __where(self, stations: [str], d1: date, d2: date) \
+        -> (str, list, str):
+        """
+        Where clause (it is '' if there are no conditions), its parameters
+            and order by clause of the rows of stations between d1 and d2.
+            The daily dates are compared as strings. The monthly dates
+            ('YYYY-M') are selected by year, so the indexes can be used, and
+            by __MONTH_NUMBER
+        """
+        where = []
+        params = []
+        if stations:
+            marks = ', '.join(['?'] * len(stations))
+            where.append(f"indicativo in ({marks})")
+            params += stations
+        if self.is_daily_file_type():
+            if d1 is not None:
+                where.append("fecha >= ?")
+                params.append(d1.isoformat())
+            if d2 is not None:
+                where.append("fecha <= ?")
+                params.append(d2.isoformat())
+            order = "indicativo, fecha"
+        else:
+            month_number = AOD_2db.__MONTH_NUMBER
+            if d1 is not None:
+                where.append(f"fecha >= ? and {month_number} >= ?")
+                params += [f'{d1.year:04d}', d1.year * 100 + d1.month]
+            if d2 is not None:
+                where.append(f"fecha < ? and {month_number} <= ?")
+                params += [f'{d2.year + 1:04d}', d2.year * 100 + d2.month]
+            order = f"indicativo, {month_number}"
+        if not where:
+            return '', params, order
+        return " where " + " and ".join(where), params, order
+
+
+    def __iter_series(self, conn: sqlite3.Connection, select: str,
+                      params: list, columns: [(str, str)], d1: date,
+                      d2: date):
+        """
+        Yields columns and then the rows of select in each schema (see
+            __schemas). In a partitioned layout the rows are ordered by
+            partition and then by station and date
+        """
+        yield columns
+        try:
+            for schema in self.__schemas(conn, d1, d2):
+                yield from conn.cursor().execute(select.format(schema),
+                                                 params)
+        except sqlite3.Error as err:
+            logging.append(f'Error reading the series\n{err}')
+
+
+    @staticmethod
+    def __series_arrays(columns: [(str, str)], rows) -> dict:
+        """
+        Groups rows by station in arrays (see series)
+        """
+        numeric = [column_type in ('real', 'integer') \
+                   for _, column_type in columns]
+        nan = float('nan')
+        series = {}
+        for row in rows:
+            station = series.get(row[0])
+            if station is None:
+                station = {'fecha': []}
+                for (name, _), is_numeric in zip(columns, numeric):
+                    station[name] = array('d') if is_numeric else []
+                series[row[0]] = station
+            station['fecha'].append(row[1])
+            for (name, _), is_numeric, v in zip(columns, numeric, row[2:]):
+                if is_numeric and not isinstance(v, (int, float)):
+                    v = nan
+                station[name].append(v)
+        return series
+
+
+    @staticmethod
+    def __as_date(value: Union[str, date]) -> date:
+        if value is None or isinstance(value, date):
+            return value
+        return date.fromisoformat(value)
+
+
+    def aggregate(self, variables: [str]=None, rebuild: bool=False) -> bool:
+        """
+        Computes the monthly and annual aggregates of the daily data with
+            group by. Each table (see __AGGREGATE_TABLES) has a row per
+            station and period, whose fecha is 'YYYY-MM' or 'YYYY', with the
+            columns days (days of the period), nrows (rows of the period in
+            the data table) and, for each variable, the columns
+            variable_n (number of values, the completeness count),
+            variable_sum, variable_avg, variable_min and variable_max; the
+            codes saved as text, such as 'Acum', are not counted. The
+            annual aggregates are computed from the monthly ones.
+        The first call creates the tables. In the next calls only the
+            station-months in aggregates_pending (the months of the rows
+            inserted since the previous call) and their years are computed
+            again, unless rebuild is True, the variables change or the data
+            has been inserted again with to_db (incremental=False).
+
+        Parameters
+        ----------
+        variables : optional. REAL or INTEGER columns of the data table; if
+            None, the variables of the existing tables or, if they do not
+            exist, the numeric columns except __NOT_AGGREGATED
+        rebuild : optional. If True all the aggregates are computed again
+
+        Returns
+        -------
+        bool. True if the task ends ok
+        """
+        if not self.is_daily_file_type():
+            logging.append('The aggregates are computed from daily data')
+            return False
+        dbpath = self.get_default_dbpath()
+        if not dbpath.exists():
+            logging.append(f'{dbpath} does not exists')
+            return False
+        table_name = AOD_2db.__DBTABLE[self.file_type]
+        monthly = self.__aggregate_table('month')
+        pending = AOD_2db.__PENDING_MONTHS_TABLES['aggregates']
+
+        with self.__lock:
+            conn = self.__connection()
+            try:
+                cur = conn.cursor()
+                column_types = \
+                    {row[1]: row[2].lower() for row in \
+                     cur.execute(f"PRAGMA table_info({table_name})")}
+                if not column_types:
+                    logging.append(f'Table {table_name} does not exists')
+                    return False
+                existing = AOD_2db.__aggregated_variables(cur, monthly)
+                if variables is None:
+                    variables = existing or \
+                        [c1 for c1, t1 in column_types.items() \
+                         if t1 in ('real', 'integer') and \
+                         c1 not in AOD_2db.__NOT_AGGREGATED]
+                elif isinstance(variables, str):
+                    variables = [variables]
+                unknown = [v1 for v1 in variables if \
+                           column_types.get(v1) not in ('real', 'integer')]
+                if unknown:
+                    logging.append(f'Not numeric columns of {table_name}: '
+                                   f'{", ".join(unknown)}')
+                    return False
+                if not variables:
+                    logging.append('No variables to aggregate')
+                    return False
+
+                if set(variables) != set(existing) or \
+                    not AOD_2db.__table_exists(cur, pending):
+                    rebuild = True
+                if rebuild:
+                    self.__create_aggregate_tables(cur, variables)
+                    schemas = self.__schemas(conn)
+                else:
+                    variables = existing
+                    months = cur.execute(f"select min(fecha), max(fecha) "
+                                         f"from {pending}").fetchone()
+                    if months[0] is None:
+                        logging.append('The aggregates are up to date',
+                                       False)
+                        return True
+                    d1 = date.fromisoformat(f'{months[0]}-01')
+                    d2 = date.fromisoformat(f'{months[1]}-01')
+                    schemas = self.__schemas(conn, d1, d2)
+                for schema in schemas:
+                    cur.execute(f"insert or replace into main.{monthly} " +\
+                                self.__monthly_select(variables, schema,
+                                                      not rebuild))
+                cur.execute(f"insert or replace into main."
+                            f"{self.__aggregate_table('year')} " +\
+                            self.__annual_select(variables, not rebuild))
+                AOD_2db.__create_pending_table(cur, pending)
+                conn.commit()
+            except sqlite3.Error as err:
+                conn.rollback()
+                logging.append(f'Error computing the aggregates\n{err}')
+                return False
+        logging.append(f'The aggregates of {table_name} have been '
+                       'computed', False)
+        return True
+
+
+    def __aggregate_table(self, period: str) -> str:
+        return AOD_2db.__AGGREGATE_TABLES[period]\
+            .format(AOD_2db.__DBTABLE[self.file_type])
+
+
+    def __has_aggregates(self) -> bool:
+        """
+        True if the aggregates have been computed (see aggregate)
+        """
+        if not self.is_daily_file_type():
+            return False
+        return AOD_2db.__table_exists(self.__connection().cursor(),
+                                      self.__aggregate_table('month'))
+
+
+    @staticmethod
+    def __aggregated_variables(cur: sqlite3.Cursor,
+                               table_name: str) -> [str]:
+        """
+        Variables of the aggregates table table_name; [] if it does not
+            exist
+        """
+        return [row[1][:-2] for row in \
+                cur.execute(f"PRAGMA table_info({table_name})") \
+                if row[1].endswith('_n')]
+
+
+    def __create_aggregate_tables(self, cur: sqlite3.Cursor,
+                                  variables: [str]) -> None:
+        """
+        Creates the aggregates tables of variables; the previous tables and
+            aggregates_pending are dropped (it is created again when the
+            aggregates have been computed)
+        """
+        columns = ['indicativo text', 'fecha text', 'days integer',
+                   'nrows integer']
+        for v1 in variables:
+            for suffix in AOD_2db.__AGGREGATE_FUNCTIONS:
+                column_type = 'integer' if suffix == 'n' else 'real'
+                columns.append(f'{v1}_{suffix} {column_type}')
+        for period in AOD_2db.__AGGREGATE_TABLES:
+            table_name = self.__aggregate_table(period)
+            cur.execute(f"drop table if exists {table_name}")
+            cur.execute(f"create table {table_name} "
+                        f"( {', '.join(columns)} )")
+            AOD_2db.__create_key_index(cur, table_name, 'data')
+        cur.execute("drop table if exists "
+                    f"{AOD_2db.__PENDING_MONTHS_TABLES['aggregates']}")
+
+
+    @staticmethod
+    def __create_pending_table(cur: sqlite3.Cursor, table_name: str) -> None:
+        """
+        Creates the table of pending station-months table_name if it does
+            not exist and deletes its rows
+        """
+        cur.execute(f"create table if not exists {table_name} "
+                    "(indicativo text, fecha text, "
+                    "primary key (indicativo, fecha)) without rowid")
+        cur.execute(f"delete from {table_name}")
+
+
+    def __pending_join(self, schema: str, pending: str) -> str:
+        """
+        From clause of the data rows (d) in schema of the station-months of
+            the table pending (p); the key index of the data table is used
+        """
+        table_name = AOD_2db.__DBTABLE[self.file_type]
+        return f"main.{pending} p join {schema}.{table_name} d on " +\
+            "d.indicativo = p.indicativo and " +\
+            "d.fecha between p.fecha || '-01' and p.fecha || '-31'"
+
+
+    def __monthly_select(self, variables: [str], schema: str,
+                         pending: bool) -> str:
+        """
+        Select of the monthly aggregates of the data table in schema; if
+            pending is True, only of the station-months in
+            aggregates_pending (the key index of the data table is used)
+        """
+        table_name = AOD_2db.__DBTABLE[self.file_type]
+        month = "substr(d.fecha, 1, 7)"
+        days = f"cast(julianday({month} || '-01', '+1 month') - " +\
+            f"julianday({month} || '-01') as integer)"
+        # the codes saved as text (see __to_real) are not aggregated
+        aggregates = [f"{f}(case when typeof(d.{v1}) in ('integer', " +\
+                      f"'real') then d.{v1} end)" for v1 in variables \
+                      for f in AOD_2db.__AGGREGATE_FUNCTIONS.values()]
+        if pending:
+            source = self.__pending_join\
+                (schema, AOD_2db.__PENDING_MONTHS_TABLES['aggregates'])
+        else:
+            source = f"{schema}.{table_name} d " +\
+                "where d.fecha like '____-__-__'"
+        return f"select d.indicativo, {month}, {days}, count(*), " +\
+            f"{', '.join(aggregates)} from {source} " +\
+            f"group by d.indicativo, {month}"
+
+
+    def __annual_select(self, variables: [str], pending: bool) -> str:
+        """
+        Select of the annual aggregates from the monthly ones; if pending
+            is True, only of the station-years of aggregates_pending
+        """
+        monthly = self.__aggregate_table('month')
+        year = "substr(m.fecha, 1, 4)"
+        days = f"cast(julianday(({year} + 1) || '-01-01') - " +\
+            f"julianday({year} || '-01-01') as integer)"
+        aggregates = []
+        for v1 in variables:
+            aggregates += [f"sum(m.{v1}_n)", f"sum(m.{v1}_sum)",
+                           f"sum(m.{v1}_sum) / nullif(sum(m.{v1}_n), 0)",
+                           f"min(m.{v1}_min)", f"max(m.{v1}_max)"]
+        if pending:
+            pending_table = AOD_2db.__PENDING_MONTHS_TABLES['aggregates']
+            source = "(select distinct indicativo, substr(fecha, 1, 4) " +\
+                f"as fecha from {pending_table}) p " +\
+                f"join {monthly} m on m.indicativo = p.indicativo and " +\
+                "m.fecha between p.fecha || '-01' and p.fecha || '-12'"
+        else:
+            source = f"{monthly} m"
+        return f"select m.indicativo, {year}, {days}, sum(m.nrows), " +\
+            f"{', '.join(aggregates)} from {source} " +\
+            f"group by m.indicativo, {year}"
+
+
+    def aggregates(self, period: str='month',
+                   stations: Union[str, list]=None,
+                   d1: Union[str, date]=None,
+                   d2: Union[str, date]=None) -> [dict]:
         """
+        Reads the aggregates computed by aggregate
+
         Parameters
         ----------
-        d_path (str). Directory path where files has been saved and database 
-            will be created
-        file_type (str). Type of files to insert in the database, codified as
-            the keys of the dictionary __FILE_PATTERNS
+        period : optional. 'month' or 'year'
+        stations : optional. Station or list of stations; if None, all
+        d1, d2 : optional. First and last date as date or 'YYYY-MM-DD'; the
+            periods that contain d1 and d2 are included
 
         Returns
         -------
-        self
+        A dictionary per station and period, ordered by station and date;
+            [] if there is an error
         """
-        
-        dir_path = AOD_2db.exists_dir_path(d_path)
-        dir_path = AOD_2db.__get_absolute_path(dir_path)
-        
-        par = {'file_type': file_type}
-        AOD_2db.__valid_value(par, AOD_2db.__FILE_PATTERNS.keys())
-        
-        self.dir_path: pathlib.Path = dir_path
-        self.file_type: str = file_type
-        self.verbose: bool = verbose
-        
-    #     self.__dbpath: pathlib.Path = None
+        if period not in AOD_2db.__AGGREGATE_TABLES:
+            a = ', '.join(AOD_2db.__AGGREGATE_TABLES)
+            logging.append(f'period must have a value in {a}')
+            return []
+        if not self.__has_aggregates():
+            logging.append('The aggregates have not been computed')
+            return []
+        try:
+            d1, d2 = [AOD_2db.__as_date(d) for d in (d1, d2)]
+        except ValueError as err:
+            logging.append(f'Not valid date: {err}')
+            return []
+        if isinstance(stations, str):
+            stations = [stations]
+        n = 7 if period == 'month' else 4
+        where = []
+        params = []
+        if stations:
+            where.append(f"indicativo in ({', '.join(['?'] * len(stations))})")
+            params += stations
+        if d1 is not None:
+            where.append("fecha >= ?")
+            params.append(d1.isoformat()[:n])
+        if d2 is not None:
+            where.append("fecha <= ?")
+            params.append(d2.isoformat()[:n])
+        where = " where " + " and ".join(where) if where else ""
+        with self.__lock:
+            try:
+                cur = self.__connection().cursor()
+                cur.execute(f"select * from {self.__aggregate_table(period)}"
+                            f"{where} order by indicativo, fecha", params)
+                columns = [c1[0] for c1 in cur.description]
+                return [dict(zip(columns, row)) for row in cur]
+            except sqlite3.Error as err:
+                logging.append(f'Error reading the aggregates\n{err}')
+                return []
 
 
-    # @property
-    # def dbpath(self):
-    #     return self.__dbpath
+    def coverage_index(self, rebuild: bool=False) -> bool:
+        """
+        Builds or updates the coverage index of the daily data, the table
+            metd_coverage with the intervals of consecutive days with rows
+            of each station (first_day, last_day, days since 1970-01-01),
+            used by missing_intervals and coverage. The intervals of
+            consecutive days of each station are computed in sql with a window function (the days
+            minus their row number are constant in an interval) and then
+            the intervals that are contiguous or overlap are merged, so the
+            intervals of several partitions are joined. The first call
+            builds the index; the next ones compute only the intervals of
+            the station-months in coverage_pending and merge them with the
+            previous intervals of their stations, because the rows of the
+            data table are replaced but not deleted
 
+        Parameters
+        ----------
+        rebuild : optional. If True the index is built again
 
-    # @dbpath.setter
-    # def dbpath(self, dbpath: str):
-    #     dbpath = AOD_2db.__get_absolute_path(dbpath)
-    #     if not dbpath.exists() or not dbpath.is_file():
-    #         msg = f"No {dbpath} exists"
-    #         logging.append(msg)
-    #         raise ValueError(msg)
-    #     self.__dbpath = dbpath
+        Returns
+        -------
+        bool. True if the task ends ok
+        """
+        if not self.is_daily_file_type():
+            logging.append('The coverage index is built from daily data')
+            return False
+        dbpath = self.get_default_dbpath()
+        if not dbpath.exists():
+            logging.append(f'{dbpath} does not exists')
+            return False
+        coverage = self.__coverage_table()
+        pending = AOD_2db.__PENDING_MONTHS_TABLES['coverage']
 
+        with self.__lock:
+            conn = self.__connection()
+            try:
+                cur = conn.cursor()
+                if not AOD_2db.__table_exists(cur, coverage) or \
+                    not AOD_2db.__table_exists(cur, pending):
+                    rebuild = True
+                if rebuild:
+                    cur.execute(f"drop table if exists {pending}")
+                    cur.execute(f"drop table if exists {coverage}")
+                    cur.execute(f"create table {coverage} (indicativo text, "
+                                "first_day integer, last_day integer)")
+                    cur.execute(f"create index {coverage}_station on "
+                                f"{coverage} (indicativo, first_day)")
+                    schemas = self.__schemas(conn)
+                else:
+                    months = cur.execute(f"select min(fecha), max(fecha) "
+                                         f"from {pending}").fetchone()
+                    if months[0] is None:
+                        return True
+                    d1 = date.fromisoformat(f'{months[0]}-01')
+                    d2 = date.fromisoformat(f'{months[1]}-01')
+                    schemas = self.__schemas(conn, d1, d2)
+                cur.execute("create temp table if not exists coverage_new "
+                            "(indicativo text, first_day integer, "
+                            "last_day integer)")
+                cur.execute("delete from temp.coverage_new")
+                for schema in schemas:
+                    cur.execute("insert into temp.coverage_new " +\
+                                self.__intervals_select(schema, not rebuild))
+                if not rebuild:
+                    stations = f"(select distinct indicativo from {pending})"
+                    cur.execute(f"insert into temp.coverage_new select * "
+                                f"from {coverage} where indicativo in "
+                                f"{stations}")
+                    cur.execute(f"delete from {coverage} where indicativo "
+                                f"in {stations}")
+                cur.execute(f"insert into {coverage} " +\
+                            AOD_2db.__merged_intervals_select())
+                cur.execute("delete from temp.coverage_new")
+                AOD_2db.__create_pending_table(cur, pending)
+                conn.commit()
+            except sqlite3.Error as err:
+                conn.rollback()
+                logging.append(f'Error building the coverage index\n{err}')
+                return False
+        return True
 
-    def get_default_dbpath(self) -> pathlib.Path:
-        dbname = self.__DBNAME[self.file_type]
-        dbpath = self.dir_path.joinpath(dbname)
-        return dbpath 
 
+    def __coverage_table(self) -> str:
+        return AOD_2db.__COVERAGE_TABLE\
+            .format(AOD_2db.__DBTABLE[self.file_type])
 
-    def is_daily_file_type(self):
-        if 'day' in self.file_type:
-            return True
-        elif 'month' in self.file_type:
+
+    def __has_coverage_index(self) -> bool:
+        """
+        True if the coverage index has been built (see coverage_index)
+        """
+        if not self.is_daily_file_type():
             return False
+        return AOD_2db.__table_exists(self.__connection().cursor(),
+                                      self.__coverage_table())
+
+
+    def __intervals_select(self, schema: str, pending: bool) -> str:
+        """
+        Select of the intervals of consecutive days of the stations in the
+            data table of schema; if pending is True, only of the
+            station-months in coverage_pending
+        """
+        table_name = AOD_2db.__DBTABLE[self.file_type]
+        day = f"cast(julianday(d.fecha) - {AOD_2db.__JULIAN_DAY_1970} " +\
+            "as integer)"
+        if pending:
+            source = self.__pending_join\
+                (schema, AOD_2db.__PENDING_MONTHS_TABLES['coverage'])
         else:
-            msg = f'File_type ({self.file_type})does not follow the '+\
-                'required name pattern' 
-            raise ValueError(msg)
+            source = f"{schema}.{table_name} d"
+        return "select indicativo, min(day), max(day) from " +\
+            f"(select d.indicativo, {day} as day, {day} - row_number() " +\
+            "over (partition by d.indicativo order by d.fecha) as interval " +\
+            f"from {source} where d.fecha like '____-__-__' and " +\
+            "julianday(d.fecha) is not null) " +\
+            "group by indicativo, interval"
 
-            
-    def to_db(self) :
+
+    @staticmethod
+    def __merged_intervals_select() -> str:
         """
-        Inserts the data in a database of type sqlite3
+        Select of the intervals of temp.coverage_new merging the intervals
+            that overlap or are contiguous: an interval starts a new one if
+            its first day is after the day that follows the last day of the
+            previous intervals
+        """
+        previous_last_day = "max(last_day) over (partition by indicativo " +\
+            "order by first_day, last_day rows between unbounded preceding " +\
+            "and 1 preceding)"
+        return "select indicativo, min(first_day), max(last_day) from " +\
+            "(select indicativo, first_day, last_day, sum(is_new) over " +\
+            "(partition by indicativo order by first_day, last_day rows " +\
+            "unbounded preceding) as interval from " +\
+            "(select indicativo, first_day, last_day, case when " +\
+            f"first_day <= {previous_last_day} + 1 then 0 else 1 end " +\
+            "as is_new from temp.coverage_new)) " +\
+            "group by indicativo, interval"
+
+
+    @staticmethod
+    def __day_number(value: date) -> int:
+        """
+        Days since 1970-01-01 of value
+        """
+        return value.toordinal() - date(1970, 1, 1).toordinal()
+
+
+    @staticmethod
+    def __day_date(day: int) -> date:
+        return date.fromordinal(day + date(1970, 1, 1).toordinal())
+
+
+    def missing_intervals(self, station: str, d1: Union[str, date]=None,
+                          d2: Union[str, date]=None) -> [(date, date)]:
+        """
+        Intervals of days of station between d1 and d2 without rows in the
+            data table, read from the coverage index (it is built or
+            updated if it is required, see coverage_index)
+
+        Parameters
+        ----------
+        station : Station (indicativo)
+        d1, d2 : optional. First and last date as date or 'YYYY-MM-DD'; if
+            None, the first and last date of station
 
         Returns
         -------
-        True if the task ends OK
+        List of tuples (first date, last date); if the station is not in
+            the index, [(d1, d2)]. If there is an error, []
+        """
+        try:
+            d1, d2 = [AOD_2db.__as_date(d) for d in (d1, d2)]
+        except ValueError as err:
+            logging.append(f'Not valid date: {err}')
+            return []
+        if not self.coverage_index():
+            return []
+        day1 = None if d1 is None else AOD_2db.__day_number(d1)
+        day2 = None if d2 is None else AOD_2db.__day_number(d2)
+        with self.__lock:
+            try:
+                intervals = self.__connection()\
+                    .execute(f"select first_day, last_day from "
+                             f"{self.__coverage_table()} where "
+                             "indicativo = ? and last_day >= ? and "
+                             "first_day <= ? order by first_day",
+                             (station, -2**62 if day1 is None else day1,
+                              2**62 if day2 is None else day2)).fetchall()
+            except sqlite3.Error as err:
+                logging.append(f'Error reading the coverage index\n{err}')
+                return []
+        if not intervals:
+            if day1 is None or day2 is None:
+                return []
+            return [(d1, d2)]
+        if day1 is None:
+            day1 = intervals[0][0]
+        if day2 is None:
+            day2 = intervals[-1][1]
+        missing = []
+        next_day = day1
+        for first_day, last_day in intervals:
+            if first_day > next_day:
+                missing.append((next_day, first_day - 1))
+            next_day = max(next_day, last_day + 1)
+        if next_day <= day2:
+            missing.append((next_day, day2))
+        return [(AOD_2db.__day_date(f), AOD_2db.__day_date(l)) \
+                for f, l in missing]
+
+
+    def coverage(self, d1: Union[str, date], d2: Union[str, date],
+                 min_coverage: float=0.) -> dict:
         """
+        Percentage of the days between d1 and d2 with rows in the data
+            table of the stations that have at least min_coverage, read
+            from the coverage index (it is built or updated if it is
+            required, see coverage_index)
 
-        files_of_type = {'data': True, 'metadata': True}
-        insert_data = {'data': True, 'metadata': True}
-        
-        for key in files_of_type:
-        
-            f_paths = self.__get_file_paths(key)
-            if not f_paths:
-                msg = f'No {key} files in '+\
-                    f'{self.dir_path} of type {self.file_type}'
-                logging.append(msg)
-                files_of_type[key] = False
-                continue
-    
-            headers = AOD_2db.__get_headers(f_paths)
-            
-            if not self.__create_table(headers, key):
-                insert_data[key] = False
-                continue
-        
-            if not self.__insert_unique(f_paths, key):
-                return False
-        
-            if key == 'data' and self.is_daily_file_type():
-                if not self.update_decimal_separator('.'):
-                    continue
-        
-        return True
+        Parameters
+        ----------
+        d1, d2 : First and last date as date or 'YYYY-MM-DD'
+        min_coverage : optional. Minimum percentage (0 - 100); the stations
+            without rows between d1 and d2 are never included
+
+        Returns
+        -------
+        A dictionary having the station as the key and the percentage as
+            the value, ordered by station; {} if there is an error
+        """
+        try:
+            d1, d2 = [AOD_2db.__as_date(d) for d in (d1, d2)]
+        except ValueError as err:
+            logging.append(f'Not valid date: {err}')
+            return {}
+        if d1 is None or d2 is None or d1 > d2:
+            logging.append('d1 and d2 must be dates and d1 <= d2')
+            return {}
+        if not self.coverage_index():
+            return {}
+        day1, day2 = [AOD_2db.__day_number(d) for d in (d1, d2)]
+        covered = "100. * sum(min(last_day, ?) - max(first_day, ?) + 1) / ?"
+        with self.__lock:
+            try:
+                rows = self.__connection()\
+                    .execute(f"select indicativo, {covered} from "
+                             f"{self.__coverage_table()} where "
+                             "last_day >= ? and first_day <= ? "
+                             f"group by indicativo having {covered} >= ? "
+                             "order by indicativo",
+                             (day2, day1, day2 - day1 + 1, day1, day2,
+                              day2, day1, day2 - day1 + 1, min_coverage))\
+                    .fetchall()
+            except sqlite3.Error as err:
+                logging.append(f'Error reading the coverage index\n{err}')
+                return {}
+        return dict(rows)
 
 
     def read_metadata_files(self) -> {}:
         """
-        Reads the metadata files and returns the characteristics of the columns
-            as a dictionary having the header id as the key 
+        Reads the metadata and returns the characteristics of the columns
+            as a dictionary having the header id as the key. The metadata
+            is read from the MetadataCache of the directory; if the file type
+            is not in the cache, the metadata files of the directory are read
 
         Returns
         -------
         column characteristics as a dictionary
 
         """
-        
+
+        columns = MetadataCache(self.dir_path).columns(self.file_type)
+        if columns:
+            return columns
+
         file_pattern = \
             AOD_2db.__FILE_PATTERNS[self.file_type].replace('_data',
                                                             '_metadata')
@@ -211,6 +2077,10 @@ class AOD_2db():
             the decimal separator using sql update
         The columns to be updated are selected from metadata of the downloaded
             csv files
+        to_db does not call this method because the values of the columns of
+            type float are converted to numbers as the rows are inserted; it
+            is only useful in databases created by previous versions, whose
+            columns are text
 
         Parameters
         ----------
@@ -250,103 +2120,180 @@ class AOD_2db():
         cols_ready = ', '.join(cols_set)
         stm = stm_template.format(table_name, cols_ready)
         
-        try:
-            conn = sqlite3.connect(dbpath)
-            cur = conn.cursor()            
-            cur.execute(stm)
-            conn.commit()
-            conn.close()
-            a = ', '.join(selected_cols)
-            print(f'Updated decimal separator as "{sep}" in columns: {a}')
-            return True
-        except Exception as err:
-            msg = f'Error updating the table {table_name}\n{err}'
-            logging.append(msg)
+        with self.__lock:
+            conn = self.__connection()
             try:
-                conn.close()
-            except:
-                pass
-            return False
+                cur = conn.cursor()            
+                cur.execute(stm)
+                conn.commit()
+                a = ', '.join(selected_cols)
+                print(f'Updated decimal separator as "{sep}" in columns: {a}')
+                return True
+            except Exception as err:
+                conn.rollback()
+                msg = f'Error updating the table {table_name}\n{err}'
+                logging.append(msg)
+                return False
         
 
-    def to_csv(self) -> bool:
+    def to_csv(self, csv_path: str=None, columns: [str]=None,
+               stations: Union[str, list]=None, d1: Union[str, date]=None,
+               d2: Union[str, date]=None, compression: str=None,
+               overwrite: bool=False) -> bool:
         """
-        Export the unique table db to a csv file
+        Export the unique table db to a csv file. The rows are read from the
+            database and written in batches of batch_size rows, so the
+            memory used does not depend on the size of the table. The file
+            is written with a temporary name and renamed at the end. In a
+            partitioned layout, only the partitions between d1 and d2 are
+            read, one after the other
+
+        Parameters
+        ----------
+        csv_path : optional. Path of the file; the default is the path of
+            the database with the suffix of compression (__CSV_SUFFIXES)
+        columns : optional. Columns to export; the default is all the columns
+        stations : optional. Station or list of stations to export; the
+            default is all the stations
+        d1, d2 : optional. First and last date to export, as in series
+        compression : optional. None, 'gzip' or 'zstd'; zstd requires the
+            package zstandard
+        overwrite : optional. If the file exists: True, it is overwritten;
+            False (default), it is not exported; None, the user is asked
 
         Returns
         -------
         bool. True if the task ends ok
 
         """
-        
-        select_template = 'select * from {}'
+        if compression not in AOD_2db.__CSV_SUFFIXES:
+            a = ', '.join([str(k) for k in AOD_2db.__CSV_SUFFIXES])
+            logging.append(f'compression must have a value in {a}')
+            return False
+        if compression == 'zstd' and zstandard is None:
+            logging.append('zstandard is required to export zstd files')
+            return False
 
         dbpath = self.get_default_dbpath()
         if not dbpath.exists():
             logging.append(f'{dbpath} does not exists')
             return False
         
-        csvpath = dbpath.with_suffix('.csv')
+        if csv_path is None:
+            csvpath = dbpath.with_suffix(AOD_2db.__CSV_SUFFIXES[compression])
+        else:
+            csvpath = pathlib.Path(csv_path)
         if csvpath.exists():
-            ans = input(f'\n{csvpath} exists, overwrite (y/n): ? ')
-            if ans.lower() != 'y':
+            if overwrite is None:
+                ans = input(f'\n{csvpath} exists, overwrite (y/n): ? ')
+                overwrite = ans.lower() == 'y'
+            if not overwrite:
+                logging.append(f'{csvpath} exists, it is not overwritten')
                 return False            
         
         table_name = AOD_2db.__DBTABLE[self.file_type]
-        select = select_template.format(table_name) 
-        column_names = self.__get_columns_names(dbpath, table_name)
+        column_names = self.__get_columns_names(table_name)
         if not column_names:
             return False
-
+        if columns is not None:
+            unknown = [c1 for c1 in columns if c1 not in column_names]
+            if unknown:
+                logging.append(f'Not columns of {table_name}: '
+                               f'{", ".join(unknown)}')
+                return False
+            column_names = list(columns)
+        if isinstance(stations, str):
+            stations = [stations]
         try:
-            conn = sqlite3.connect(dbpath)
-            cur = conn.cursor()
-            cur.execute(select)
-            data = cur.fetchall()
-            conn.close()
-        except sqlite3.Error as err:
-            msg = f'Sqlite error {err}' 
+            d1, d2 = [AOD_2db.__as_date(d) for d in (d1, d2)]
+        except ValueError as err:
+            logging.append(f'Not valid date: {err}')
+            return False
+        where, params, order = self.__where(stations, d1, d2)
+        select = f"select {', '.join(column_names)} from {{}}.{table_name}" +\
+            where
+        if where:
+            select += f" order by {order}"
+
+        part_path = csvpath.with_name(csvpath.name + '.part')
+        nrows = 0
+        try:
+            conn = self.__connection()
+            with AOD_2db.__open_csv(part_path, compression) as csv_file:
+                csv_writer = csv.writer(csv_file)
+                csv_writer.writerow(column_names)
+                for schema in self.__schemas(conn, d1, d2):
+                    cur = conn.cursor()
+                    cur.execute(select.format(schema), params)
+                    while True:
+                        rows = cur.fetchmany(self.batch_size)
+                        if not rows:
+                            break
+                        csv_writer.writerows(rows)
+                        nrows += len(rows)
+            os.replace(part_path, csvpath)
+        except (sqlite3.Error, OSError) as err:
+            msg = f'Error exporting {table_name}\n{err}' 
             logging.append(msg)
-            try:
-                conn.close()
-            except:
-                pass        
+            part_path.unlink(missing_ok=True)
             return False
-        
-        with open(csvpath, 'w', newline='', encoding='utf-8') as csv_file:
-            csv_writer = csv.writer(csv_file)
-            csv_writer.writerow(column_names)
-            csv_writer.writerows(data)
-        msg = f'Data dumped to\n{csvpath}'
+        msg = f'{nrows} rows dumped to\n{csvpath}'
         logging.append(msg)
         
         return True
 
 
     @staticmethod
-    def __get_columns_names(dbpath:pathlib.Path , table_name: str) -> [str]:
-        
-        select_template = "select * from {}"
+    def __open_csv(f_path: pathlib.Path, compression: str):
+        """
+        Opens f_path to write text with compression (see to_csv)
+        """
+        if compression == 'gzip':
+            return gzip.open(f_path, 'wt', newline='', encoding='utf-8')
+        if compression == 'zstd':
+            return zstandard.open(f_path, 'wt', newline='', encoding='utf-8')
+        return open(f_path, 'w', newline='', encoding='utf-8')
+
+
+    def numeric_columns(self) -> [str]:
+        """
+        Columns of the data table of type REAL or INTEGER, the variables
+            that can be loaded as arrays (see SeriesStore)
+        """
+        table_name = AOD_2db.__table_name(self.file_type, 'data')
+        try:
+            with self.__lock:
+                table_info = self.__connection()\
+                    .execute(f'PRAGMA table_info({table_name})').fetchall()
+        except sqlite3.Error as err:
+            logging.append(f'Sqlite error {err}')
+            return []
+        return [row[1] for row in table_info \
+                if row[2].lower() in ('real', 'integer')]
+
+
+    def data_file_paths(self) -> [pathlib.Path]:
+        """
+        Paths of the downloaded data files of file_type
+        """
+        return self.__get_file_paths('data')
+
+
+    def __get_columns_names(self, table_name: str) -> [str]:
+        """
+        Column names of table_name, read with PRAGMA table_info
+        """
         columns = []
-        
         try:
-            select = select_template.format(table_name)
-            conn = sqlite3.connect(dbpath)
-            cur = conn.cursor()
-            data = cur.execute(select)
-            columns = [col1[0] for col1 in data.description]
+            cur = self.__connection().cursor()
+            table_info = cur.execute(f"PRAGMA table_info({table_name})")
+            columns = [row[1] for row in table_info]
+            if not columns:
+                logging.append(f'Table {table_name} does not exists')
         except sqlite3.Error as err:
             msg = f'Sqlite error {err}' 
             logging.append(msg)
-        except Exception as err:
-            msg = f'Error {err}' 
-            logging.append(msg)
-        finally:
-            try:
-                conn.close()
-            except:
-                pass
-            return columns       
+        return columns       
 
 
     @staticmethod
@@ -395,12 +2342,15 @@ class AOD_2db():
     def __get_file_paths(self, key:str = 'data') -> [] :
         """
         Returns a list with the file paths of downloaded files of type
-            data or metadata
+            data or metadata. If the directory has a DownloadManifest the
+            files are looked up in it; otherwise the file names in the
+            directory are matched with the patterns in __FILE_PATTERNS
 
         Parameters
         ----------
         key, optional. If 'data' return data files, if 'atadata' metadata
-            files. The default is 'data'.
+            files, including the files in the MetadataCache. The default is
+            'data'.
 
         Returns
         -------
@@ -410,7 +2360,14 @@ class AOD_2db():
         if key not in ('data', 'metadata'):
             logging.append(f'Unexpected value for key: {key}')
             return []
-        
+
+        if DownloadManifest.exists(self.dir_path):
+            filtered_names = self.__get_file_paths_from_manifest(key)
+            if key == 'metadata':
+                filtered_names += \
+                    MetadataCache(self.dir_path).file_paths(self.file_type)
+            return filtered_names
+
         file_pattern = AOD_2db.__FILE_PATTERNS[self.file_type]
         if key == 'data':
             f_paths = self.dir_path.glob('*_data.csv')
@@ -421,20 +2378,66 @@ class AOD_2db():
         filtered_names = \
             [fp1 for fp1 in f_paths if \
              re.match(file_pattern, fp1.name)]
+        if key == 'metadata':
+            filtered_names += \
+                MetadataCache(self.dir_path).file_paths(self.file_type)
         return filtered_names
 
 
+    def __get_file_paths_from_manifest(self, key: str) -> [pathlib.Path]:
+        """
+        Returns the paths of the complete files of type self.file_type and
+            key registered in the manifest of the directory. The files that
+            were registered without type (downloaded before the manifest
+            existed) are classified first with the patterns in
+            __FILE_PATTERNS; this is made only once. Only csv files are
+            returned
+        """
+        manifest = DownloadManifest(self.dir_path)
+        try:
+            unclassified = manifest.unclassified_file_names()
+            if unclassified:
+                AOD_2db.__classify_files(manifest, unclassified)
+            file_names = manifest.file_names(self.file_type, key)
+        finally:
+            manifest.close()
+        f_paths = [self.dir_path.joinpath(fn1) for fn1 in file_names \
+                   if fn1.endswith('.csv')]
+        return [fp1 for fp1 in f_paths if fp1.exists()]
+
+
     @staticmethod
-    def __get_headers(file_paths: [str], sort:bool = True) -> [str]:
+    def __classify_files(manifest: DownloadManifest, file_names: [str]) \
+        -> None:
+        """
+        Sets the file type and key of file_names in manifest. Files that do
+            not match any pattern are set with empty type and key
+        """
+        pending = set(file_names)
+        for file_type, pattern in AOD_2db.__FILE_PATTERNS.items():
+            for key in ('data', 'metadata'):
+                if key == 'metadata':
+                    pattern = pattern.replace('_data', '_metadata')
+                matched = [fn1 for fn1 in pending if re.match(pattern, fn1)]
+                if matched:
+                    manifest.classify(matched, file_type, key)
+                    pending.difference_update(matched)
+        if pending:
+            manifest.classify(sorted(pending), '', '')
+
+
+    def __get_headers(self, file_paths: [pathlib.Path], key: str) -> [str]:
         """
         Let file_paths a list with CSV file paths, the function returns the
-            headers in the files without repetitions and optionally 
-            ordered by name
+            headers in the files without repetitions ordered by name. The
+            headers of a file are read from the table file_columns; the file
+            is only read if it is not in the table or its size or
+            modification time have changed
 
         Parameters
         ----------
-        csv_file_paths : List with CSV file paths
-        sort: If True headers will sorted. 
+        file_paths : List with CSV file paths
+        key : 'data' or 'metadata'
 
         Returns
         -------
@@ -442,18 +2445,57 @@ class AOD_2db():
 
         """
         all_headers = set()
-    
-        for file_path in file_paths:
-            with open(file_path, 'r', encoding='utf-8') as csv_file:
-                reader = csv.reader(csv_file)
-                headers = next(reader, None)
-                if headers:
-                    all_headers.update(headers)
-    
-        if sort:
-            return sorted(all_headers)
-        else:
-            return all_headers
+        with self.__lock:
+            cur = self.__connection().cursor()
+            self.__create_schema_table(cur)
+            registered = {row[0]: row[1:] for row in \
+                          cur.execute("select file_name, size, mtime, "
+                                      "columns from "
+                                      f"{AOD_2db.__SCHEMA_TABLE} "
+                                      "where key = ?", (key,))}
+        new_files = []
+        for fp1 in file_paths:
+            stat = fp1.stat()
+            previous = registered.get(self.__file_name(fp1))
+            if previous is not None and previous[0] == stat.st_size \
+                and previous[1] == stat.st_mtime:
+                headers = previous[2].split(',') if previous[2] else []
+            else:
+                with open(fp1, 'r', newline='', encoding='utf-8') \
+                    as csv_file:
+                    headers = next(csv.reader(csv_file), [])
+                new_files.append((fp1, headers))
+            all_headers.update(headers)
+        if new_files:
+            self.__register_headers(new_files, key)
+            self.__connection().commit()
+        return sorted(all_headers)
+
+
+    def __create_schema_table(self, cur: sqlite3.Cursor) -> None:
+        cur.execute(f"create table if not exists "
+                    f"{AOD_2db.__SCHEMA_TABLE} ("
+                    "file_name text primary key, key text, size integer, "
+                    "mtime real, columns text)")
+
+
+    def __register_headers(self, files: [(pathlib.Path, [str])],
+                           key: str) -> None:
+        """
+        Saves the headers of the files, given as tuples (path, headers), in
+            file_columns. The caller commits the transaction
+        """
+        rows = []
+        for fp1, headers in files:
+            stat = fp1.stat()
+            rows.append((self.__file_name(fp1), key, stat.st_size,
+                         stat.st_mtime, ','.join(headers)))
+        with self.__lock:
+            cur = self.__connection().cursor()
+            self.__create_schema_table(cur)
+            cur.executemany(f"insert or replace into "
+                            f"{AOD_2db.__SCHEMA_TABLE} "
+                            "values (?, ?, ?, ?, ?)", rows)
 
 
     @staticmethod
@@ -485,7 +2527,13 @@ class AOD_2db():
     def __create_table(self, headers: [str], 
                        table: str='data') -> bool:
         """
-        Create a table for data or metadata
+        Create a table for data or metadata if it does not exist; otherwise
+            the columns of headers that are not in the table are added (see
+            __add_columns). The types of the data columns are derived from
+            the metadata (see __get_column_types); a table with other types,
+            created by a previous version, is rebuilt with them (see
+            __retype_table). The indexes of a variable created by series in
+            previous versions are dropped
 
         Parameters
         ----------
@@ -498,43 +2546,47 @@ class AOD_2db():
 
         """
         
-        drop_table_template = "drop table if exists {}"
-        create_table_template = "create table if not exists '{}' ( {} );"
-        column_template = "{} text"
+        drop_index_template = "drop index if exists {}"
 
-        dbpath = self.get_default_dbpath()
         if table == 'data':
             table_name = AOD_2db.__DBTABLE[self.file_type]
         else:
             table_name = AOD_2db.__DBTABLE_METADATA[self.file_type]
 
-        columns = [column_template.format(h1) for h1 in headers]
-        columns = ', '.join(columns)
-
-        stm0 = drop_table_template.format(table_name)
-        stm = create_table_template.format(table_name, columns)
-        
         try:
-            conn = sqlite3.connect(dbpath)
+            conn = self.__connection()
             cur = conn.cursor()
-            cur.execute(stm0)
-            cur.execute(stm)
-            conn.close()
+            column_types = self.__table_column_types(cur, table)
+            AOD_2db.__add_columns(cur, table_name, headers, column_types)
+            AOD_2db.__retype_table(cur, table_name, column_types)
+            index_names = cur.execute("select name from sqlite_master "
+                                      "where type = 'index' and "
+                                      "tbl_name = ? and name like ?",
+                                      (table_name,
+                                       f'%{AOD_2db.__SERIES_INDEX}'))\
+                .fetchall()
+            for row in index_names:
+                cur.execute(drop_index_template.format(row[0]))
+            conn.commit()
             return True
         except Exception as err:
+            conn.rollback()
             msg = f'Error creating table {table_name}\n{err}'
             logging.append(msg)
-            try:
-                conn.close()
-            except:
-                pass
             return False
 
 
     def __insert_unique(self, f_paths: [pathlib.Path], key:str) -> bool:
         """
-        Insert data in f_paths in a Sqlite database. Only unique rows are
-            inserted
+        Insert data in f_paths in a Sqlite database. Only the first row of
+            each natural key is kept: the rows are inserted in the table
+            without indexes and then the unique index on the key is built,
+            deleting the repeated keys (see __create_key_index). The files
+            are read (see __parsed_files) and inserted in batches (see
+            __insert_rows). In a partitioned layout the partitions are
+            deleted and created again. The tables of
+            __PENDING_MONTHS_TABLES are dropped, so the aggregates and the
+            coverage index are computed again
 
         Parameters
         ----------
@@ -551,21 +2603,11 @@ class AOD_2db():
             logging.append(f'key has not a valid value: {key}')
             return False
  
-        TEMP_TABLE = 'tempt0'
-        copy_table_template = "create temp table if not exists " +\
-            "{} as select * from {} where 0;"
-        insert_template = "insert into {} ({}) values ({})" 
-        insert_from_select_template = "insert into {} ({}) {}"
-        select_template = "select distinct {} from {}"
-        
         dbpath = self.get_default_dbpath()
-        if key == 'data':
-            table_name = AOD_2db.__DBTABLE[self.file_type]
-        else:
-            table_name = AOD_2db.__DBTABLE_METADATA[self.file_type]
+        table_name = AOD_2db.__table_name(self.file_type, key)
 
+        conn = self.__connection()
         try:
-            conn = sqlite3.connect(dbpath)
             cur = conn.cursor()
             tables = \
                 cur.execute("select name from sqlite_master" 
@@ -577,49 +2619,43 @@ class AOD_2db():
             if table_name not in table_names:
                 logging.append(f'Table {table_name} does not exists')
                 return False
-            cur.execute(copy_table_template.format(TEMP_TABLE, table_name))
+            cur.execute(f"drop index if exists {table_name}_key")
             cur.execute(f"delete from {table_name}")
+            if key == 'data':
+                # the aggregates and the coverage index will be computed
+                #  again
+                for pending in AOD_2db.__PENDING_MONTHS_TABLES.values():
+                    cur.execute(f"drop table if exists {pending}")
+                # the rows that were not in files have been deleted
+                cur.execute("drop table if exists "
+                            f"{AOD_2db.__RECORDS_TABLE}")
+                if DownloadManifest.exists(self.dir_path):
+                    manifest = DownloadManifest(self.dir_path)
+                    manifest.remove_db_only(self.file_type)
+                    manifest.close()
             conn.commit()            
-
-            for i, fp1 in enumerate(f_paths):
+            if key == 'data' and self.partition is not None:
+                self.__remove_partitions(conn)
+            self.__touched_partitions.clear()
+            column_types = self.__table_column_types(cur, key)
+
+            self.__uncommitted_batches = 0
+            parsed_files = self.__parsed_files(f_paths, key, column_types)
+            for i, (fp1, headers, rows) in enumerate(parsed_files):
                 if self.verbose:
                     print(i, fp1.name)
-                headers = []
-                data = []                
-                with open(fp1, 'r', encoding='utf-8') as csv_file:
-                    csv_reader = csv.reader(csv_file)
-                    
-                    # Extract headers from the first row
-                    headers = next(csv_reader)
-                    column_names = ', '.join(headers)
-                    qs = ['?' for c1 in headers]
-                    qs = ', '.join(qs)
-                    insert_stm = insert_template.format(TEMP_TABLE, 
-                                                        column_names, qs)
-
-                    for row in csv_reader:
-                        data.append(row)      
-
-                cur.executemany(insert_stm, data)
-                conn.commit()
-
-            query = f"PRAGMA table_info({table_name})"
-            cur.execute(query)
-            table_info = cur.fetchall()
-            column_names = [c1[1] for c1 in table_info]
-            column_names = ', '.join(column_names)
-            
-            select = select_template.format(column_names, TEMP_TABLE)
-            insert = insert_from_select_template.format(table_name, column_names,
-                                                        select)
+                if not headers:
+                    continue
 
-            cur.execute(insert)
+                self.__insert_rows(conn, 'insert', table_name, key, headers,
+                                   rows, key_index=False)
+            AOD_2db.__create_key_index(cur, table_name, key)
+            for name in sorted(self.__touched_partitions):
+                schema = self.__partition_schema(conn, name, key_index=False)
+                AOD_2db.__create_key_index(cur, table_name, key, schema)
             conn.commit()
         except Exception as err:
-            try:
-                conn.close()
-            except:
-                pass
+            conn.rollback()
             traceback_entry = \
                 traceback.extract_tb(err.__traceback__)[-1]
             filename, lineno, name, line = traceback_entry            
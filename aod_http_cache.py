@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 16 16:40:12 2026
+
+@author: solis
+
+Persistent cache of the responses of the Aemet OpenData server.
+Each data request to Aemet is made in two stages: the first-stage response
+    is a descriptor with the urls of the data ('datos') and the metadata
+    ('metadatos'); the second-stage response is the payload. Historical
+    climatological data does not change, so the repetition of a request
+    (notebook sessions, downloads with overlapping periods) can be served
+    from the disk.
+"""
+import hashlib
+import json
+import pathlib
+import sqlite3
+from threading import Lock
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+import uuid
+
+import littleLogging as logging
+
+
+class ResponseCache():
+    """
+    The responses are saved as files in cache_dir; their index is the sqlite3
+        database index.db.
+    The key of a response is its url without the query parameter api_key.
+    The descriptors (first stage) and the payloads (second stage) have their
+        own time to live in days. A descriptor is valid while the payloads
+        requested with it are valid; its time to live only applies while
+        they are not in the cache. When the size of the saved responses
+        exceeds max_mb, the least recently used are deleted.
+    """
+
+    __INDEX_NAME = 'index.db'
+    __DESCRIPTOR = 'descriptor'
+    __PAYLOAD = 'payload'
+    # Keys of the urls of the payloads in a descriptor
+    __PAYLOAD_KEYS = ('datos', 'metadatos')
+    # Query parameters that are not part of the key
+    __EXCLUDED_PARAMS = ('api_key',)
+    __SECS_PER_DAY = 86400
+
+
+    def __init__(self, cache_dir: str, descriptor_ttl: float=30.,
+                 payload_ttl: float=365., max_mb: float=2048.):
+        """
+        Parameters
+        ----------
+        cache_dir : Directory of the cache, it is created if it does not
+            exist
+        descriptor_ttl : optional. Days a first-stage response is valid
+            when its payloads are not in the cache
+        payload_ttl : optional. Days a second-stage response is valid
+        max_mb : optional. Size budget of the cache in MB
+        """
+        self.dir_path: pathlib.Path = pathlib.Path(cache_dir)
+        self.dir_path.mkdir(parents=True, exist_ok=True)
+        self.ttl: dict = \
+            {ResponseCache.__DESCRIPTOR: descriptor_ttl * \
+                 ResponseCache.__SECS_PER_DAY,
+             ResponseCache.__PAYLOAD: payload_ttl * \
+                 ResponseCache.__SECS_PER_DAY}
+        self.max_bytes: int = int(max_mb * 1024 * 1024)
+        self.__lock = Lock()
+        self.__conn = sqlite3.connect\
+            (self.dir_path.joinpath(ResponseCache.__INDEX_NAME),
+             check_same_thread=False)
+        self.__conn.execute('create table if not exists responses ('
+                            'key text primary key, stage text, '
+                            'file text, size integer, created real, '
+                            'last_access real)')
+        self.__conn.execute('create index if not exists responses_access '
+                            'on responses (last_access)')
+        self.__conn.commit()
+
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__conn.close()
+
+
+    @staticmethod
+    def key(url: str, params: dict=None) -> str:
+        """
+        Key of a request: url with the query parameters sorted and without
+            the parameters in __EXCLUDED_PARAMS
+        """
+        parts = urlsplit(url)
+        query = parse_qsl(parts.query)
+        if params:
+            query += list(params.items())
+        query = sorted((k, v) for k, v in query \
+                       if k not in ResponseCache.__EXCLUDED_PARAMS)
+        return urlunsplit((parts.scheme, parts.netloc, parts.path,
+                           urlencode(query), ''))
+
+
+    @staticmethod
+    def stage(url: str) -> str:
+        """
+        The first-stage urls are those of the api; the rest are payloads
+        """
+        if '/opendata/api/' in url:
+            return ResponseCache.__DESCRIPTOR
+        return ResponseCache.__PAYLOAD
+
+
+    @staticmethod
+    def __file_name(key: str) -> str:
+        return hashlib.sha256(key.encode('utf-8')).hexdigest() + '.bin'
+
+
+    def __get_row(self, key: str, expire: bool=True):
+        """
+        Path of the file of the response key or None if it is not in the
+            cache; if expire is True the response is deleted when it is
+            older than the time to live of its stage
+        """
+        row = self.__conn.execute('select stage, file, created from '
+                                  'responses where key = ?',
+                                  (key,)).fetchone()
+        if row is None:
+            return None
+        stage, file_name, created = row
+        file_path = self.dir_path.joinpath(file_name)
+        if (expire and time.time() - created > self.ttl[stage]) or \
+            not file_path.exists():
+            self.__delete(key, file_name)
+            return None
+        return file_path
+
+
+    def get(self, url: str, params: dict=None,
+            payloads: [str]=__PAYLOAD_KEYS) -> bytes:
+        """
+        Returns the content of the saved response of url or None if it is not
+            in the cache or it has expired. A descriptor is only returned if
+            the responses of its urls in payloads ('datos', 'metadatos') are
+            also in the cache, because the payload urls of Aemet are
+            temporary (see get_path)
+        """
+        file_path = self.get_path(url, params, payloads)
+        if file_path is None:
+            return None
+        return file_path.read_bytes()
+
+
+    def get_path(self, url: str, params: dict=None,
+                 payloads: [str]=__PAYLOAD_KEYS) -> pathlib.Path:
+        """
+        As get, but it returns the path of the file with the content of the
+            response, so large responses can be read in chunks. A descriptor
+            is returned only if the responses of its urls of payloads, the
+            ones the caller will request, are in the cache, because its urls
+            are temporary and they can not be requested when it has been
+            saved for a while. While they are in the cache, the descriptor
+            does not expire
+        """
+        key = ResponseCache.key(url, params)
+        is_descriptor = ResponseCache.stage(url) == ResponseCache.__DESCRIPTOR
+        with self.__lock:
+            file_path = self.__get_row(key, expire=not is_descriptor)
+            if file_path is None:
+                return None
+            if is_descriptor:
+                urls = ResponseCache.__payload_urls(file_path.read_bytes(),
+                                                    payloads)
+                if any(self.__get_row(ResponseCache.key(u1)) is None \
+                       for u1 in urls):
+                    # it is deleted if it has expired
+                    self.__get_row(key)
+                    return None
+            self.__conn.execute('update responses set last_access = ? '
+                                'where key = ?', (time.time(), key))
+            self.__conn.commit()
+        return file_path
+
+
+    @staticmethod
+    def __payload_urls(content: bytes, payloads: [str]) -> [str]:
+        """
+        Urls of the payloads of a descriptor whose keys are in payloads
+        """
+        try:
+            data = json.loads(content.decode('ISO-8859-15'))
+        except ValueError:
+            return []
+        if not isinstance(data, dict):
+            return []
+        return [data[k] for k in payloads if data.get(k)]
+
+
+    def put(self, url: str, content: bytes, params: dict=None) -> None:
+        """
+        Saves the content of the response of url and deletes the least
+            recently used responses if the cache exceeds its size budget
+        """
+        tmp_path = self.temp_path()
+        tmp_path.write_bytes(content)
+        self.put_file(url, tmp_path, params)
+
+
+    def temp_path(self) -> pathlib.Path:
+        """
+        Returns a new path in the cache directory where a response can be
+            written in chunks before it is saved with put_file
+        """
+        return self.dir_path.joinpath(f'{uuid.uuid4().hex}.tmp')
+
+
+    def put_file(self, url: str, tmp_path: pathlib.Path,
+                 params: dict=None) -> None:
+        """
+        As put, but the content of the response is in the file tmp_path
+            (see temp_path), which is moved to the cache
+        """
+        key = ResponseCache.key(url, params)
+        file_name = ResponseCache.__file_name(key)
+        file_path = self.dir_path.joinpath(file_name)
+        size = tmp_path.stat().st_size
+        now = time.time()
+        with self.__lock:
+            tmp_path.replace(file_path)
+            self.__conn.execute('insert or replace into responses '
+                                'values (?, ?, ?, ?, ?, ?)',
+                                (key, ResponseCache.stage(url), file_name,
+                                 size, now, now))
+            self.__conn.commit()
+            self.__evict()
+
+
+    def __delete(self, key: str, file_name: str) -> None:
+        self.__conn.execute('delete from responses where key = ?', (key,))
+        self.__conn.commit()
+        self.dir_path.joinpath(file_name).unlink(missing_ok=True)
+
+
+    def __evict(self) -> None:
+        total = self.__conn.execute('select coalesce(sum(size), 0) '
+                                    'from responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        cur = self.__conn.execute('select key, file, size from responses '
+                                  'order by last_access')
+        to_delete = []
+        for key, file_name, size in cur:
+            if total <= self.max_bytes:
+                break
+            to_delete.append((key, file_name))
+            total -= size
+        for key, file_name in to_delete:
+            self.__delete(key, file_name)
+        logging.append(f'{len(to_delete)} responses evicted from the cache',
+                       False)
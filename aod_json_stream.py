@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 12:05:48 2026
+
+@author: solis
+
+Incremental parser of the json responses of Aemet OpenData. The data
+    responses are arrays of objects (a row per station and date) that can
+    be large in the requests of all the stations; the parser yields the
+    objects as the chunks of the response arrive, so the whole response is
+    never held in memory.
+"""
+import codecs
+import json
+
+
+__WHITESPACE = ' \t\n\r'
+__SEPARATORS = ' \t\n\r,'
+
+
+def first_char(chunk: bytes) -> str:
+    """
+    Returns the first character of a json document that is not whitespace
+        or '' if chunk has only whitespace. It allows to know if a response
+        is an array '[' or an object '{' reading only its first chunk
+    """
+    text = chunk.lstrip(b' \t\n\r')
+    return chr(text[0]) if text else ''
+
+
+def iter_json_array(chunks, encoding: str='ISO-8859-15'):
+    """
+    Yields the elements of a json array whose text arrives in chunks
+
+    Parameters
+    ----------
+    chunks : Iterable of bytes, the json document split in any way
+    encoding : optional. Encoding of the bytes, the default is that of Aemet
+
+    Raises
+    ------
+    ValueError if the document is not an array or it is incomplete
+
+    Yields
+    ------
+    The elements of the array
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(encoding)()
+    buf = ''
+    pos = 0
+    started = False
+    for chunk in chunks:
+        buf = buf[pos:] + text_decoder.decode(chunk)
+        pos = 0
+        n = len(buf)
+        while True:
+            skip = __WHITESPACE if not started else __SEPARATORS
+            while pos < n and buf[pos] in skip:
+                pos += 1
+            if pos >= n:
+                break
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError('The json document is not an array')
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            try:
+                element, pos_end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # the element is not complete, wait for the next chunk
+                break
+            yield element
+            pos = pos_end
+    raise ValueError('Incomplete json array')
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 18:02:41 2026
+
+@author: solis
+
+Pool of api keys of Aemet OpenData. The rate limit of Aemet applies to
+    each api key, so a user with several keys can make more requests per
+    minute spreading them over the keys.
+Each key has its own TokenBucket; the pool gives the next request a key
+    with a token available, starting each time with a different key. A key
+    whose requests are persistently rejected as unauthorized (401) is put in
+    quarantine, and a download only fails when all the keys are in
+    quarantine.
+"""
+import hashlib
+from threading import Lock
+import time
+
+import littleLogging as logging
+from aod_rate_limiter import TokenBucket
+
+
+class ApiKeyPool():
+    """
+    acquire() returns a key with a token available, waiting for the first
+        key that will have one; block(key, secs) applies a Retry-After to a
+        key; unauthorized(key) and authorized(key) report the result of a
+        request made with key
+    """
+
+    # Consecutive 401 responses that put a key in quarantine
+    __MAX_UNAUTHORIZED = 3
+    __QUARANTINE_SECS = 3600.
+
+
+    def __init__(self, keys: [str], requests_per_minute: float,
+                 capacity: int=1, lock_file: str=None):
+        """
+        Parameters
+        ----------
+        keys : Api keys; blank and repeated keys are ignored
+        requests_per_minute : Maximum rate of requests of each key
+        capacity : optional. Burst of requests of each key
+        lock_file : optional. If not None, the rate limits are shared by all
+            the processes that use this lock file (see TokenBucket); with
+            several keys, each key has its own file with a suffix
+        """
+        keys = list(dict.fromkeys([k.strip() for k in keys if k.strip()]))
+        if not keys:
+            msg = 'No api keys'
+            logging.append(msg)
+            raise ValueError(msg)
+        self.keys: [str] = keys
+        self.__buckets = \
+            {k: TokenBucket.shared(k, requests_per_minute, capacity,
+                                   ApiKeyPool.__key_lock_file(lock_file, k,
+                                                              len(keys))) \
+             for k in keys}
+        self.__unauthorized = {k: 0 for k in keys}
+        self.__quarantined_until = {k: 0. for k in keys}
+        self.__next = 0
+        self.__lock = Lock()
+
+
+    @staticmethod
+    def __key_lock_file(lock_file: str, key: str, n_keys: int) -> str:
+        if lock_file is None or n_keys == 1:
+            return lock_file
+        suffix = hashlib.sha256(key.encode('utf-8')).hexdigest()[:12]
+        return f'{lock_file}.{suffix}'
+
+
+    @staticmethod
+    def masked(key: str) -> str:
+        """
+        Key as it is shown in the messages
+        """
+        return '...' + key[-6:]
+
+
+    def __active_keys(self) -> [str]:
+        """
+        Keys that are not in quarantine; the first key is a different one
+            in each call
+        """
+        now = time.time()
+        with self.__lock:
+            start = self.__next
+            self.__next = (start + 1) % len(self.keys)
+            keys = self.keys[start:] + self.keys[:start]
+            return [k for k in keys if self.__quarantined_until[k] <= now]
+
+
+    def acquire(self) -> str:
+        """
+        Takes a token of a key, waiting until a key has one
+
+        Returns
+        -------
+        The key or None if all the keys are in quarantine
+        """
+        while True:
+            keys = self.__active_keys()
+            if not keys:
+                return None
+            wait = None
+            for k in keys:
+                key_wait = self.__buckets[k].try_acquire()
+                if key_wait == 0.:
+                    return k
+                wait = key_wait if wait is None else min(wait, key_wait)
+            time.sleep(wait)
+
+
+    def block(self, key: str, seconds: float) -> None:
+        """
+        key will not be used in the next seconds
+        """
+        self.__buckets[key].block(seconds)
+
+
+    def authorized(self, key: str) -> None:
+        """
+        A request made with key has been accepted
+        """
+        with self.__lock:
+            self.__unauthorized[key] = 0
+
+
+    def unauthorized(self, key: str) -> None:
+        """
+        A request made with key has been rejected as unauthorized (401). After
+            __MAX_UNAUTHORIZED consecutive rejections the key is put in
+            quarantine for __QUARANTINE_SECS seconds
+        """
+        with self.__lock:
+            self.__unauthorized[key] += 1
+            if self.__unauthorized[key] < ApiKeyPool.__MAX_UNAUTHORIZED:
+                return
+            self.__unauthorized[key] = 0
+            self.__quarantined_until[key] = \
+                time.time() + ApiKeyPool.__QUARANTINE_SECS
+        logging.append(f'Api key {ApiKeyPool.masked(key)} is unauthorized, '
+                       'it will not be used in the next '
+                       f'{ApiKeyPool.__QUARANTINE_SECS / 60:0.0f} minutes')
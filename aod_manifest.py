@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 09:12:33 2026
+
+@author: solis
+
+Manifest of the files downloaded from Aemet OpenData. It is a sqlite3
+    database saved in the download directory with a row per file: the
+    request (url, station, period), its status and the size, number of
+    rows and checksum of the saved file.
+The manifest replaces the search of the file names in the directory: the
+    decision of downloading a file again and the discovery of the files to
+    be inserted in a database (AOD_2db) are indexed lookups.
+The sink of a request is where its rows were saved: 'csv' (the file),
+    'db' (directly in the database of AOD_2db, there is no file) or 'both'.
+"""
+from datetime import datetime
+import hashlib
+import pathlib
+import sqlite3
+from threading import Lock
+
+import littleLogging as logging
+
+
+class DownloadManifest():
+    """
+    Status of a file in the manifest:
+        'pending': the file is being saved; if the process stops, the file
+            is incomplete
+        'ok': the file has been saved
+        'legacy': the file was found in the directory without a download
+            record (it was saved before the manifest existed, by a previous
+            version or copied to the directory); its size is known but not
+            its contents
+    A file is complete if its status is 'ok' or 'legacy' and its size is
+        the size in the manifest; if it was saved only in the database (sink
+        'db') there is no file to check
+    """
+
+    DB_NAME = 'aod_manifest.db'
+    __COMPLETE = ('ok', 'legacy')
+    __SINKS_CSV = ('csv', 'both')
+    __SINKS_DB = ('db', 'both')
+    __HASH_BLOCK_SIZE = 1024 * 1024
+
+
+    def __init__(self, d_path: str):
+        """
+        Opens the manifest of the directory d_path, which is created if it
+            does not exist. The csv files in d_path that are not in the
+            manifest are registered as legacy files
+
+        Parameters
+        ----------
+        d_path : Download directory
+        """
+        self.dir_path: pathlib.Path = pathlib.Path(d_path)
+        self.db_path: pathlib.Path = \
+            self.dir_path.joinpath(DownloadManifest.DB_NAME)
+        self.__lock = Lock()
+        self.__conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.__conn.execute('create table if not exists downloads ('
+                            'file_name text primary key, file_type text, '
+                            'kind text, url text, station text, '
+                            'period_start text, period_end text, '
+                            'status text, size integer, nrows integer, '
+                            'sha256 text, downloaded_at text, '
+                            'sink text)')
+        self.__add_sink_column()
+        self.__conn.execute('create index if not exists downloads_type on '
+                            'downloads (file_type, kind, status)')
+        self.__conn.commit()
+        self.__register_legacy_files()
+
+
+    def __add_sink_column(self) -> None:
+        """
+        The manifests created before the column sink existed are updated;
+            their files were saved as csv
+        """
+        columns = [row[1] for row in \
+                   self.__conn.execute('pragma table_info(downloads)')]
+        if 'sink' not in columns:
+            self.__conn.execute('alter table downloads add column sink text')
+
+
+    @staticmethod
+    def exists(d_path: str) -> bool:
+        """
+        True if the directory d_path has a manifest
+        """
+        return pathlib.Path(d_path).joinpath(DownloadManifest.DB_NAME)\
+            .exists()
+
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__conn.close()
+
+
+    def __register_legacy_files(self) -> None:
+        """
+        Registers as legacy the csv files of the directory that are not in
+            the manifest
+        """
+        rows = []
+        for fp1 in self.dir_path.glob('*.csv'):
+            rows.append((fp1.name, 'legacy', fp1.stat().st_size))
+        if not rows:
+            return
+        with self.__lock:
+            changes = self.__conn.total_changes
+            self.__conn.executemany('insert or ignore into downloads '
+                                    '(file_name, status, size) '
+                                    'values (?, ?, ?)', rows)
+            self.__conn.commit()
+            n_new = self.__conn.total_changes - changes
+        if n_new:
+            logging.append(f'{n_new} files not downloaded with the manifest '
+                           f'registered in {self.db_path.name}')
+
+
+    def is_complete(self, file_name: str, sink: str='csv') -> bool:
+        """
+        True if file_name has been completely downloaded and saved in sink
+        """
+        with self.__lock:
+            row = self.__conn.execute('select status, size, '
+                                      "coalesce(sink, 'csv') from downloads "
+                                      'where file_name = ?',
+                                      (file_name,)).fetchone()
+        if row is None or row[0] not in DownloadManifest.__COMPLETE:
+            return False
+        if sink in DownloadManifest.__SINKS_DB and \
+            row[2] not in DownloadManifest.__SINKS_DB:
+            return False
+        if sink not in DownloadManifest.__SINKS_CSV:
+            return True
+        if row[2] not in DownloadManifest.__SINKS_CSV:
+            return False
+        file_path = self.dir_path.joinpath(file_name)
+        try:
+            return file_path.stat().st_size == row[1]
+        except OSError:
+            return False
+
+
+    def start(self, file_name: str, file_type: str, kind: str, url: str,
+              station: str=None, period: [str]=(None, None),
+              sink: str='csv') -> None:
+        """
+        Registers file_name as 'pending' before it is saved
+
+        Parameters
+        ----------
+        file_name : file name in the download directory
+        file_type : endpoint type, see AOD_2db file types
+        kind : 'data' or 'metadata'
+        url : first-stage url of the request
+        station : station identifier in requests of selected stations
+        period : first and last date (or year) of the request
+        sink : 'csv', 'db' or 'both'
+        """
+        with self.__lock:
+            self.__conn.execute('insert or replace into downloads '
+                                '(file_name, file_type, kind, url, station, '
+                                'period_start, period_end, status, sink) '
+                                'values (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                (file_name, file_type, kind, url, station,
+                                 period[0], period[1], 'pending', sink))
+            self.__conn.commit()
+
+
+    def complete(self, file_name: str, nrows: int) -> None:
+        """
+        Sets file_name as 'ok' and saves its size, number of rows and
+            checksum; if the rows were saved only in the database, the file
+            does not exist and its size and checksum are null
+        """
+        file_path = self.dir_path.joinpath(file_name)
+        size, sha256 = None, None
+        if file_path.exists():
+            size = file_path.stat().st_size
+            sha256 = DownloadManifest.__checksum(file_path)
+        now = datetime.now().isoformat(timespec='seconds')
+        with self.__lock:
+            self.__conn.execute('update downloads set status = ?, size = ?, '
+                                'nrows = ?, sha256 = ?, downloaded_at = ? '
+                                'where file_name = ?',
+                                ('ok', size, nrows, sha256, now, file_name))
+            self.__conn.commit()
+
+
+    @staticmethod
+    def __checksum(file_path: pathlib.Path) -> str:
+        h = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(DownloadManifest.__HASH_BLOCK_SIZE),
+                              b''):
+                h.update(block)
+        return h.hexdigest()
+
+
+    def file_names(self, file_type: str, kind: str='data') -> [str]:
+        """
+        Names of the complete files of file_type and kind; the requests
+            saved only in the database are excluded
+        """
+        with self.__lock:
+            rows = self.__conn.execute('select file_name from downloads '
+                                       'where file_type = ? and kind = ? '
+                                       'and status in (?, ?) '
+                                       "and coalesce(sink, 'csv') != 'db' "
+                                       'order by file_name',
+                                       (file_type, kind,
+                                        *DownloadManifest.__COMPLETE))\
+                .fetchall()
+        return [row[0] for row in rows]
+
+
+    def db_only_file_names(self, file_type: str, kind: str='data') -> [str]:
+        """
+        Names of the complete requests of file_type and kind whose rows were
+            saved only in the database (sink 'db'); there is no file with
+            their rows
+        """
+        with self.__lock:
+            rows = self.__conn.execute('select file_name from downloads '
+                                       'where file_type = ? and kind = ? '
+                                       'and status in (?, ?) '
+                                       "and sink = 'db' "
+                                       'order by file_name',
+                                       (file_type, kind,
+                                        *DownloadManifest.__COMPLETE))\
+                .fetchall()
+        return [row[0] for row in rows]
+
+
+    def remove_db_only(self, file_type: str) -> None:
+        """
+        Removes the requests of file_type saved only in the database, after
+            their rows have been deleted from it, so they are downloaded
+            again
+        """
+        with self.__lock:
+            self.__conn.execute("delete from downloads where file_type = ? "
+                                "and sink = 'db'", (file_type,))
+            self.__conn.commit()
+
+
+    def unclassified_file_names(self) -> [str]:
+        """
+        Names of the legacy files whose type and kind are unknown
+        """
+        with self.__lock:
+            rows = self.__conn.execute('select file_name from downloads '
+                                       'where file_type is null').fetchall()
+        return [row[0] for row in rows]
+
+
+    def classify(self, file_names: [str], file_type: str, kind: str) -> None:
+        """
+        Sets the file type and kind of legacy files
+        """
+        with self.__lock:
+            self.__conn.executemany('update downloads set file_type = ?, '
+                                    'kind = ? where file_name = ?',
+                                    [(file_type, kind, fn1) \
+                                     for fn1 in file_names])
+            self.__conn.commit()
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 16 10:02:41 2026
+
+@author: solis
+
+The metadata of a request to Aemet OpenData (the key 'campos' of the
+    'metadatos' response) is the same for every period and station of a
+    given endpoint. MetadataCache keeps a single copy of it per endpoint
+    type, identified by the hash of its content, so the metadata is
+    downloaded once per endpoint and revalidated after __MAX_AGE_DAYS.
+"""
+import csv
+from datetime import datetime, timedelta
+import hashlib
+import json
+import os
+import pathlib
+from threading import Lock
+
+import littleLogging as logging
+
+
+class MetadataCache():
+    """
+    Metadata cache saved in the subdirectory __DIR_NAME of the download
+        directory:
+        index.json: for each endpoint type, the hash of the current
+            metadata, the name of the file and the date of the last check
+        {endpoint}_{hash}_metadata.csv: the column descriptions ('campos'),
+            with the same format as the metadata files saved by
+            AemetOpenData
+    Endpoint types are the file types of AOD_2db: 'stations_day',
+        'station1_day' and 'station1_month'
+    """
+
+    __DIR_NAME = 'metadata_cache'
+    __INDEX_NAME = 'index.json'
+    __FILE_NAME_TEMPLATE = '{}_{}_metadata.csv'
+    __HASH_LENGTH = 12
+    # Metadata older than this number of days is downloaded again
+    __MAX_AGE_DAYS = 30
+
+
+    def __init__(self, d_path: str):
+        """
+        Parameters
+        ----------
+        d_path : Download directory. The cache directory is created on demand
+        """
+        self.dir_path: pathlib.Path = \
+            pathlib.Path(d_path).joinpath(MetadataCache.__DIR_NAME)
+        self.__lock = Lock()
+        self.__pending = set()
+        self.__index = self.__read_index()
+
+
+    def __index_path(self) -> pathlib.Path:
+        return self.dir_path.joinpath(MetadataCache.__INDEX_NAME)
+
+
+    def __read_index(self) -> dict:
+        index_path = self.__index_path()
+        if not index_path.exists():
+            return {}
+        try:
+            with open(index_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as err:
+            logging.append(f'Metadata cache index not readable: {err}')
+            return {}
+
+
+    def __write_index(self) -> None:
+        index_path = self.__index_path()
+        tmp_path = index_path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.__index, f, indent=1)
+        os.replace(tmp_path, index_path)
+
+
+    def is_fresh(self, endpoint: str) -> bool:
+        """
+        True if the metadata of endpoint is in the cache and it has been
+            checked in the last __MAX_AGE_DAYS days
+        """
+        entry = self.__index.get(endpoint)
+        if entry is None:
+            return False
+        if not self.dir_path.joinpath(entry['file']).exists():
+            return False
+        checked = datetime.fromisoformat(entry['checked'])
+        max_age = timedelta(days=MetadataCache.__MAX_AGE_DAYS)
+        return datetime.now() - checked < max_age
+
+
+    def expire(self, endpoint: str) -> None:
+        """
+        The metadata of endpoint will be downloaded again in the next request
+        """
+        with self.__lock:
+            entry = self.__index.get(endpoint)
+            if entry is not None:
+                entry['checked'] = datetime.min.isoformat()
+
+
+    def claim(self, endpoint: str) -> bool:
+        """
+        Returns True if the caller must download the metadata of endpoint:
+            the metadata is not fresh and no other thread is downloading it.
+            The claim ends with put or release
+        """
+        with self.__lock:
+            if endpoint in self.__pending or self.is_fresh(endpoint):
+                return False
+            self.__pending.add(endpoint)
+            return True
+
+
+    def release(self, endpoint: str) -> None:
+        """
+        Ends a claim without saving metadata (the download failed)
+        """
+        with self.__lock:
+            self.__pending.discard(endpoint)
+
+
+    def put(self, endpoint: str, data: dict) -> pathlib.Path:
+        """
+        Saves the metadata response of endpoint. If its content is already
+            in the cache only the date of the check is updated
+
+        Parameters
+        ----------
+        endpoint : endpoint type
+        data : 'metadatos' response of Aemet in json format
+
+        Returns
+        -------
+        Path of the metadata file
+        """
+        campos = data.get('campos', []) if isinstance(data, dict) else []
+        content = json.dumps(campos, sort_keys=True, ensure_ascii=False)
+        content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        content_hash = content_hash[:MetadataCache.__HASH_LENGTH]
+        file_name = MetadataCache.__FILE_NAME_TEMPLATE.format(endpoint,
+                                                              content_hash)
+        file_path = self.dir_path.joinpath(file_name)
+
+        with self.__lock:
+            self.dir_path.mkdir(exist_ok=True)
+            if not file_path.exists():
+                MetadataCache.__write_campos(file_path, campos)
+                logging.append(f'New metadata for {endpoint}: {file_name}')
+            self.__index[endpoint] = {'hash': content_hash,
+                                      'file': file_name,
+                                      'checked': datetime.now().isoformat()}
+            self.__write_index()
+            self.__pending.discard(endpoint)
+        return file_path
+
+
+    @staticmethod
+    def __write_campos(file_path: pathlib.Path, campos: [dict]) -> None:
+        unique_keys = set()
+        for dict1 in campos:
+            unique_keys.update(dict1.keys())
+        header = sorted(unique_keys)
+        with open(file_path, 'w', newline='', encoding='utf-8') as csvfile:
+            csvwriter = csv.writer(csvfile)
+            csvwriter.writerow(header)
+            for dict1 in campos:
+                csvwriter.writerow([dict1.get(h1, '') for h1 in header])
+
+
+    def file_path(self, endpoint: str) -> pathlib.Path:
+        """
+        Path of the current metadata file of endpoint or None
+        """
+        entry = self.__index.get(endpoint)
+        if entry is None:
+            return None
+        return self.dir_path.joinpath(entry['file'])
+
+
+    def file_paths(self, endpoint: str) -> [pathlib.Path]:
+        """
+        Paths of all the metadata files of endpoint in the cache, including
+            previous versions of the metadata
+        """
+        if not self.dir_path.exists():
+            return []
+        pattern = MetadataCache.__FILE_NAME_TEMPLATE.format(endpoint, '*')
+        return sorted(self.dir_path.glob(pattern))
+
+
+    def columns(self, endpoint: str) -> dict:
+        """
+        Characteristics of the columns in the current metadata of endpoint
+            as a dictionary having the column id as the key and a list
+            [descripcion, tipo_datos, requerido] as the value. Empty if
+            endpoint is not in the cache
+        """
+        file_path = self.file_path(endpoint)
+        if file_path is None or not file_path.exists():
+            return {}
+        columns = {}
+        with open(file_path, 'r', newline='', encoding='utf-8') as csvfile:
+            reader = csv.DictReader(csvfile)
+            for row in reader:
+                columns[row['id']] = [row['descripcion'], row['tipo_datos'],
+                                      row['requerido']]
+        return columns
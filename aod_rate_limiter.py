@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 16 12:27:05 2026
+
+@author: solis
+
+Client-side rate limiter for the requests to Aemet OpenData. Aemet limits
+    the number of requests per minute of each api key; when the limit is
+    exceeded the server answers 429 and the client has to wait, usually
+    for the number of seconds in the header Retry-After.
+A TokenBucket is filled with requests_per_minute tokens per minute up to
+    its capacity; each request takes a token, so the requests are spaced
+    out before the server rejects them.
+The buckets are shared by all the threads of the process (TokenBucket.shared)
+    and, optionally, by several processes through a lock file that stores
+    the state of the bucket.
+"""
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+import json
+import os
+import pathlib
+from threading import Lock
+import time
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+import littleLogging as logging
+
+
+class TokenBucket():
+    """
+    Token bucket. acquire() blocks until a token is available; block(secs)
+        empties the bucket for secs seconds (Retry-After)
+    """
+
+    # Buckets shared in the process, the key is the name of the bucket
+    __registry = {}
+    __registry_lock = Lock()
+
+
+    def __init__(self, requests_per_minute: float, capacity: int=1,
+                 lock_file: str=None):
+        """
+        Parameters
+        ----------
+        requests_per_minute : Tokens added to the bucket per minute
+        capacity : Maximum number of tokens in the bucket (burst of requests)
+        lock_file : optional. If not None, the state of the bucket is saved in
+            this file and shared by all the processes that use it
+        """
+        if requests_per_minute <= 0 or capacity < 1:
+            msg = 'requests_per_minute must be > 0 and capacity >= 1'
+            logging.append(msg)
+            raise ValueError(msg)
+        self.rate: float = requests_per_minute / 60.
+        self.capacity: int = capacity
+        self.lock_file: pathlib.Path = \
+            None if lock_file is None else pathlib.Path(lock_file)
+        self.__lock = Lock()
+        self.__state = {'tokens': float(capacity), 'stamp': time.time(),
+                        'blocked_until': 0.}
+
+
+    @classmethod
+    def shared(cls, name: str, requests_per_minute: float, capacity: int=1,
+               lock_file: str=None):
+        """
+        Returns the bucket name of the process; it is created the first time
+            it is requested. The next requests must have the same rate,
+            capacity and lock file, otherwise ValueError is raised, so a
+            bucket is not used with a rate other than the requested one
+        """
+        with cls.__registry_lock:
+            bucket = cls.__registry.get(name)
+            if bucket is None:
+                bucket = cls(requests_per_minute, capacity, lock_file)
+                cls.__registry[name] = bucket
+                return bucket
+            lock_file = None if lock_file is None else pathlib.Path(lock_file)
+            if bucket.rate != requests_per_minute / 60. or \
+                bucket.capacity != capacity or bucket.lock_file != lock_file:
+                # the name is not logged, it can be an api key
+                msg = 'The shared bucket exists with ' +\
+                    f'{bucket.rate * 60.:g} requests per minute, capacity ' +\
+                    f'{bucket.capacity} and lock file {bucket.lock_file}'
+                logging.append(msg)
+                raise ValueError(msg)
+            return bucket
+
+
+    @contextmanager
+    def __state_locked(self):
+        """
+        Locks the state of the bucket in the process and, if there is a lock
+            file, between processes. Yields the state as a dict
+        """
+        with self.__lock:
+            if self.lock_file is None:
+                yield self.__state
+                return
+            with open(self.lock_file, 'a+b') as f:
+                TokenBucket.__flock(f)
+                try:
+                    f.seek(0)
+                    content = f.read()
+                    if content:
+                        try:
+                            self.__state = json.loads(content)
+                        except ValueError:
+                            pass
+                    yield self.__state
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(self.__state).encode('utf-8'))
+                    f.flush()
+                finally:
+                    TokenBucket.__funlock(f)
+
+
+    @staticmethod
+    def __flock(f) -> None:
+        if os.name == 'nt':
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    return
+                except OSError:
+                    time.sleep(0.05)
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+
+    @staticmethod
+    def __funlock(f) -> None:
+        if os.name == 'nt':
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+    def __refill(self, state: dict, now: float) -> None:
+        """
+        Adds the tokens of the time elapsed since the last refill; while the
+            bucket is blocked (see block) no tokens are added
+        """
+        if now < state['blocked_until']:
+            return
+        elapsed = max(0., now - state['stamp'])
+        state['tokens'] = min(self.capacity,
+                              state['tokens'] + elapsed * self.rate)
+        state['stamp'] = now
+
+
+    def try_acquire(self) -> float:
+        """
+        Takes a token from the bucket if one is available, without waiting
+
+        Returns
+        -------
+        0. if a token has been taken; otherwise, the seconds until the next
+            token will be available
+        """
+        with self.__state_locked() as state:
+            now = time.time()
+            self.__refill(state, now)
+            if now < state['blocked_until']:
+                return state['blocked_until'] - now
+            if state['tokens'] >= 1.:
+                state['tokens'] -= 1.
+                return 0.
+            return (1. - state['tokens']) / self.rate
+
+
+    def acquire(self) -> float:
+        """
+        Takes a token from the bucket, waiting until one is available
+
+        Returns
+        -------
+        Seconds waited
+        """
+        waited = 0.
+        while True:
+            wait = self.try_acquire()
+            if wait == 0.:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+
+    def block(self, seconds: float) -> None:
+        """
+        No token will be available in the next seconds; after them the bucket
+            starts empty
+        """
+        with self.__state_locked() as state:
+            now = time.time()
+            state['blocked_until'] = max(state['blocked_until'],
+                                         now + seconds)
+            state['tokens'] = 0.
+            state['stamp'] = state['blocked_until']
+
+
+    @staticmethod
+    def retry_after_seconds(value: str, default: float) -> float:
+        """
+        Converts the value of the header Retry-After (seconds or http date)
+            to seconds. If value is None or it is not valid, returns default
+        """
+        if not value:
+            return default
+        try:
+            return max(0., float(value))
+        except ValueError:
+            pass
+        try:
+            retry_date = parsedate_to_datetime(value)
+            return max(0., retry_date.timestamp() - time.time())
+        except (TypeError, ValueError):
+            return default
@@ -0,0 +1,604 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:14:27 2026
+
+@author: solis
+
+In-memory store of the daily series of the meteorological stations, built
+    from the database of AOD_2db or from the downloaded csv files. The
+    dates are int32 day offsets since 1970-01-01, the variables are float32
+    arrays with nan as missing value and the stations are dictionary
+    encoded, so the series of many stations and decades are sliced and
+    reduced with NumPy instead of row by row. It requires numpy.
+A store can be saved as a binary cache, a .npy file per array, which is
+    loaded memory mapped: loading does not read the files, the pages are
+    read on demand and shared by the processes that load the same cache.
+"""
+import csv
+from datetime import date
+from itertools import islice
+import json
+import os
+import pathlib
+from typing import Union
+
+import littleLogging as logging
+from aod_2db import AOD_2db
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class SeriesStore():
+    """
+    The rows of the store are sorted by station and date and there is only
+        one row per station and date:
+        stations: array with the station identifiers (indicativo), sorted;
+            the code of a station is its index in stations
+        station: int32 array with the station code of each row
+        day: int32 array with the date of each row as days since 1970-01-01
+        values: dictionary having the variable name as the key and a float32
+            array as the value
+    The rows of a station are contiguous; their first row is in the array
+        of station offsets, so a station and a date range are sliced with
+        two binary searches.
+    """
+
+    # Rows converted to arrays at once when the store is built
+    CHUNK_SIZE = 100000
+    # Binary cache (see save): subdirectory of the download directory,
+    #  description file, format version and prefix of the variable files
+    CACHE_DIR_NAME = 'series_cache'
+    __CACHE_MANIFEST = 'series_cache.json'
+    __CACHE_FORMAT = 1
+    __VALUES_PREFIX = 'values_'
+
+
+    def __init__(self, stations: list, station, day, values: dict):
+        """
+        Parameters
+        ----------
+        stations : Station identifiers; the station codes are indexes of
+            this list
+        station : Station code of each row
+        day : Date of each row as days since 1970-01-01
+        values : Variable name: array of values of each row
+
+        The rows do not need to be sorted; if a station and date is repeated
+            the first row is kept
+        """
+        if not SeriesStore.available():
+            raise ImportError('numpy is required to build a SeriesStore')
+        stations = np.asarray(stations, dtype=str)
+        station = np.asarray(station, dtype=np.int32)
+        day = np.asarray(day, dtype=np.int32)
+        # The stations are sorted and the codes are changed accordingly
+        order = np.argsort(stations, kind='stable')
+        new_codes = np.empty(len(order), dtype=np.int32)
+        new_codes[order] = np.arange(len(order), dtype=np.int32)
+        station = new_codes[station] if len(station) else station
+        rows = np.lexsort((day, station))
+        station = station[rows]
+        day = day[rows]
+        unique = np.ones(len(rows), dtype=bool)
+        unique[1:] = (station[1:] != station[:-1]) | (day[1:] != day[:-1])
+
+        self.stations = stations[order]
+        self.station = station[unique]
+        self.day = day[unique]
+        self.values: dict = {k: np.asarray(v, dtype=np.float32)[rows][unique] \
+                             for k, v in values.items()}
+        self.__offsets = np.searchsorted(self.station,
+                                         np.arange(len(self.stations) + 1))
+
+
+    @classmethod
+    def __from_arrays(cls, stations, station, day, values: dict, offsets):
+        """
+        Store of arrays that are already sorted and unique, for example
+            memory mapped arrays, which are not copied
+        """
+        store = cls.__new__(cls)
+        store.stations = stations
+        store.station = station
+        store.day = day
+        store.values = values
+        store.__offsets = offsets
+        return store
+
+
+    @staticmethod
+    def available() -> bool:
+        """
+        True if numpy is installed
+        """
+        return np is not None
+
+
+    def __len__(self) -> int:
+        return len(self.day)
+
+
+    @property
+    def variables(self) -> [str]:
+        return list(self.values.keys())
+
+
+    @classmethod
+    def from_db(cls, db: AOD_2db, variables: [str]=None,
+                stations: Union[str, list]=None,
+                d1: Union[str, date]=None, d2: Union[str, date]=None):
+        """
+        Builds the store with the daily data of the database of db (see
+            AOD_2db.series)
+
+        Parameters
+        ----------
+        db : AOD_2db object of a daily file type
+        variables : optional. Columns of the data table; the default is the
+            columns of type REAL and INTEGER
+        stations, d1, d2 : optional. Stations and dates to load
+
+        Returns
+        -------
+        SeriesStore or None if there is an error
+        """
+        if not db.is_daily_file_type():
+            logging.append('SeriesStore only stores daily data')
+            return None
+        if variables is None:
+            variables = db.numeric_columns()
+        if not variables:
+            logging.append('No variables to load in the SeriesStore')
+            return None
+        rows = db.series(stations, variables, d1, d2, as_arrays=False)
+        return cls.__from_rows(rows, variables)
+
+
+    @classmethod
+    def from_csv_dir(cls, d_path: str, file_type: str,
+                     variables: [str]=None):
+        """
+        Builds the store with the data csv files of a download directory
+
+        Parameters
+        ----------
+        d_path : Download directory
+        file_type : Daily file type of AOD_2db
+        variables : optional. Columns of the files; the default is the
+            columns of type float in the metadata
+
+        Returns
+        -------
+        SeriesStore or None if there is an error
+        """
+        db = AOD_2db(d_path, file_type, verbose=False)
+        if not db.is_daily_file_type():
+            logging.append('SeriesStore only stores daily data')
+            return None
+        if variables is None:
+            variables = sorted([k for k, v in \
+                                db.read_metadata_files().items() \
+                                if v[1] == 'float'])
+        if not variables:
+            logging.append('No variables to load in the SeriesStore')
+            return None
+        f_paths = db.data_file_paths()
+        return cls.__from_rows(SeriesStore.__csv_rows(f_paths, variables),
+                               variables)
+
+
+    @classmethod
+    def from_db_cached(cls, db: AOD_2db, variables: [str]=None,
+                       cache_dir: str=None):
+        """
+        Loads the store of the database of db from its binary cache (see
+            save and load). The cache is built, or built again, with
+            from_db if it does not exist, if the data of the database has
+            changed since it was built (see AOD_2db.data_version) or if it
+            has not all the variables. The cache has all the REAL and
+            INTEGER columns, and the variables, whatever the variables
+            requested, so the callers of different variables share it; the
+            variables are selected when it is loaded
+
+        Parameters
+        ----------
+        db : AOD_2db object of a daily file type
+        variables : optional. Columns of the data table; the default is the
+            columns of type REAL and INTEGER
+        cache_dir : optional. Directory of the cache; the default is the
+            subdirectory CACHE_DIR_NAME/{database name} of the directory of
+            db
+
+        Returns
+        -------
+        SeriesStore or None if there is an error
+        """
+        if not db.is_daily_file_type():
+            logging.append('SeriesStore only stores daily data')
+            return None
+        if cache_dir is None:
+            cache_dir = db.dir_path.joinpath(SeriesStore.CACHE_DIR_NAME,
+                                             db.get_default_dbpath().stem)
+        cache_dir = pathlib.Path(cache_dir)
+        version = db.data_version()
+        if version is None:
+            return None
+        if variables is None:
+            variables = db.numeric_columns()
+        manifest = SeriesStore.read_cache_manifest(cache_dir)
+        if manifest is not None and \
+            manifest.get('data_version') == version and \
+            set(variables).issubset(manifest['variables']):
+            store = cls.load(cache_dir, variables)
+            if store is not None:
+                return store
+
+        logging.append(f'Building the series cache in {cache_dir}', False)
+        all_variables = list(dict.fromkeys(db.numeric_columns() + \
+                                           list(variables)))
+        store = cls.from_db(db, all_variables)
+        if store is None or not store.save(cache_dir, version):
+            return store
+        loaded = cls.load(cache_dir, variables)
+        return store if loaded is None else loaded
+
+
+    def save(self, dir_path: str, data_version: str=None) -> bool:
+        """
+        Saves the store as a binary cache in the directory dir_path: a .npy
+            file (a small header with the type and shape and the array) for
+            each array of the index (stations, station, day and the station
+            offsets) and for each variable (values_{variable}.npy). The
+            description of the cache (format, variables, number of rows and
+            data_version) is saved in __CACHE_MANIFEST after the arrays, so
+            a cache whose saving has not ended is not valid. Each file is
+            written with a temporary name and renamed, so the processes
+            that have loaded the previous cache can go on reading it
+
+        Parameters
+        ----------
+        dir_path : Directory of the cache; it is created if it does not
+            exist
+        data_version : optional. Version of the source of the store (see
+            from_db_cached)
+
+        Returns
+        -------
+        bool. True if the cache has been saved
+        """
+        dir_path = pathlib.Path(dir_path)
+        manifest_path = dir_path.joinpath(SeriesStore.__CACHE_MANIFEST)
+        arrays = {'stations': self.stations, 'station': self.station,
+                  'day': self.day, 'offsets': self.__offsets}
+        for k, v in self.values.items():
+            arrays[f'{SeriesStore.__VALUES_PREFIX}{k}'] = v
+        try:
+            dir_path.mkdir(parents=True, exist_ok=True)
+            if manifest_path.exists():
+                manifest_path.unlink()
+            for name, a1 in arrays.items():
+                SeriesStore.__replace_file(dir_path.joinpath(f'{name}.npy'),
+                                           lambda f: np.save(f, a1))
+            for fp1 in dir_path.glob(f'{SeriesStore.__VALUES_PREFIX}*.npy'):
+                if fp1.stem not in arrays:
+                    fp1.unlink()
+            manifest = {'format': SeriesStore.__CACHE_FORMAT,
+                        'variables': self.variables, 'nrows': len(self),
+                        'data_version': data_version}
+            SeriesStore.__replace_file\
+                (manifest_path,
+                 lambda f: f.write(json.dumps(manifest, indent=1)\
+                                   .encode('utf-8')))
+        except OSError as err:
+            logging.append(f'The series cache has not been saved in '
+                           f'{dir_path}\n{err}')
+            return False
+        return True
+
+
+    @staticmethod
+    def __replace_file(file_path: pathlib.Path, write) -> None:
+        """
+        Writes file_path with the function write, which receives the file
+            object, in a temporary file that is renamed at the end
+        """
+        part_path = file_path.with_name(file_path.name + '.part')
+        try:
+            with open(part_path, 'wb') as f:
+                write(f)
+            os.replace(part_path, file_path)
+        finally:
+            if part_path.exists():
+                part_path.unlink()
+
+
+    @staticmethod
+    def read_cache_manifest(dir_path: str) -> dict:
+        """
+        Description of the binary cache in dir_path (see save); None if
+            there is not a valid cache
+        """
+        manifest_path = \
+            pathlib.Path(dir_path).joinpath(SeriesStore.__CACHE_MANIFEST)
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest.get('format') != SeriesStore.__CACHE_FORMAT:
+            return None
+        return manifest
+
+
+    @classmethod
+    def load(cls, dir_path: str, variables: [str]=None, mmap: bool=True):
+        """
+        Loads a store saved with save. The arrays are memory mapped in read
+            only mode unless mmap is False
+
+        Parameters
+        ----------
+        dir_path : Directory of the cache
+        variables : optional. Variables to load; the default is all the
+            variables of the cache
+        mmap : optional. If False the arrays are read into memory
+
+        Returns
+        -------
+        SeriesStore or None if there is not a valid cache
+        """
+        if not SeriesStore.available():
+            raise ImportError('numpy is required to load a SeriesStore')
+        dir_path = pathlib.Path(dir_path)
+        manifest = SeriesStore.read_cache_manifest(dir_path)
+        if manifest is None:
+            logging.append(f'No series cache in {dir_path}')
+            return None
+        if variables is None:
+            variables = manifest['variables']
+        elif isinstance(variables, str):
+            variables = [variables]
+        missing = [v1 for v1 in variables if v1 not in manifest['variables']]
+        if missing:
+            logging.append(f'Variables not in the series cache: '
+                           f'{", ".join(missing)}')
+            return None
+        mmap_mode = 'r' if mmap else None
+        names = ['stations', 'station', 'day', 'offsets'] + \
+            [f'{SeriesStore.__VALUES_PREFIX}{v1}' for v1 in variables]
+        try:
+            arrays = [np.load(dir_path.joinpath(f'{name}.npy'),
+                              mmap_mode=mmap_mode, allow_pickle=False) \
+                      for name in names]
+        except (OSError, ValueError) as err:
+            logging.append(f'Error loading the series cache in {dir_path}'
+                           f'\n{err}')
+            return None
+        if any(len(a1) != manifest['nrows'] for a1 in arrays[4:] + \
+               arrays[1:3]):
+            logging.append(f'The series cache in {dir_path} is not valid')
+            return None
+        return cls.__from_arrays(arrays[0], arrays[1], arrays[2],
+                                 dict(zip(variables, arrays[4:])), arrays[3])
+
+
+    @staticmethod
+    def __csv_rows(f_paths: [pathlib.Path], variables: [str]):
+        """
+        Yields the rows (indicativo, fecha, variable values) of the csv
+            files; the decimal comma is changed to a period
+        """
+        for fp1 in f_paths:
+            with open(fp1, 'r', newline='', encoding='utf-8') as csv_file:
+                reader = csv.DictReader(csv_file)
+                for row in reader:
+                    yield (row.get('indicativo'), row.get('fecha'),
+                           *[SeriesStore.__to_float(row.get(v1)) \
+                             for v1 in variables])
+
+
+    @staticmethod
+    def __to_float(value) -> float:
+        if isinstance(value, (int, float)):
+            return value
+        if value in AOD_2db.CODE_VALUES:
+            return AOD_2db.CODE_VALUES[value]
+        try:
+            return float(value.replace(',', '.'))
+        except (AttributeError, ValueError):
+            return None
+
+
+    @classmethod
+    def __from_rows(cls, rows, variables: [str]):
+        """
+        Builds the store with rows (indicativo, fecha, variable values),
+            which are converted to arrays in chunks of CHUNK_SIZE rows
+        """
+        codes = {}
+        station_chunks, day_chunks = [], []
+        value_chunks = {v1: [] for v1 in variables}
+        rows = iter(rows)
+        while True:
+            chunk = list(islice(rows, SeriesStore.CHUNK_SIZE))
+            if not chunk:
+                break
+            columns = list(zip(*chunk))
+            day = SeriesStore.__to_days(columns[1])
+            valid = day != np.iinfo(np.int64).min
+            station = np.fromiter((codes.setdefault(s, len(codes)) \
+                                   for s in columns[0]),
+                                  dtype=np.int32, count=len(chunk))
+            station_chunks.append(station[valid])
+            day_chunks.append(day[valid].astype(np.int32))
+            for v1, col in zip(variables, columns[2:]):
+                value_chunks[v1].append(SeriesStore.__to_array(col)[valid])
+
+        stations = sorted(codes, key=codes.get)
+        if not station_chunks:
+            return cls(stations, [], [], {v1: [] for v1 in variables})
+        return cls(stations, np.concatenate(station_chunks),
+                   np.concatenate(day_chunks),
+                   {v1: np.concatenate(value_chunks[v1]) \
+                    for v1 in variables})
+
+
+    @staticmethod
+    def __to_days(fechas: tuple):
+        """
+        Days since 1970-01-01 of the dates 'YYYY-MM-DD' as an int64 array;
+            the dates that are not valid are the minimum int64 (NaT)
+        """
+        try:
+            return np.array(fechas, dtype='datetime64[D]').astype(np.int64)
+        except (TypeError, ValueError):
+            days = np.empty(len(fechas), dtype=np.int64)
+            for i, f in enumerate(fechas):
+                try:
+                    days[i] = np.datetime64(f, 'D').astype(np.int64)
+                except (TypeError, ValueError):
+                    days[i] = np.iinfo(np.int64).min
+            return days
+
+
+    @staticmethod
+    def __to_array(values: tuple):
+        """
+        float32 array of values; None and the values that are not numbers
+            are nan
+        """
+        try:
+            return np.array(values, dtype=np.float32)
+        except (TypeError, ValueError):
+            return np.array([v if isinstance(v, (int, float)) else None \
+                             for v in values], dtype=np.float32)
+
+
+    @staticmethod
+    def to_day(value: Union[str, date]) -> int:
+        """
+        Days since 1970-01-01 of a date or 'YYYY-MM-DD'
+        """
+        return int(np.datetime64(str(value), 'D').astype(np.int64))
+
+
+    def dates(self):
+        """
+        Dates of the rows as a datetime64[D] array
+        """
+        return self.day.astype('datetime64[D]')
+
+
+    def __station_codes(self, stations: Union[str, list]):
+        """
+        Sorted array without repetitions of the codes of the stations that
+            are in the store; stations can be in any order and repeated
+        """
+        if stations is None:
+            return np.arange(len(self.stations))
+        if isinstance(stations, str):
+            stations = [stations]
+        codes = np.searchsorted(self.stations, stations)
+        codes = np.minimum(codes, max(len(self.stations) - 1, 0))
+        found = self.stations[codes] == np.asarray(stations, dtype=str) \
+            if len(self.stations) else np.zeros(len(stations), dtype=bool)
+        return np.unique(codes[found])
+
+
+    def rows(self, stations: Union[str, list]=None,
+             d1: Union[str, date]=None, d2: Union[str, date]=None):
+        """
+        Indexes of the rows of stations between d1 and d2, ordered by
+            station and date
+
+        Parameters
+        ----------
+        stations : optional. Station or list of stations; None, all
+        d1, d2 : optional. First and last date; None, not limited
+        """
+        day1 = None if d1 is None else SeriesStore.to_day(d1)
+        day2 = None if d2 is None else SeriesStore.to_day(d2)
+        starts = self.__offsets[:-1]
+        ends = self.__offsets[1:]
+        codes = self.__station_codes(stations)
+        slices = []
+        for c in codes:
+            start, end = starts[c], ends[c]
+            days = self.day[start:end]
+            if day1 is not None:
+                start += np.searchsorted(days, day1, side='left')
+            if day2 is not None:
+                end = starts[c] + np.searchsorted(days, day2, side='right')
+            if end > start:
+                slices.append(np.arange(start, end))
+        if not slices:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(slices)
+
+
+    def slice(self, stations: Union[str, list]=None,
+              d1: Union[str, date]=None, d2: Union[str, date]=None):
+        """
+        Returns a SeriesStore with the rows of stations between d1 and d2
+            (see rows)
+        """
+        rows = self.rows(stations, d1, d2)
+        codes = np.unique(self.station[rows])
+        new_codes = np.zeros(len(self.stations), dtype=np.int32)
+        new_codes[codes] = np.arange(len(codes), dtype=np.int32)
+        return SeriesStore(self.stations[codes],
+                           new_codes[self.station[rows]], self.day[rows],
+                           {k: v[rows] for k, v in self.values.items()})
+
+
+    def series(self, station: str, variable: str,
+               d1: Union[str, date]=None, d2: Union[str, date]=None):
+        """
+        Series of variable in station between d1 and d2; the arrays are
+            views of the store
+
+        Returns
+        -------
+        Tuple (dates as datetime64[D], values as float32)
+        """
+        codes = self.__station_codes(station)
+        if len(codes) == 0:
+            return (np.empty(0, dtype='datetime64[D]'),
+                    np.empty(0, dtype=np.float32))
+        rows = self.rows(station, d1, d2)
+        if len(rows):
+            rows = slice(rows[0], rows[-1] + 1)
+        return self.day[rows].astype('datetime64[D]'), \
+            self.values[variable][rows]
+
+
+    def matrix(self, variable: str, stations: Union[str, list]=None,
+               d1: Union[str, date]=None, d2: Union[str, date]=None):
+        """
+        Values of variable as a matrix with a row per station, in the order
+            of the returned stations (sorted, without repetitions), and a
+            column per day between d1 and d2; the missing days are nan
+
+        Returns
+        -------
+        Tuple (stations, dates as datetime64[D], float32 matrix)
+        """
+        rows = self.rows(stations, d1, d2)
+        codes = self.__station_codes(stations)
+        if d1 is not None:
+            day1 = SeriesStore.to_day(d1)
+        else:
+            day1 = int(self.day[rows].min()) if len(rows) else 0
+        if d2 is not None:
+            day2 = SeriesStore.to_day(d2)
+        else:
+            day2 = int(self.day[rows].max()) if len(rows) else day1 - 1
+        n_days = max(day2 - day1 + 1, 0)
+        data = np.full((len(codes), n_days), np.nan, dtype=np.float32)
+        i_row = np.searchsorted(codes, self.station[rows])
+        data[i_row, self.day[rows] - day1] = self.values[variable][rows]
+        dates = np.arange(day1, day1 + n_days).astype('datetime64[D]')
+        return self.stations[codes], dates, data
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 17:40:52 2026
+
+@author: solis
+
+Catalogue of the meteorological stations of Aemet OpenData, read from the
+    inventory downloaded by AemetOpenData.meteo_stations
+    (estaciones_open_data_data.csv). The coordinates, which Aemet gives as
+    degrees, minutes and seconds ('394924N'), are parsed once to arrays of
+    decimal degrees and indexed, so the stations near a point are found
+    without reading the file again. The queries return lists of station
+    identifiers (indicativo) that can be passed as the parameter stations
+    of AemetOpenData.meteo_data_by_station. It requires numpy; if scipy is
+    installed the stations are indexed in a KD-tree.
+"""
+import csv
+import pathlib
+import re
+
+import littleLogging as logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+
+class StationCatalog():
+    """
+    The stations are points on a sphere of radius EARTH_RADIUS_KM. They are
+        indexed by their unit vectors: the straight line (chord) distance
+        between two unit vectors increases with the great circle distance,
+        so the nearest stations and the stations within a radius are those
+        of the chord distances. The index is a scipy cKDTree or, if scipy
+        is not installed, the array of unit vectors, whose distances to a
+        point are computed at once (the inventory has about 1000 stations)
+    The stations whose coordinates are not valid are in the catalogue but
+        they are never returned by the queries.
+    """
+
+    FILE_NAME = 'estaciones_open_data_data.csv'
+    EARTH_RADIUS_KM = 6371.0088
+    # Degrees, minutes, seconds and hemisphere, for example 394924N
+    __DMS = re.compile(r'^\s*(\d{1,3})(\d{2})(\d{2}(?:\.\d*)?)\s*([NSEW])\s*$',
+                       re.IGNORECASE)
+
+
+    def __init__(self, file_path: str):
+        """
+        Parameters
+        ----------
+        file_path : Path of the inventory of stations (see FILE_NAME)
+        """
+        if not StationCatalog.available():
+            raise ImportError('numpy is required to build a StationCatalog')
+        self.file_path: pathlib.Path = pathlib.Path(file_path)
+        self.stations: [dict] = []
+        with open(self.file_path, 'r', newline='', encoding='utf-8') \
+            as csv_file:
+            for row in csv.DictReader(csv_file):
+                self.stations.append(row)
+        self.indicativos: [str] = [s1.get('indicativo', '') \
+                                   for s1 in self.stations]
+        self.__positions = {s1: i for i, s1 in enumerate(self.indicativos)}
+        self.lat = np.array([StationCatalog.dms_to_degrees\
+                             (s1.get('latitud')) for s1 in self.stations],
+                            dtype=np.float64)
+        self.lon = np.array([StationCatalog.dms_to_degrees\
+                             (s1.get('longitud')) for s1 in self.stations],
+                            dtype=np.float64)
+        self.__valid = np.flatnonzero(~np.isnan(self.lat) & \
+                                      ~np.isnan(self.lon))
+        if len(self.__valid) < len(self.stations):
+            logging.append(f'{len(self.stations) - len(self.__valid)} '
+                           'stations without valid coordinates in '
+                           f'{self.file_path.name}', False)
+        self.__xyz = StationCatalog.__unit_vectors(self.lat[self.__valid],
+                                                   self.lon[self.__valid])
+        self.__tree = None
+        if cKDTree is not None and len(self.__valid):
+            self.__tree = cKDTree(self.__xyz)
+
+
+    @classmethod
+    def from_dir(cls, d_path: str):
+        """
+        Catalogue of the inventory downloaded in the directory d_path; None
+            if the inventory is not in d_path
+        """
+        file_path = pathlib.Path(d_path).joinpath(cls.FILE_NAME)
+        if not file_path.exists():
+            logging.append(f'{file_path} does not exists; download it with '
+                           'AemetOpenData.meteo_stations')
+            return None
+        return cls(file_path)
+
+
+    @staticmethod
+    def available() -> bool:
+        """
+        True if numpy is installed
+        """
+        return np is not None
+
+
+    def __len__(self) -> int:
+        return len(self.stations)
+
+
+    @staticmethod
+    def dms_to_degrees(value: str) -> float:
+        """
+        Converts the coordinates of Aemet ('394924N', '025309W') to decimal
+            degrees, negative in the south and the west; nan if value is not
+            valid
+        """
+        if not isinstance(value, str):
+            return float('nan')
+        match = StationCatalog.__DMS.match(value)
+        if not match:
+            return float('nan')
+        degrees = int(match.group(1)) + int(match.group(2)) / 60. + \
+            float(match.group(3)) / 3600.
+        if match.group(4).upper() in ('S', 'W'):
+            degrees = -degrees
+        return degrees
+
+
+    @staticmethod
+    def __unit_vectors(lat, lon):
+        lat = np.radians(np.asarray(lat, dtype=np.float64))
+        lon = np.radians(np.asarray(lon, dtype=np.float64))
+        cos_lat = np.cos(lat)
+        return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon),
+                                np.sin(lat)))
+
+
+    @staticmethod
+    def __chord(distance_km: float) -> float:
+        """
+        Chord distance of the unit sphere of a great circle distance
+        """
+        angle = min(distance_km / StationCatalog.EARTH_RADIUS_KM, np.pi)
+        return 2. * np.sin(angle / 2.)
+
+
+    @staticmethod
+    def __great_circle(chord):
+        """
+        Great circle distance in km of chord distances of the unit sphere
+        """
+        chord = np.clip(np.asarray(chord, dtype=np.float64), 0., 2.)
+        return 2. * np.arcsin(chord / 2.) * StationCatalog.EARTH_RADIUS_KM
+
+
+    def station(self, indicativo: str) -> dict:
+        """
+        Row of the inventory of the station indicativo; {} if it is not in
+            the catalogue
+        """
+        i = self.__positions.get(indicativo)
+        if i is None:
+            return {}
+        return dict(self.stations[i], lat=float(self.lat[i]),
+                    lon=float(self.lon[i]))
+
+
+    def distances(self, lat: float, lon: float, stations: [str]=None):
+        """
+        Great circle distances in km from the point (lat, lon), in decimal
+            degrees, to stations; nan if a station is not in the catalogue
+            or it has not valid coordinates
+
+        Parameters
+        ----------
+        lat, lon : Coordinates of the point
+        stations : optional. Station identifiers; if None, all the stations
+            of the catalogue
+        """
+        if stations is None:
+            stations = self.indicativos
+        elif isinstance(stations, str):
+            stations = [stations]
+        positions = np.array([self.__positions.get(s1, -1) \
+                              for s1 in stations], dtype=np.int64)
+        found = positions >= 0
+        lats = np.where(found, self.lat[positions], np.nan)
+        lons = np.where(found, self.lon[positions], np.nan)
+        point = StationCatalog.__unit_vectors([lat], [lon])[0]
+        xyz = StationCatalog.__unit_vectors(lats, lons)
+        return StationCatalog.__great_circle(np.linalg.norm(xyz - point,
+                                                            axis=1))
+
+
+    def __query(self, lat: float, lon: float, k: int=None,
+                radius_km: float=None) -> ([int], [float]):
+        """
+        Positions (in self.__valid) and chord distances of the k nearest
+            stations to the point and/or of the stations within radius_km,
+            ordered by distance
+        """
+        n = len(self.__valid)
+        if n == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        point = StationCatalog.__unit_vectors([lat], [lon])[0]
+        chord = None if radius_km is None else \
+            StationCatalog.__chord(radius_km)
+        if self.__tree is not None:
+            if k is None:
+                idx = np.asarray(self.__tree.query_ball_point(point, chord),
+                                 dtype=np.int64)
+                dist = np.linalg.norm(self.__xyz[idx] - point, axis=1)
+            else:
+                k = min(k, n)
+                dist, idx = self.__tree.query(point, k=k,
+                                              distance_upper_bound=\
+                                              np.inf if chord is None \
+                                              else chord * (1 + 1e-12))
+                dist, idx = np.atleast_1d(dist), np.atleast_1d(idx)
+                found = idx < n
+                dist, idx = dist[found], idx[found]
+        else:
+            dist = np.linalg.norm(self.__xyz - point, axis=1)
+            idx = np.arange(n)
+            if chord is not None:
+                idx = idx[dist <= chord * (1 + 1e-12)]
+                dist = dist[idx]
+            if k is not None and k < len(idx):
+                nearest = np.argpartition(dist, k - 1)[:k]
+                idx, dist = idx[nearest], dist[nearest]
+        order = np.lexsort((idx, dist))
+        return idx[order], dist[order]
+
+
+    def nearest(self, lat: float, lon: float, k: int=1,
+                max_distance_km: float=None) -> [str]:
+        """
+        The k stations nearest to the point (lat, lon)
+
+        Parameters
+        ----------
+        lat, lon : Coordinates of the point in decimal degrees
+        k : optional. Number of stations
+        max_distance_km : optional. If not None, the stations farther than
+            max_distance_km are not returned
+
+        Returns
+        -------
+        Station identifiers ordered by distance
+        """
+        if k < 1:
+            return []
+        idx, _ = self.__query(lat, lon, k=k, radius_km=max_distance_km)
+        return [self.indicativos[i] for i in self.__valid[idx]]
+
+
+    def within_radius(self, lat: float, lon: float,
+                      radius_km: float) -> [str]:
+        """
+        Stations whose great circle distance to the point (lat, lon) is not
+            greater than radius_km, ordered by distance
+        """
+        idx, _ = self.__query(lat, lon, radius_km=radius_km)
+        return [self.indicativos[i] for i in self.__valid[idx]]
+
+
+    def within_bbox(self, lat_min: float, lat_max: float, lon_min: float,
+                    lon_max: float) -> [str]:
+        """
+        Stations inside the box of coordinates in decimal degrees, ordered
+            by station identifier. If lon_min is greater than lon_max the
+            box crosses the meridian 180
+        """
+        lat = self.lat[self.__valid]
+        lon = self.lon[self.__valid]
+        inside = (lat >= lat_min) & (lat <= lat_max)
+        if lon_min <= lon_max:
+            inside &= (lon >= lon_min) & (lon <= lon_max)
+        else:
+            inside &= (lon >= lon_min) | (lon <= lon_max)
+        return sorted([self.indicativos[i] for i in self.__valid[inside]])
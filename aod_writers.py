@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 12:31:10 2026
+
+@author: solis
+
+Writers of the rows downloaded from Aemet OpenData. A writer receives the
+    rows one by one as dictionaries, so the rows can be saved as they are
+    parsed from the response of the server. All the writers have the
+    methods write, close (it returns the number of rows written) and abort
+    and the attribute nrows.
+The file writers are created with new_file_writer by file format; the
+    parquet writer requires pyarrow.
+"""
+import csv
+from datetime import date
+import os
+import pathlib
+
+import littleLogging as logging
+from aod_2db import AOD_2db
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+class CsvRecordWriter():
+    """
+    Writes dictionaries as rows of a csv file. The columns are given when the
+        writer is created (for example, the ids of the metadata) or they are
+        the sorted keys of the first row. The rows are written to a temporary
+        file as they arrive; if a row has keys that are not in the columns,
+        the new columns are appended and, when the writer is closed, the
+        temporary file is copied row by row with the final header. Memory
+        use does not depend on the number of rows.
+    """
+
+    __PART_SUFFIX = '.part'
+
+
+    def __init__(self, file_path: str, columns: [str]=None):
+        """
+        Parameters
+        ----------
+        file_path : Path of the csv file
+        columns : optional. Initial columns of the csv file
+        """
+        self.file_path: pathlib.Path = pathlib.Path(file_path)
+        self.nrows: int = 0
+        self.__part_path = \
+            self.file_path.with_name(self.file_path.name + \
+                                     CsvRecordWriter.__PART_SUFFIX)
+        self.__columns = list(columns) if columns else []
+        self.__column_set = set(self.__columns)
+        self.__header_len = len(self.__columns)
+        self.__file = None
+        self.__writer = None
+
+
+    def __open(self, record: dict) -> None:
+        if not self.__columns:
+            self.__columns = sorted(record.keys())
+            self.__column_set = set(self.__columns)
+            self.__header_len = len(self.__columns)
+        self.__file = open(self.__part_path, 'w', newline='',
+                           encoding='utf-8')
+        self.__writer = csv.writer(self.__file)
+        self.__writer.writerow(self.__columns)
+
+
+    def write(self, record: dict) -> None:
+        """
+        Writes a row; missing keys are written as ''
+        """
+        if self.__file is None:
+            self.__open(record)
+        columns = self.__columns
+        for k in record:
+            if k not in self.__column_set:
+                columns.append(k)
+                self.__column_set.add(k)
+        self.__writer.writerow([record.get(c1, '') for c1 in columns])
+        self.nrows += 1
+
+
+    def close(self) -> int:
+        """
+        Closes the writer and saves the file
+
+        Returns
+        -------
+        Number of rows written
+        """
+        if self.__file is None:
+            return 0
+        self.__file.close()
+        self.__file = None
+        if len(self.__columns) == self.__header_len:
+            os.replace(self.__part_path, self.file_path)
+            return self.nrows
+
+        # There are new columns: the header and the short rows are rewritten
+        n_columns = len(self.__columns)
+        with open(self.__part_path, 'r', newline='', encoding='utf-8') as fi,\
+            open(self.file_path, 'w', newline='', encoding='utf-8') as fo:
+            reader = csv.reader(fi)
+            writer = csv.writer(fo)
+            next(reader)
+            writer.writerow(self.__columns)
+            for row in reader:
+                if len(row) < n_columns:
+                    row += [''] * (n_columns - len(row))
+                writer.writerow(row)
+        os.remove(self.__part_path)
+        return self.nrows
+
+
+    def abort(self) -> None:
+        """
+        Closes the writer and deletes the temporary file
+        """
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+        try:
+            os.remove(self.__part_path)
+        except OSError as err:
+            logging.append(f'{self.__part_path} not removed: {err}', False)
+
+
+class ParquetRecordWriter():
+    """
+    Writes dictionaries as rows of a parquet file with typed columns:
+        * the columns of type float in the metadata are float64; as in the
+        database (see AOD_2db), the decimal comma is changed to a period
+        and the codes of AOD_2db.CODE_VALUES are their number ('Ip',
+        inappreciable precipitation, is 0); the other values that are not
+        numbers (for example 'Acum') are null, since the column can not
+        keep them as text
+        * the columns in date_columns are dates
+        * the columns in DICTIONARY_COLUMNS are dictionary encoded strings
+        * the rest of the columns are strings
+    The missing values are null. The columns of the file are the ids of the
+        metadata and the keys of the first batch of rows, sorted; each batch
+        of batch_size rows is a row group. If a later row has keys that are
+        not in the columns, the next batches are written with the new
+        columns in another temporary file and, when the writer is closed,
+        the temporary files are joined. It requires pyarrow.
+    """
+
+    DICTIONARY_COLUMNS = ('indicativo', 'nombre', 'provincia')
+    BATCH_SIZE = 50000
+    __PART_SUFFIX = '.part{}'
+
+
+    def __init__(self, file_path: str, columns: dict=None,
+                 date_columns: [str]=(), batch_size: int=BATCH_SIZE):
+        """
+        Parameters
+        ----------
+        file_path : Path of the parquet file
+        columns : optional. Metadata of the columns as a dictionary having
+            the column id as the key and a list [descripcion, tipo_datos,
+            requerido] as the value (see MetadataCache.columns)
+        date_columns : optional. Columns with dates as 'YYYY-MM-DD'
+        batch_size : optional. Number of rows of a row group
+        """
+        if not ParquetRecordWriter.available():
+            raise ImportError('pyarrow is required to write parquet files')
+        self.file_path: pathlib.Path = pathlib.Path(file_path)
+        self.batch_size: int = batch_size
+        self.nrows: int = 0
+        self.__types = {}
+        if columns:
+            for k, v in columns.items():
+                self.__types[k] = 'float' if v[1] == 'float' else 'str'
+        for c1 in date_columns:
+            self.__types[c1] = 'date'
+        for c1 in ParquetRecordWriter.DICTIONARY_COLUMNS:
+            self.__types[c1] = 'dictionary'
+        self.__columns = sorted(columns) if columns else []
+        self.__batch = []
+        self.__part_paths = []
+        self.__writer = None
+
+
+    @staticmethod
+    def available() -> bool:
+        """
+        True if pyarrow is installed
+        """
+        return pa is not None
+
+
+    def __field_type(self, column: str):
+        column_type = self.__types.get(column, 'str')
+        if column_type == 'float':
+            return pa.float64()
+        if column_type == 'date':
+            return pa.date32()
+        if column_type == 'dictionary':
+            return pa.dictionary(pa.int32(), pa.string())
+        return pa.string()
+
+
+    @staticmethod
+    def __to_float(value) -> float:
+        if isinstance(value, (int, float)):
+            return float(value)
+        if isinstance(value, str) and value.strip() in AOD_2db.CODE_VALUES:
+            return AOD_2db.CODE_VALUES[value.strip()]
+        try:
+            return float(value.replace(',', '.'))
+        except (AttributeError, ValueError):
+            return None
+
+
+    @staticmethod
+    def __to_date(value) -> date:
+        try:
+            return date.fromisoformat(value[:10])
+        except (TypeError, ValueError):
+            return None
+
+
+    def __array(self, column: str, values: list):
+        column_type = self.__types.get(column, 'str')
+        if column_type == 'float':
+            return pa.array([ParquetRecordWriter.__to_float(v) \
+                             for v in values], pa.float64())
+        if column_type == 'date':
+            return pa.array([ParquetRecordWriter.__to_date(v) \
+                             for v in values], pa.date32())
+        values = [v if v is None or isinstance(v, str) else str(v) \
+                  for v in values]
+        if column_type == 'dictionary':
+            return pa.array(values, pa.string()).dictionary_encode()
+        return pa.array(values, pa.string())
+
+
+    def __open_part(self) -> None:
+        schema = pa.schema([(c1, self.__field_type(c1)) \
+                            for c1 in self.__columns])
+        part_path = self.file_path.with_name\
+            (self.file_path.name + ParquetRecordWriter.__PART_SUFFIX\
+             .format(len(self.__part_paths)))
+        self.__part_paths.append(part_path)
+        self.__writer = pq.ParquetWriter(part_path, schema)
+
+
+    def __flush(self) -> None:
+        if not self.__batch:
+            return
+        keys = {k for r in self.__batch for k in r}
+        new_columns = keys.difference(self.__columns)
+        if self.__writer is None or new_columns:
+            if self.__writer is not None:
+                self.__writer.close()
+            self.__columns = self.__columns + sorted(new_columns)
+            self.__open_part()
+        arrays = [self.__array(c1, [r.get(c1) for r in self.__batch]) \
+                  for c1 in self.__columns]
+        table = pa.Table.from_arrays(arrays, schema=self.__writer.schema)
+        self.__writer.write_table(table)
+        self.__batch = []
+
+
+    def write(self, record: dict) -> None:
+        self.__batch.append(record)
+        self.nrows += 1
+        if len(self.__batch) >= self.batch_size:
+            self.__flush()
+
+
+    def close(self) -> int:
+        """
+        Closes the writer and saves the file
+
+        Returns
+        -------
+        Number of rows written
+        """
+        self.__flush()
+        if self.__writer is None:
+            return 0
+        self.__writer.close()
+        self.__writer = None
+        if len(self.__part_paths) == 1:
+            os.replace(self.__part_paths[0], self.file_path)
+        else:
+            # There are new columns: the temporary files are joined
+            tables = [pq.read_table(pp1) for pp1 in self.__part_paths]
+            table = pa.concat_tables(tables, promote_options='default')
+            pq.write_table(table, self.file_path)
+            for pp1 in self.__part_paths:
+                os.remove(pp1)
+        self.__part_paths = []
+        return self.nrows
+
+
+    def abort(self) -> None:
+        """
+        Closes the writer and deletes the temporary files
+        """
+        self.__batch = []
+        if self.__writer is not None:
+            self.__writer.close()
+            self.__writer = None
+        for pp1 in self.__part_paths:
+            try:
+                os.remove(pp1)
+            except OSError as err:
+                logging.append(f'{pp1} not removed: {err}', False)
+        self.__part_paths = []
+
+
+class DbRecordWriter():
+    """
+    Writes dictionaries in the database of an AOD_2db object. The rows are
+        inserted in batches of batch_size rows, each batch in a transaction
+        (see AOD_2db.insert_records)
+    """
+
+    BATCH_SIZE = 5000
+
+
+    def __init__(self, db, key: str='data', batch_size: int=BATCH_SIZE):
+        """
+        Parameters
+        ----------
+        db : AOD_2db object of the file type of the rows
+        key : optional. 'data' or 'metadata'
+        batch_size : optional. Number of rows inserted in a transaction
+        """
+        self.db = db
+        self.key: str = key
+        self.batch_size: int = batch_size
+        self.nrows: int = 0
+        self.__batch = []
+
+
+    def __flush(self) -> None:
+        if not self.__batch:
+            return
+        if not self.db.insert_records(self.__batch, self.key):
+            self.__batch = []
+            raise ValueError('The rows could not be inserted in '
+                             f'{self.db.get_default_dbpath()}')
+        self.__batch = []
+
+
+    def write(self, record: dict) -> None:
+        self.__batch.append(record)
+        self.nrows += 1
+        if len(self.__batch) >= self.batch_size:
+            self.__flush()
+
+
+    def close(self) -> int:
+        """
+        Inserts the pending rows
+
+        Returns
+        -------
+        Number of rows written
+        """
+        self.__flush()
+        return self.nrows
+
+
+    def abort(self) -> None:
+        """
+        Discards the pending rows; the batches already inserted are kept
+        """
+        self.__batch = []
+
+
+class TeeRecordWriter():
+    """
+    Writes each dictionary with several writers, for example a csv file and
+        a database
+    """
+
+
+    def __init__(self, writers: list):
+        self.writers = writers
+
+
+    @property
+    def nrows(self) -> int:
+        return self.writers[0].nrows
+
+
+    def write(self, record: dict) -> None:
+        for w1 in self.writers:
+            w1.write(record)
+
+
+    def close(self) -> int:
+        """
+        Closes the writers
+
+        Returns
+        -------
+        Number of rows written
+        """
+        nrows = 0
+        for w1 in self.writers:
+            nrows = w1.close()
+        return nrows
+
+
+    def abort(self) -> None:
+        for w1 in self.writers:
+            w1.abort()
+
+
+# Suffix of the files by file format
+FILE_SUFFIXES = {'csv': '.csv', 'parquet': '.parquet'}
+
+
+def new_file_writer(file_format: str, file_path: str, columns: dict=None,
+                    date_columns: [str]=()):
+    """
+    Returns a file writer
+
+    Parameters
+    ----------
+    file_format : A key of FILE_SUFFIXES
+    file_path : Path of the file
+    columns : optional. Metadata of the columns (see ParquetRecordWriter);
+        in csv files only the column ids are used
+    date_columns : optional. Columns with dates; only in parquet files
+
+    Returns
+    -------
+    CsvRecordWriter or ParquetRecordWriter
+    """
+    if file_format == 'parquet':
+        return ParquetRecordWriter(file_path, columns, date_columns)
+    return CsvRecordWriter(file_path, sorted(columns) if columns else None)
@@ -64,22 +64,28 @@ if __name__ == "__main__":
                 aod.meteo_data_all_stations(par.d1, par.d2, par.dir_path, 
                                             fetch = par.fetch, 
                                             verbose = par.verbose, 
-                                            use_files = par.use_files)
+                                            use_files = par.use_files,
+                                            max_workers = par.max_workers,
+                                            metadata_cache = \
+                                                par.metadata_cache)
             print('Downloaded files', len(file_names))                
         elif ans == '3':
             file_names =\
                 aod.meteo_data_by_station\
                     (par.time_step, par.d1, par.d2, 
                      par.stations, par.dir_path, par.fetch,
-                     par.verbose, par.use_files)
+                     par.verbose, par.use_files, par.max_workers,
+                     par.metadata_cache)
             print('Downloaded files', len(file_names))
         elif ans == '4':
-            a2db = AOD_2db(par.dir_path, par.ftype)
-            if not a2db.to_db():
+            a2db = AOD_2db(par.dir_path, par.ftype,
+                           max_workers=par.parse_workers,
+                           partition=par.partition)
+            if not a2db.to_db(par.incremental):
                 print('No data has been inserted')
                 raise SystemExit(0)
             else:
-                a2db.to_csv()
+                a2db.to_csv(overwrite=par.overwrite_csv)
         else:
             print('Not an action option selected')
 